@@ -0,0 +1,97 @@
+"""
+Benchmark the processed-record dedup check.
+
+Compares the old pickled set of SHA-256 hex strings with the SQLite DedupStore,
+with and without the Bloom filter in front, for startup cost, memory and
+lookup latency on new records and already processed ones. Most fetched rows
+are already processed (each run re-reads its TRACK_HOURS overlap), so that is
+the common case; the Bloom filter only speeds up new ones.
+
+Usage:
+    python bench_dedup.py --records 1000000 --lookups 100000
+"""
+import argparse
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+import tracemalloc
+from dedup_store import DedupStore
+
+BATCH = 1000
+
+
+def make_digests(count, salt):
+    return [hashlib.sha256(f"{salt}-{i}".encode()).digest() for i in range(count)]
+
+
+def measure(label, setup, lookup, new_keys, old_keys):
+    tracemalloc.start()
+    start = time.perf_counter()
+    target = setup()
+    load_seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    results = {}
+    for name, keys in (("new", new_keys), ("processed", old_keys)):
+        start = time.perf_counter()
+        for i in range(0, len(keys), BATCH):
+            lookup(target, keys[i:i + BATCH])
+        results[name] = (time.perf_counter() - start) / len(keys) * 1e6
+
+    print(f"{label:<28} load {load_seconds:7.2f}s  peak mem {peak / 1e6:8.1f} MB  "
+          f"new {results['new']:6.2f} us/row  processed {results['processed']:6.2f} us/row")
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=1_000_000, help="processed hashes already stored")
+    parser.add_argument("--lookups", type=int, default=100_000, help="lookups per key kind")
+    parser.add_argument("--error-rate", type=float, default=0.001, help="bloom false-positive rate")
+    args = parser.parse_args()
+
+    stored = make_digests(args.records, "stored")
+    new_keys = make_digests(args.lookups, "new")
+    old_keys = stored[:args.lookups]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_path = os.path.join(tmp, "processed_records.pkl")
+        with open(pickle_path, "wb") as file:
+            pickle.dump({"hashes": {d.hex() for d in stored}, "last_run": None}, file)
+
+        db_path = os.path.join(tmp, "processed_records.db")
+        bloom_path = os.path.join(tmp, "processed_records.bloom")
+        seed = DedupStore(db_path)
+        seed.add_many(stored)
+        seed.close()
+        # Build and save the filter once so the timed load below is a warm start
+        DedupStore(db_path, bloom_path=bloom_path, bloom_error_rate=args.error_rate).close()
+
+        print(f"{args.records} stored hashes, {args.lookups} lookups of each kind\n")
+
+        def load_pickle():
+            with open(pickle_path, "rb") as file:
+                return pickle.load(file)["hashes"]
+
+        measure("pickled set (hex)", load_pickle,
+                lambda hashes, keys: [k.hex() in hashes for k in keys], new_keys, old_keys)
+
+        store = measure("sqlite store", lambda: DedupStore(db_path),
+                        lambda s, keys: s.existing(keys), new_keys, old_keys)
+        store.close()
+
+        store = measure("sqlite store + bloom", lambda: DedupStore(db_path, bloom_path=bloom_path,
+                                                                   bloom_error_rate=args.error_rate),
+                        lambda s, keys: s.existing(keys), new_keys, old_keys)
+        false_positives = store.store_lookups - len(old_keys)
+        print(f"\nbloom filter: {store.bloom.memory_bytes() / 1e6:.1f} MB on disk/in memory, "
+              f"{store.bloom.num_hashes} hashes, "
+              f"observed false positives {false_positives}/{len(new_keys)}")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
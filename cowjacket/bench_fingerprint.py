@@ -0,0 +1,87 @@
+"""
+Benchmark record fingerprinting, reported as cost per million rows.
+
+Compares the old '|'-joined SHA-256 record hash (hex, as first written, and
+raw bytes) with the length-prefixed fingerprint, and SHA-256 with BLAKE2b-128
+over the same length-prefixed encoding. Rows come from the fixture generator, with dates as strings (what SQLite returns)
+or as date/datetime objects (what PostgreSQL returns).
+
+Usage:
+    python bench_fingerprint.py --rows 200000 --batch 1000 --types native
+"""
+import argparse
+import hashlib
+import time
+from collections import namedtuple
+from operator import attrgetter
+from datetime import date, datetime
+from fingerprint import FINGERPRINT_FIELDS, encode_fields, fingerprint, legacy_fingerprint
+from fixtures import COLUMNS, generate_rows
+
+Row = namedtuple("Row", COLUMNS)
+get_fields = attrgetter(*FINGERPRINT_FIELDS)
+
+
+def legacy_hex(row):
+    """The record hash as first written: a hex string per row."""
+    hash_string = f"{row.newusername}|{row.emailaddress}|{row.phonenumber}|{row.createdat}|{row.dateneededby}|{row.telephonelinesandinstallations}|{row.handsetsandheadsets}"
+    return hashlib.sha256(hash_string.encode()).hexdigest()
+
+
+def make_rows(count, native):
+    rows = []
+    for values in generate_rows(count, seed=0):
+        row = Row(*values)
+        if native:
+            row = row._replace(createdat=datetime.fromisoformat(row.createdat),
+                               dateneededby=date.fromisoformat(row.dateneededby))
+        rows.append(row)
+    return rows
+
+
+def timed(cases, batches, repeat):
+    """Best time of each case over `repeat` rounds; cases take turns so machine noise hits them alike."""
+    best = [float("inf")] * len(cases)
+    for _ in range(repeat):
+        for index, (_, fn, _) in enumerate(cases):
+            start = time.perf_counter()
+            for batch in batches:
+                fn(batch)
+            best[index] = min(best[index], time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--batch", type=int, default=1000, help="rows per fetched batch")
+    parser.add_argument("--types", choices=("text", "native"), default="native",
+                        help="dates as strings (SQLite) or date/datetime objects (PostgreSQL)")
+    parser.add_argument("--repeat", type=int, default=7, help="timing repeats (best is reported)")
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows, args.types == "native")
+    batches = [rows[start:start + args.batch] for start in range(0, len(rows), args.batch)]
+
+    # fingerprint's shortcut must give the same digests as the general encoding
+    assert all(fingerprint(row) == hashlib.sha256(encode_fields(get_fields(row))).digest() for row in batches[0])
+
+    cases = (
+        ("sha256 hex, '|' joined (original)", lambda batch: [legacy_hex(row) for row in batch], 64),
+        ("sha256 bytes, '|' joined (previous)", lambda batch: [legacy_fingerprint(row) for row in batch], 32),
+        ("sha256, length-prefixed (fingerprint)", lambda batch: [fingerprint(row) for row in batch], 32),
+        ("sha256, encode_fields", lambda batch: [
+            hashlib.sha256(encode_fields(get_fields(row))).digest() for row in batch], 32),
+        ("blake2b-128, encode_fields", lambda batch: [
+            hashlib.blake2b(encode_fields(get_fields(row)), digest_size=16).digest() for row in batch], 16),
+    )
+    print(f"{args.rows} rows in batches of {args.batch}, {args.types} dates, best of {args.repeat}\n")
+    print(f"{'':38} {'s per 1M rows':>13} {'MB of digests per 1M':>20}")
+    timings = timed(cases, batches, args.repeat)
+    baseline = timings[0]
+    for (label, _, digest_bytes), seconds in zip(cases, timings):
+        print(f"{label:38} {seconds / args.rows * 1e6:>13.2f} {digest_bytes:>20}   ({baseline / seconds:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Benchmark ticket payload building for one batch.
+
+"before" is the per-row dict building + json.dumps that process_batch used to do;
+"after" is PayloadCompiler.build_batch on the same rows.
+
+Usage:
+    python bench_payload.py --rows 1000 --repeat 20
+"""
+import argparse
+import json
+import random
+import time
+from collections import namedtuple
+from payload import PayloadCompiler, DEFAULT_FORM_SCHEMA, TEMPORARY_USE
+
+COLUMNS = ("newusername", "job", "phonenumber", "emailaddress", "departmentname", "costcenter",
+           "telephonelinesandinstallations", "handsetsandheadsets", "timeframe", "dateneededby",
+           "approximateendingdate", "Comments", "createdat")
+Row = namedtuple("Row", COLUMNS)
+
+
+def legacy_payload(user, service_desk_id="1", request_type_id="2"):
+    """The payload build process_batch did per row before PayloadCompiler."""
+    name = user.newusername
+    equipment = [item.strip() for item in user.handsetsandheadsets.split(";")]
+    approx_ending_date = None
+    if user.timeframe == TEMPORARY_USE:
+        time_usage = ["183"]
+        approx_ending_date = user.approximateendingdate
+    elif user.timeframe == "Permanent use":
+        time_usage = ["184"]
+
+    installation_mapping = {
+        "New extension including new cabling and socket": ["160"],
+        "New extension to an existing, inactive socket": ["161"],
+        "Relocate existing to a new location": ["182"],
+        "Convert existing extension from analogue to digital": ["190"],
+        "Relocate an existing extension to an existing inactive, socket": ["191"],
+        "Swap of telephone extensions": ["192"],
+        "Other... (multi-line hunt group setup)": ["0"]
+    }
+    installation_type_cd = installation_mapping[user.telephonelinesandinstallations]
+    equipment_list = []
+    equipment_mapping = {
+        "Handset speaker phone": "164",
+        "Cordless headset": "165",
+        "Cordless handset": "166",
+        "Mobile phone": "167",
+        "Smartphone": "168",
+        "SIM card only": "194",
+        "Other...": "0"
+    }
+    for item in equipment:
+        if item in equipment_mapping:
+            equipment_list.append(equipment_mapping[item])
+
+    ticket_issue = {
+        "serviceDeskId": service_desk_id,
+        "requestTypeId": request_type_id,
+        "requestFieldValues": {
+            "summary": f"Phone equipment order - {name}",
+            "description": f"Equipment request for {name} in {user.departmentname}"
+        },
+        "form": {
+            "answers": {
+                "199": {"text": name},
+                "200": {"text": user.job},
+                "201": {"text": user.phonenumber},
+                "202": {"text": user.emailaddress},
+                "203": {"text": user.departmentname},
+                "204": {"text": user.costcenter},
+                "157": {"choices": installation_type_cd},
+                "159": {"choices": equipment_list},
+                "205": {"choices": time_usage},
+                "206": {"date": user.dateneededby},
+                "189": {"text": user.Comments}
+            }
+        }
+    }
+    if approx_ending_date:
+        ticket_issue["form"]["answers"]["197"] = {"date": approx_ending_date}
+    return json.dumps(ticket_issue).encode()
+
+
+def make_rows(count, seed=0):
+    rng = random.Random(seed)
+    installations = list(DEFAULT_FORM_SCHEMA["answers"][6]["choices"])
+    equipment = list(DEFAULT_FORM_SCHEMA["answers"][7]["choices"])
+    rows = []
+    for i in range(count):
+        rows.append(Row(
+            f"User {i}", "Data Engineer", f"0819{i:07d}", f"user{i}@example.com", "Finance",
+            f"{rng.randrange(10**10):010d}", rng.choice(installations),
+            "; ".join(rng.sample(equipment, rng.randint(1, 3))),
+            rng.choice([TEMPORARY_USE, "Permanent use"]), "2025-10-28", "2025-11-22",
+            "Replace faulty handset", "2025-10-24"
+        ))
+    return rows
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000, help="rows per batch")
+    parser.add_argument("--repeat", type=int, default=20, help="timing repeats (best is reported)")
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    compiler = PayloadCompiler("1", "2")
+
+    # Both paths must produce the same documents
+    for row in rows:
+        assert json.loads(compiler.build(row)) == json.loads(legacy_payload(row))
+
+    before = timed(lambda: [legacy_payload(row) for row in rows], args.repeat)
+    after = timed(lambda: compiler.build_batch(rows), args.repeat)
+
+    print(f"batch of {args.rows} rows, best of {args.repeat}")
+    print(f"before (dict + json.dumps per row): {before * 1e3:8.2f} ms  ({before / args.rows * 1e6:6.2f} us/row)")
+    print(f"after  (PayloadCompiler.build_batch): {after * 1e3:8.2f} ms  ({after / args.rows * 1e6:6.2f} us/row)")
+    print(f"speedup: {before / after:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+End-to-end throughput benchmark for main.py against the local mock Jira.
+
+For every batch size / worker count combination, runs a full main.main() in a
+fresh working directory against a seeded SQLite phonerequest fixture and a
+MockJira server, and reports tickets/sec, request latency p50/p99, fetch
+rate, peak memory and dedup store size. Each run is a separate process so
+module-level settings and memory peaks don't leak between runs.
+
+Save results with --output and compare later runs with --baseline; the script
+exits non-zero if tickets/sec drops by more than --tolerance for any
+combination.
+
+Usage:
+    python bench_throughput.py --rows 5000 --batch-sizes 500,1000 --workers 4,8,16 --latency 20
+    python bench_throughput.py --output baseline.json
+    python bench_throughput.py --baseline baseline.json --tolerance 0.15
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from fixtures import write_fixture
+from mock_jira import MockJira
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULT_FILE = "bench_result.json"
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_child(use_tracemalloc):
+    """Runs inside the benchmark subprocess: one main.main() with timing hooks."""
+    sys.path.insert(0, HERE)
+    if use_tracemalloc:
+        tracemalloc.start()
+    import main
+
+    start = time.perf_counter()
+    fetched = sum(len(batch) for batch in main.fetch_users_in_batches())
+    fetch_seconds = time.perf_counter() - start
+
+    # Time every Jira call (a single ticket, or one bulk call)
+    latencies = []
+    send_tickets = main.send_tickets
+
+    def timed_send_tickets(*args, **kwargs):
+        call_start = time.perf_counter()
+        try:
+            return send_tickets(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - call_start)
+
+    main.send_tickets = timed_send_tickets
+    start = time.perf_counter()
+    main.main()
+    seconds = time.perf_counter() - start
+
+    if use_tracemalloc:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    else:
+        # ru_maxrss is in KB on Linux
+        peak_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    store_bytes = sum(entry.stat().st_size for entry in os.scandir(main.RECORD_DIR) if entry.is_file())
+    with open(RESULT_FILE, "w") as file:
+        json.dump({
+            "seconds": seconds,
+            "fetch_rows_per_sec": fetched / fetch_seconds if fetch_seconds else 0.0,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "peak_mb": peak_bytes / 1e6,
+            "store_kb": store_bytes / 1e3
+        }, file)
+
+
+def run_case(args, fixture_path, batch_size, workers):
+    """Run one benchmark combination in a subprocess and return its results."""
+    with tempfile.TemporaryDirectory() as workdir, \
+            MockJira(latency=args.latency / 1000, error_rate=args.error_rate,
+                     throttle_rate=args.throttle_rate, max_rps=args.max_rps, seed=0) as mock:
+        db_path = os.path.join(workdir, "phonerequest.db")
+        shutil.copy(fixture_path, db_path)
+        env = dict(os.environ,
+                   DB_CREDENTIALS=f"sqlite:///{db_path}",
+                   JIRA_URL=mock.url, JIRA_EMAIL="bench", JIRA_API_TOKEN="bench",
+                   SERVICE_DESK_ID="1", REQUEST_TYPE_ID="2",
+                   CHUNK_SIZE=str(batch_size), MAX_WORKERS=str(workers), JIRA_POOL_SIZE=str(workers),
+                   JIRA_RATE=str(args.jira_rate), JIRA_MAX_RATE=str(args.jira_rate),
+                   FETCH_MODE="full", PAGINATION_MODE=args.pagination,
+                   BULK_MODE="true" if args.bulk else "false",
+                   JIRA_PROJECT_KEY="CP", JIRA_ISSUE_TYPE_ID="10001")
+        command = [sys.executable, os.path.abspath(__file__), "--child"]
+        if args.tracemalloc:
+            command.append("--tracemalloc")
+        subprocess.run(command, cwd=workdir, env=env, check=True)
+
+        with open(os.path.join(workdir, RESULT_FILE)) as file:
+            result = json.load(file)
+        result.update(batch_size=batch_size, workers=workers, tickets=mock.stats['created'],
+                      requests=mock.stats['requests'])
+        result["tickets_per_sec"] = result["tickets"] / result["seconds"] if result["seconds"] else 0.0
+        return result
+
+
+def compare(results, baseline_path, tolerance):
+    """Return a line per combination whose tickets/sec regressed against the baseline."""
+    with open(baseline_path) as file:
+        baseline = {(r["batch_size"], r["workers"]): r for r in json.load(file)}
+    regressions = []
+    for result in results:
+        before = baseline.get((result["batch_size"], result["workers"]))
+        if before and result["tickets_per_sec"] < before["tickets_per_sec"] * (1 - tolerance):
+            regressions.append(f"batch {result['batch_size']}, workers {result['workers']}: "
+                               f"{before['tickets_per_sec']:.1f} -> {result['tickets_per_sec']:.1f} tickets/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000, help="phonerequest rows in the fixture")
+    parser.add_argument("--batch-sizes", default="500,1000", help="comma-separated CHUNK_SIZE values")
+    parser.add_argument("--workers", default="4,8,16", help="comma-separated MAX_WORKERS values")
+    parser.add_argument("--latency", type=float, default=20, help="mock Jira mean latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="mock 503 fraction")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="mock 429 fraction")
+    parser.add_argument("--max-rps", type=float, default=None, help="mock 429 above this many requests/sec")
+    parser.add_argument("--jira-rate", type=float, default=1000, help="JIRA_RATE/JIRA_MAX_RATE for the client")
+    parser.add_argument("--pagination", default="stream", help="PAGINATION_MODE")
+    parser.add_argument("--bulk", action="store_true", help="use BULK_MODE")
+    parser.add_argument("--bad-rate", type=float, default=0.0, help="fixture rows failing validation")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="report Python heap peak via tracemalloc (slower) instead of process max RSS")
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--baseline", help="compare tickets/sec against a previous --output file")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed tickets/sec drop vs baseline")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.tracemalloc)
+        return
+
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        fixture_path = os.path.join(fixture_dir, "phonerequest.db")
+        write_fixture(f"sqlite:///{fixture_path}", args.rows, seed=0, bad_rate=args.bad_rate)
+
+        print(f"{args.rows} rows, mock latency {args.latency:g} ms, pagination {args.pagination}"
+              f"{', bulk' if args.bulk else ''}\n")
+        print(f"{'batch':>6} {'workers':>7} {'tickets':>7} {'secs':>7} {'tickets/s':>9} {'p50 ms':>7} "
+              f"{'p99 ms':>7} {'fetch rows/s':>12} {'peak MB':>8} {'store KB':>8}")
+        results = []
+        for batch_size in (int(value) for value in args.batch_sizes.split(",")):
+            for workers in (int(value) for value in args.workers.split(",")):
+                r = run_case(args, fixture_path, batch_size, workers)
+                results.append(r)
+                print(f"{r['batch_size']:>6} {r['workers']:>7} {r['tickets']:>7} {r['seconds']:>7.2f} "
+                      f"{r['tickets_per_sec']:>9.1f} {r['p50_ms']:>7.1f} {r['p99_ms']:>7.1f} "
+                      f"{r['fetch_rows_per_sec']:>12.0f} {r['peak_mb']:>8.1f} {r['store_kb']:>8.0f}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print("\nThroughput regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print(f"\nNo throughput regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import math
+import os
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+# File header: magic, capacity, bit count, hash count, items added, store size at save time
+HEADER = struct.Struct("<4sQQIQQ")
+MAGIC = b"BLM1"
+
+
+class BloomFilter:
+    """
+    Compact probabilistic set of record digests.
+
+    A miss means the digest is definitely not in the store; a hit only means it
+    probably is, and must be confirmed against the store. Sized for `capacity`
+    items at `error_rate` false positives. Bit positions come from double hashing
+    the digest itself, which is already uniformly distributed, so no extra hashing
+    is done per lookup.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(1, int(capacity))
+        self.capacity = capacity
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        # Size of the backing store when this filter was last saved, used to detect staleness
+        self.store_size = 0
+
+    def _positions(self, digest):
+        num_bits = self.num_bits
+        position = int.from_bytes(digest[:8], "little") % num_bits
+        step = (int.from_bytes(digest[8:16], "little") | 1) % num_bits
+        for _ in range(self.num_hashes):
+            yield position
+            position = (position + step) % num_bits
+
+    def add(self, digest):
+        bits = self.bits
+        for position in self._positions(digest):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, digests):
+        for digest in digests:
+            self.add(digest)
+
+    def __contains__(self, digest):
+        # Inlined probe loop: most lookups are new records and stop at the first clear bit
+        bits = self.bits
+        num_bits = self.num_bits
+        position = int.from_bytes(digest[:8], "little") % num_bits
+        step = (int.from_bytes(digest[8:16], "little") | 1) % num_bits
+        for _ in range(self.num_hashes):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            position = (position + step) % num_bits
+        return True
+
+    def memory_bytes(self):
+        return len(self.bits)
+
+    def save(self, path, store_size):
+        """Write the filter atomically (temp file + rename)."""
+        self.store_size = store_size
+        # Per-process temp file: shards sharing a store may save at the same time
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, self.capacity, self.num_bits, self.num_hashes, self.count, store_size))
+            file.write(self.bits)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved filter, or return None if it is missing or unreadable."""
+        try:
+            with open(path, "rb") as file:
+                magic, capacity, num_bits, num_hashes, count, store_size = HEADER.unpack(file.read(HEADER.size))
+                bits = bytearray(file.read())
+        except (OSError, struct.error) as e:
+            logger.info(f"No usable bloom filter at {path}: {e}")
+            return None
+
+        if magic != MAGIC or len(bits) != (num_bits + 7) // 8:
+            logger.warning(f"Bloom filter at {path} is corrupt; it will be rebuilt")
+            return None
+
+        bloom = cls.__new__(cls)
+        bloom.capacity = capacity
+        bloom.num_bits = num_bits
+        bloom.num_hashes = num_hashes
+        bloom.bits = bits
+        bloom.count = count
+        bloom.store_size = store_size
+        return bloom
@@ -0,0 +1,251 @@
+"""
+Long-running cowjacket daemon.
+
+Keeps the database engine, Jira connection pool, worker threads and dedup store
+open, and runs an incremental pass whenever new phonerequest rows may have
+arrived: on a PostgreSQL NOTIFY from an insert trigger, or every
+DAEMON_POLL_INTERVAL seconds when LISTEN isn't available. SIGTERM/SIGINT stop
+fetching, let in-flight tickets finish, commit their hashes and close the
+store; a second signal exits immediately.
+
+Usage:
+    python daemon.py --install-trigger   # once, PostgreSQL only
+    python daemon.py
+"""
+import argparse
+import os
+import select
+import signal
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from sqlalchemy import text
+from main import (
+    engine, load_processed_records, create_jira_client, bulk_enabled, run_pass, advance_watermark,
+    client_totals, log_totals, watermark_since, dead_letter_rechecks, export_metrics, _older,
+    MAX_WORKERS, TRACK_HOURS, LOG_DIR
+)
+from metrics import profiled
+
+logger = logging.getLogger(__name__)
+
+# Seconds between passes when LISTEN/NOTIFY isn't available
+DAEMON_POLL_INTERVAL = float(os.getenv('DAEMON_POLL_INTERVAL', 5))
+# With LISTEN/NOTIFY, still run a pass at least this often in case a notification is missed
+DAEMON_SAFETY_POLL = float(os.getenv('DAEMON_SAFETY_POLL', 60))
+# Overlap re-read behind the newest row seen on every pass
+DAEMON_OVERLAP_SECONDS = float(os.getenv('DAEMON_OVERLAP_SECONDS', 120))
+# Every this many minutes a wide pass re-reads TRACK_HOURS behind the saved
+# watermark, picking up late rows and retrying failed ones
+DAEMON_WIDE_PASS_MINUTES = float(os.getenv('DAEMON_WIDE_PASS_MINUTES', 15))
+# Channel the insert trigger notifies
+DAEMON_CHANNEL = os.getenv('DAEMON_CHANNEL', 'phonerequest_inserted')
+# Longest wait after a failed pass before trying again
+MAX_ERROR_BACKOFF = 60
+
+TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION notify_{channel}() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{channel}', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS {channel} ON phonerequest;
+CREATE TRIGGER {channel} AFTER INSERT ON phonerequest
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_{channel}();
+"""
+
+
+def install_trigger(channel=DAEMON_CHANNEL):
+    """Create the statement-level insert trigger that notifies `channel` (PostgreSQL 11+)."""
+    with engine.begin() as conn:
+        conn.execute(text(TRIGGER_SQL.format(channel=channel)))
+    logger.info(f"Installed phonerequest insert trigger notifying {channel}")
+
+
+def _as_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime.combine(value, datetime.min.time())
+    return datetime.fromisoformat(str(value))
+
+
+class ChangeListener:
+    """
+    Waits until phonerequest may have new rows. On PostgreSQL it LISTENs on
+    `channel` over its own connection and wakes on NOTIFY (bursts of
+    notifications collapse into one wake-up); otherwise, or while that
+    connection is down, it simply waits `poll_interval` seconds.
+    """
+
+    def __init__(self, channel, stop, poll_interval=DAEMON_POLL_INTERVAL, safety_poll=DAEMON_SAFETY_POLL):
+        self.channel = channel
+        self.stop = stop
+        self.poll_interval = poll_interval
+        self.safety_poll = safety_poll
+        self.raw = None
+        self.connection = None
+        if engine.dialect.name == "postgresql":
+            self._connect()
+        else:
+            logger.info(f"No LISTEN/NOTIFY on {engine.dialect.name}; polling every {poll_interval}s")
+
+    def _connect(self):
+        try:
+            self.raw = engine.raw_connection()
+            self.connection = self.raw.driver_connection
+            self.connection.autocommit = True
+            cursor = self.connection.cursor()
+            cursor.execute(f'LISTEN "{self.channel}"')
+            cursor.close()
+            logger.info(f"Listening for {self.channel} notifications")
+        except Exception as e:
+            logger.warning(f"LISTEN {self.channel} failed ({e}); polling every {self.poll_interval}s")
+            self.close()
+
+    def wait(self):
+        """Block until notified, the safety interval passes or stop is set. Returns True if notified."""
+        if self.connection is None:
+            self.stop.wait(self.poll_interval)
+            if engine.dialect.name == "postgresql" and not self.stop.is_set():
+                self._connect()
+            return False
+
+        deadline = time.monotonic() + self.safety_poll
+        while not self.stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                # Wake at least once a second to notice a shutdown
+                ready, _, _ = select.select([self.connection], [], [], min(1.0, remaining))
+                if ready:
+                    self.connection.poll()
+                    if self.connection.notifies:
+                        self.connection.notifies.clear()
+                        return True
+            except Exception as e:
+                logger.warning(f"Lost the LISTEN connection ({e}); polling until it is back")
+                self.close()
+                return False
+        return False
+
+    def close(self):
+        if self.raw is not None:
+            try:
+                self.raw.close()
+            except Exception:
+                pass
+        self.raw = None
+        self.connection = None
+
+
+def run_daemon():
+    """Run passes until SIGTERM/SIGINT, then flush and close everything."""
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info(f"Received {signal.Signals(signum).name}; finishing in-flight tickets and shutting down")
+        stop.set()
+        # A second signal stops immediately
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    logger.info("=" * 30)
+    logger.info("STARTING JIRA TICKET DAEMON")
+    logger.info("=" * 30)
+
+    store, journal = load_processed_records()
+    client = create_jira_client()
+    bulk = bulk_enabled()
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    listener = ChangeListener(DAEMON_CHANNEL, stop)
+
+    # Newest row committed so far; short passes re-read DAEMON_OVERLAP_SECONDS behind it
+    cursor = _as_datetime(store.get_state('watermark'))
+    # Oldest failed row since the last wide pass, which holds the saved watermark back
+    retry_from = None
+    last_wide_pass = None
+    passes = 0
+    totals = {'success': 0, 'failed': 0, 'skipped': 0, 'rejected': 0, 'new_records': 0}
+    error_backoff = DAEMON_POLL_INTERVAL
+
+    try:
+        while not stop.is_set():
+            wide = last_wide_pass is None or time.monotonic() - last_wide_pass >= DAEMON_WIDE_PASS_MINUTES * 60
+            if wide:
+                since = watermark_since(_older(cursor, retry_from), TRACK_HOURS)
+            else:
+                since = watermark_since(cursor, DAEMON_OVERLAP_SECONDS / 3600)
+
+            try:
+                # Wide passes also re-read dead-lettered rows the fetch window has left behind
+                pass_totals, newest_seen, oldest_failed, pipeline = run_pass(
+                    store, journal, client, executor, bulk, since, keep_going=lambda: not stop.is_set(),
+                    recheck=dead_letter_rechecks(store, since) if wide else ()
+                )
+            except Exception as e:
+                logger.error(f"Pass failed: {e}; retrying in {error_backoff:.0f}s", exc_info=True)
+                stop.wait(error_backoff)
+                error_backoff = min(MAX_ERROR_BACKOFF, error_backoff * 2)
+                continue
+            error_backoff = DAEMON_POLL_INTERVAL
+
+            passes += 1
+            for key in totals:
+                totals[key] += pass_totals[key]
+            if wide:
+                last_wide_pass = time.monotonic()
+                retry_from = _as_datetime(oldest_failed)
+            else:
+                retry_from = _older(retry_from, _as_datetime(oldest_failed))
+
+            newest_seen = _as_datetime(newest_seen)
+            if newest_seen is not None and (cursor is None or newest_seen > cursor):
+                cursor = newest_seen
+                advance_watermark(store, 'watermark', cursor, retry_from)
+
+            if pass_totals['success'] or pass_totals['failed'] or pass_totals['rejected']:
+                logger.info(f"{'Wide pass' if wide else 'Pass'} complete: {pass_totals['success']} successful, "
+                            f"{pass_totals['failed']} failed, {pass_totals['rejected']} rejected")
+                # Refresh the metrics file so a scraper sees the daemon's running totals
+                export_metrics(client_totals(totals, client), store, pipeline)
+
+            if not stop.is_set():
+                listener.wait()
+    finally:
+        logger.info("Shutting down: waiting for in-flight requests and saving state")
+        executor.shutdown(wait=True)
+        listener.close()
+        summary = client_totals(totals, client)
+        client.close()
+        journal.close()
+        store.close()
+        engine.dispose()
+        logger.info("=" * 10)
+        logger.info(f"Daemon stopped after {passes} passes")
+        log_totals(summary)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--install-trigger", action="store_true",
+                        help="create the phonerequest insert trigger for LISTEN/NOTIFY and exit")
+    parser.add_argument("--profile", choices=("cpu", "memory", "all"),
+                        help="profile the daemon until it stops; results go to the log and logs/main.prof")
+    args = parser.parse_args()
+
+    if args.install_trigger:
+        install_trigger()
+    elif args.profile:
+        with profiled(args.profile, LOG_DIR):
+            run_daemon()
+    else:
+        run_daemon()
@@ -0,0 +1,529 @@
+import os
+import pickle
+import sqlite3
+import threading
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from bloom import BloomFilter
+from fingerprint import FINGERPRINT_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# SQLite caps the number of bound parameters per statement
+LOOKUP_CHUNK = 500
+
+# Bloom filter sizing: false-positive rate, and headroom over the current store size
+DEFAULT_BLOOM_ERROR_RATE = 0.001
+BLOOM_GROWTH = 2
+MIN_BLOOM_CAPACITY = 100_000
+
+# Seconds a writer waits for another process to release the database
+BUSY_TIMEOUT = 60
+
+
+class DedupStore:
+    """
+    Persistent set of processed record digests backed by SQLite.
+
+    Digests are stored as raw bytes in a WITHOUT ROWID table keyed on the digest,
+    so membership is an index lookup and nothing is loaded into memory up front.
+    Only new digests are written per batch. A small key/value `state` table holds
+    run metadata such as the last run time and the fetch watermark.
+
+    Rows that failed validation are kept in a `dead_letters` table keyed on a
+    fingerprint of the whole row, with the reasons and the row's createdat, so
+    later runs skip them until the source row changes. A dead letter is cleared
+    once a row with the same record digest is ticketed, or once the row has
+    changed and its new version has been processed.
+
+    Rows whose ticket failed are counted in `failed_tickets` by digest, so the
+    caller can stop retrying a row that keeps failing (see count_failures).
+    A digest's count is cleared once it is ticketed or dead-lettered.
+
+    Several processes (shards) can share one store. Before submitting, a shard
+    claims its digests in the `claims` table; a digest already processed or
+    claimed by another shard is not handed out again, so no ticket is created
+    twice. Claims are dropped when their digests are committed, released when
+    the ticket fails, and left-over claims from a crashed run are released at
+    the next start.
+
+    With `bloom_path` set, a Bloom filter in front of the table answers
+    "definitely new" in memory and only possible hits are looked up in SQLite.
+    The filter is saved on close and rebuilt from the table whenever it is
+    missing, corrupt, out of date with the table, or over capacity. It is saved
+    with the number of table rows it covers (those present when it was loaded
+    plus those this process inserted), so after shards have each added their
+    own digests no single shard's filter passes as up to date.
+    """
+
+    def __init__(self, path, bloom_path=None, bloom_error_rate=DEFAULT_BLOOM_ERROR_RATE):
+        self.path = path
+        self.bloom_path = bloom_path
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom = None
+        # Rows of processed_hashes the Bloom filter is known to hold
+        self.bloom_covers = 0
+        self.bloom_negatives = 0
+        self.store_lookups = 0
+        self.lock = threading.Lock()
+        # Wait for other processes holding the write lock instead of failing
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=BUSY_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # FULL so a committed batch is on disk before the journal is reset
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_hashes (
+                digest BLOB PRIMARY KEY
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                fingerprint BLOB PRIMARY KEY,
+                digest BLOB NOT NULL,
+                reasons TEXT NOT NULL,
+                rejected_at TEXT NOT NULL,
+                createdat TEXT
+            ) WITHOUT ROWID
+        """)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(dead_letters)")}
+        if "createdat" not in columns:
+            # Stores from before dead letters were re-fetched by createdat
+            self.conn.execute("ALTER TABLE dead_letters ADD COLUMN createdat TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS dead_letters_digest ON dead_letters (digest)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS dead_letters_createdat ON dead_letters (createdat)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS failed_tickets (
+                digest BLOB PRIMARY KEY,
+                attempts INTEGER NOT NULL,
+                last_failed_at TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS claims (
+                digest BLOB PRIMARY KEY,
+                owner TEXT NOT NULL,
+                claimed_at TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        self.conn.commit()
+        # Kept in memory so batches skip the dead letter lookup while the table is empty
+        self.dead_letter_count = self.conn.execute("SELECT count(*) FROM dead_letters").fetchone()[0]
+        self.failed_ticket_count = self.conn.execute("SELECT count(*) FROM failed_tickets").fetchone()[0]
+
+        if bloom_path:
+            self._open_bloom()
+
+    def _open_bloom(self):
+        size = len(self)
+        bloom = BloomFilter.load(self.bloom_path)
+        if bloom is None or bloom.store_size != size or size > bloom.capacity:
+            bloom = self.rebuild_bloom()
+        else:
+            logger.info(f"Loaded bloom filter ({bloom.memory_bytes()} bytes, {bloom.num_hashes} hashes)")
+            self.bloom_covers = size
+        self.bloom = bloom
+
+    def rebuild_bloom(self):
+        """Rebuild the Bloom filter from every digest in the table and save it."""
+        with self.lock:
+            size = self.conn.execute("SELECT count(*) FROM processed_hashes").fetchone()[0]
+            bloom = BloomFilter(max(MIN_BLOOM_CAPACITY, size * BLOOM_GROWTH), self.bloom_error_rate)
+            for (digest,) in self.conn.execute("SELECT digest FROM processed_hashes"):
+                bloom.add(digest)
+        bloom.save(self.bloom_path, size)
+        self.bloom = bloom
+        self.bloom_covers = size
+        logger.info(f"Rebuilt bloom filter from {size} records ({bloom.memory_bytes()} bytes)")
+        return bloom
+
+    def __contains__(self, digest):
+        if self.bloom is not None and digest not in self.bloom:
+            self.bloom_negatives += 1
+            return False
+        self.store_lookups += 1
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM processed_hashes WHERE digest = ?", (digest,)
+            ).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT count(*) FROM processed_hashes").fetchone()[0]
+
+    def existing(self, digests):
+        """Return the subset of `digests` already in the store, in as few queries as possible."""
+        digests = list(digests)
+        if self.bloom is not None:
+            candidates = [digest for digest in digests if digest in self.bloom]
+            self.bloom_negatives += len(digests) - len(candidates)
+            digests = candidates
+        self.store_lookups += len(digests)
+        with self.lock:
+            return self._select_in("SELECT digest FROM processed_hashes WHERE digest IN ({})", digests)
+
+    def _select_in(self, query, keys):
+        """
+        Run `query` over `keys` in IN-list chunks and return the first column as
+        a set. The caller holds the lock.
+        """
+        found = set()
+        for start in range(0, len(keys), LOOKUP_CHUNK):
+            chunk = keys[start:start + LOOKUP_CHUNK]
+            rows = self.conn.execute(query.format(",".join("?" * len(chunk))), chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    def dead_letters(self, fingerprints):
+        """Return the subset of row `fingerprints` that were rejected before."""
+        if not self.dead_letter_count:
+            return set()
+        with self.lock:
+            return self._select_in("SELECT fingerprint FROM dead_letters WHERE fingerprint IN ({})",
+                                   list(fingerprints))
+
+    def claim(self, digests, owner):
+        """
+        Claim `digests` for `owner` and return the ones it got: those neither
+        processed nor claimed by anyone else. Check and insert happen in one
+        write transaction, so concurrent shards never get the same digest.
+        """
+        digests = list(digests)
+        claimed_at = datetime.now().isoformat()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                taken = self._select_in("SELECT digest FROM processed_hashes WHERE digest IN ({})", digests)
+                taken |= self._select_in("SELECT digest FROM claims WHERE digest IN ({})", digests)
+                claimed = [digest for digest in digests if digest not in taken]
+                self.conn.executemany(
+                    "INSERT INTO claims (digest, owner, claimed_at) VALUES (?, ?, ?)",
+                    ((digest, owner, claimed_at) for digest in claimed)
+                )
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        return set(claimed)
+
+    def release(self, digests):
+        """Give up claims on digests whose tickets were not created."""
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM claims WHERE digest = ?", ((digest,) for digest in digests))
+
+    def release_stale_claims(self, owner, max_age_hours):
+        """
+        Release claims left by `owner`'s previous run, and anyone's claims older
+        than `max_age_hours` (e.g. from a shard layout no longer in use).
+        Run after the journal has been replayed.
+        """
+        cutoff = (datetime.now() - timedelta(hours=max_age_hours)).isoformat()
+        with self.lock, self.conn:
+            released = self.conn.execute(
+                "DELETE FROM claims WHERE owner = ? OR claimed_at < ?", (owner, cutoff)
+            ).rowcount
+        if released:
+            logger.info(f"Released {released} stale claims")
+        return released
+
+    def add_dead_letters(self, rejects):
+        """Record rejected rows as (fingerprint, digest, reasons, createdat) in a single transaction."""
+        rejected_at = datetime.now().isoformat()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO dead_letters (fingerprint, digest, reasons, rejected_at, createdat) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ((fingerprint, digest, reasons, rejected_at, createdat)
+                 for fingerprint, digest, reasons, createdat in rejects)
+            )
+            self.dead_letter_count = self.conn.execute("SELECT count(*) FROM dead_letters").fetchone()[0]
+            if self.failed_ticket_count:
+                # Once the row is fixed, its tickets get a fresh set of attempts
+                self._clear_failures(digest for _, digest, _, _ in rejects)
+
+    def count_failures(self, digests):
+        """Count one more failed ticket for each of `digests`; returns {digest: failures so far}."""
+        digests = list(digests)
+        failed_at = datetime.now().isoformat()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO failed_tickets (digest, attempts, last_failed_at) VALUES (?, 1, ?) "
+                "ON CONFLICT(digest) DO UPDATE SET attempts = attempts + 1, last_failed_at = excluded.last_failed_at",
+                ((digest, failed_at) for digest in digests)
+            )
+            self.failed_ticket_count = self.conn.execute("SELECT count(*) FROM failed_tickets").fetchone()[0]
+            attempts = {}
+            for start in range(0, len(digests), LOOKUP_CHUNK):
+                chunk = digests[start:start + LOOKUP_CHUNK]
+                attempts.update(self.conn.execute(
+                    f"SELECT digest, attempts FROM failed_tickets WHERE digest IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall())
+        return attempts
+
+    def _clear_failures(self, digests):
+        # The caller holds the lock inside a transaction
+        self.conn.executemany("DELETE FROM failed_tickets WHERE digest = ?", ((digest,) for digest in digests))
+        self.failed_ticket_count = self.conn.execute("SELECT count(*) FROM failed_tickets").fetchone()[0]
+
+    def dead_letter_createdats(self, max_age_days):
+        """Distinct createdat of the dead letters rejected within `max_age_days`, oldest first."""
+        cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat()
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT createdat FROM dead_letters "
+                "WHERE createdat IS NOT NULL AND rejected_at >= ? ORDER BY createdat", (cutoff,)
+            )
+            return [row[0] for row in rows]
+
+    def drop_changed_dead_letters(self, rows):
+        """
+        Delete the dead letters of rows that have changed since they were
+        rejected. `rows` holds (createdat, fingerprint) of every current row
+        created at those createdat values; a dead letter with one of them but
+        none of the fingerprints is out of date. Returns the number deleted.
+        """
+        current = {}
+        for createdat, fingerprint in rows:
+            current.setdefault(createdat, set()).add(fingerprint)
+        with self.lock, self.conn:
+            stale = []
+            for createdat, fingerprints in current.items():
+                for (fingerprint,) in self.conn.execute(
+                        "SELECT fingerprint FROM dead_letters WHERE createdat = ?", (createdat,)):
+                    if fingerprint not in fingerprints:
+                        stale.append((fingerprint,))
+            self.conn.executemany("DELETE FROM dead_letters WHERE fingerprint = ?", stale)
+            self.dead_letter_count = self.conn.execute("SELECT count(*) FROM dead_letters").fetchone()[0]
+        return len(stale)
+
+    def rekey_dead_letters(self, pairs):
+        """Point dead letters recorded under an old digest at its new one, given (old, new) pairs."""
+        with self.lock, self.conn:
+            self.conn.executemany("UPDATE dead_letters SET digest = ? WHERE digest = ?",
+                                  ((new, old) for old, new in pairs))
+
+    def add_many(self, digests):
+        """Insert new digests in a single transaction."""
+        digests = list(digests)
+        with self.lock, self.conn:
+            inserted = self.conn.executemany(
+                "INSERT OR IGNORE INTO processed_hashes (digest) VALUES (?)",
+                ((digest,) for digest in digests)
+            ).rowcount
+            self.conn.executemany("DELETE FROM claims WHERE digest = ?", ((digest,) for digest in digests))
+            if self.dead_letter_count:
+                # Earlier versions of these rows were rejected; they are fixed now
+                self.conn.executemany("DELETE FROM dead_letters WHERE digest = ?", ((digest,) for digest in digests))
+                self.dead_letter_count = self.conn.execute("SELECT count(*) FROM dead_letters").fetchone()[0]
+            if self.failed_ticket_count:
+                self._clear_failures(digests)
+        if self.bloom is not None:
+            self.bloom.update(digests)
+            self.bloom_covers += inserted
+
+    def get_state(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_state(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO state (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+
+    def migrate_pickle(self, pickle_path):
+        """
+        Import hashes and run state from the old pickled set, then rename the
+        pickle out of the way so the import only happens once.
+        """
+        if not os.path.exists(pickle_path):
+            return 0
+
+        with open(pickle_path, 'rb') as file:
+            data = pickle.load(file)
+
+        hashes = data.get('hashes', set())
+        self.add_many(bytes.fromhex(h) if isinstance(h, str) else h for h in hashes)
+        for key in ('last_run', 'watermark'):
+            value = data.get(key)
+            if value is not None:
+                self.set_state(key, value.isoformat() if hasattr(value, 'isoformat') else str(value))
+
+        os.replace(pickle_path, pickle_path + ".migrated")
+        logger.info(f"Migrated {len(hashes)} hashes from {pickle_path} into {self.path}")
+        return len(hashes)
+
+    def close(self):
+        if self.bloom is not None:
+            # Rows other processes added since the load are not in this filter;
+            # saving the count it covers makes the next load rebuild if any were
+            self.bloom.save(self.bloom_path, self.bloom_covers)
+        with self.lock:
+            self.conn.close()
+
+
+# SQL for the record hash in server-side dedup mode (PostgreSQL 11+).
+# Length-prefixed like the local fingerprint (fingerprint.py): each field's
+# length in characters as a big-endian int4 (-1 for NULL), then the text of
+# every field. The two are not byte-compatible (PostgreSQL prints dates and
+# timestamps its own way), so server mode uses this hash for every row it reads.
+SERVER_HASH_SQL = "sha256({} || convert_to(concat({}), 'UTF8'))".format(
+    " || ".join(f"int4send(coalesce(length({field}::text), -1))" for field in FINGERPRINT_FIELDS),
+    ", ".join(f"{field}::text" for field in FINGERPRINT_FIELDS)
+)
+# Recorded in the store's state once processed_hashes holds SERVER_HASH_SQL hashes
+SERVER_HASH_VERSION = "sha256-length-prefixed"
+# The previous server hash, fields joined with '|', kept to re-key old tables
+LEGACY_SERVER_HASH_SQL = """sha256(convert_to(concat_ws('|',
+    coalesce(newusername::text, ''), coalesce(emailaddress::text, ''),
+    coalesce(phonenumber::text, ''), coalesce(createdat::text, ''),
+    coalesce(dateneededby::text, ''), coalesce(telephonelinesandinstallations::text, ''),
+    coalesce(handsetsandheadsets::text, '')), 'UTF8'))"""
+
+
+class ServerDedupStore:
+    """
+    Dedup store that also keeps processed hashes in a `processed_hashes` table
+    next to `phonerequest`, so fetches can anti-join against it and only
+    unprocessed rows leave the database.
+
+    Wraps the local DedupStore, which still provides run state, the Bloom filter
+    and crash recovery through the journal; every add is written to the server
+    table first and then locally.
+
+    Shards on several machines claim digests in a server-side `ticket_claims`
+    table. Claims of committed digests are kept rather than deleted, so a claim
+    can never be taken again while its commit is still in flight elsewhere.
+    """
+
+    def __init__(self, local_store, engine):
+        self.local_store = local_store
+        self.engine = engine
+        with self.engine.begin() as conn:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS processed_hashes (
+                    record_hash BYTEA PRIMARY KEY,
+                    processed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """))
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS ticket_claims (
+                    record_hash BYTEA PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    claimed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """))
+
+    def __getattr__(self, name):
+        # Run state, counters and lookups come from the local store
+        return getattr(self.local_store, name)
+
+    def __contains__(self, digest):
+        return digest in self.local_store
+
+    def __len__(self):
+        return len(self.local_store)
+
+    def server_count(self):
+        with self.engine.connect() as conn:
+            return conn.execute(text("SELECT count(*) FROM processed_hashes")).scalar()
+
+    def add_many(self, digests):
+        """Record digests on the server, then locally."""
+        digests = list(digests)
+        if digests:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text("INSERT INTO processed_hashes (record_hash) VALUES (:record_hash) "
+                         "ON CONFLICT (record_hash) DO NOTHING"),
+                    [{"record_hash": digest} for digest in digests]
+                )
+        self.local_store.add_many(digests)
+
+    def claim(self, digests, owner):
+        """Claim `digests` on the server; returns those not processed or claimed elsewhere."""
+        digests = list(digests)
+        if not digests:
+            return set()
+        with self.engine.begin() as conn:
+            rows = conn.execute(text("""
+                INSERT INTO ticket_claims (record_hash, owner)
+                SELECT d, :owner FROM unnest(CAST(:digests AS BYTEA[])) AS d
+                WHERE NOT EXISTS (SELECT 1 FROM processed_hashes ph WHERE ph.record_hash = d)
+                ON CONFLICT (record_hash) DO NOTHING
+                RETURNING record_hash
+            """), {"digests": digests, "owner": owner})
+            return {bytes(row.record_hash) for row in rows}
+
+    def release(self, digests):
+        """Give up server claims on digests whose tickets were not created."""
+        digests = list(digests)
+        if digests:
+            with self.engine.begin() as conn:
+                conn.execute(text("""
+                    DELETE FROM ticket_claims WHERE record_hash = ANY(CAST(:digests AS BYTEA[]))
+                    AND NOT EXISTS (SELECT 1 FROM processed_hashes ph WHERE ph.record_hash = ticket_claims.record_hash)
+                """), {"digests": digests})
+
+    def release_stale_claims(self, owner, max_age_hours):
+        """Release unprocessed server claims left by `owner`, or older than `max_age_hours`."""
+        with self.engine.begin() as conn:
+            released = conn.execute(text("""
+                DELETE FROM ticket_claims
+                WHERE (owner = :owner OR claimed_at < now() - make_interval(secs => :max_age))
+                AND NOT EXISTS (SELECT 1 FROM processed_hashes ph WHERE ph.record_hash = ticket_claims.record_hash)
+            """), {"owner": owner, "max_age": max_age_hours * 3600}).rowcount
+        if released:
+            logger.info(f"Released {released} stale server claims")
+        return released
+
+    def backfill(self, local_hash):
+        """
+        Seed `processed_hashes` from a local store built with a different hash.
+
+        Scans phonerequest once, recomputes each row's local hash with `local_hash`
+        and records the server hash of every row the local store already has, so
+        switching to server mode does not re-ticket old requests.
+        """
+        seeded = 0
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=LOOKUP_CHUNK).execute(
+                text(f"SELECT *, {SERVER_HASH_SQL} AS record_hash FROM phonerequest")
+            )
+            for rows in result.partitions():
+                local = {local_hash(row): bytes(row.record_hash) for row in rows}
+                server_hashes = [local[digest] for digest in self.local_store.existing(local)]
+                if server_hashes:
+                    self.add_many(server_hashes)
+                    seeded += len(server_hashes)
+        logger.info(f"Seeded processed_hashes with {seeded} records from the local store")
+        return seeded
+
+    def rekey(self, old_hash_sql=LEGACY_SERVER_HASH_SQL):
+        """
+        Add the SERVER_HASH_SQL hash of every phonerequest row whose `old_hash_sql`
+        hash is in `processed_hashes`, on the server and locally, so a change of
+        server hash does not re-ticket old requests. Old hashes are left in place,
+        so an interrupted re-key simply runs again.
+        """
+        rekeyed = 0
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=LOOKUP_CHUNK).execute(text(f"""
+                SELECT {SERVER_HASH_SQL} AS record_hash FROM phonerequest
+                WHERE EXISTS (SELECT 1 FROM processed_hashes ph WHERE ph.record_hash = {old_hash_sql})
+            """))
+            for rows in result.partitions():
+                self.add_many(bytes(row.record_hash) for row in rows)
+                rekeyed += len(rows)
+        logger.info(f"Re-keyed {rekeyed} processed_hashes records to {SERVER_HASH_VERSION}")
+        return rekeyed
@@ -0,0 +1,50 @@
+import hashlib
+import struct
+from operator import attrgetter
+
+# Fields that identify a request; two rows with the same values are the same request
+FINGERPRINT_FIELDS = (
+    "newusername",
+    "emailaddress",
+    "phonenumber",
+    "createdat",
+    "dateneededby",
+    "telephonelinesandinstallations",
+    "handsetsandheadsets"
+)
+# Recorded in the dedup store's state once its digests use this scheme
+FINGERPRINT_VERSION = "sha256-length-prefixed"
+
+_get_fields = attrgetter(*FINGERPRINT_FIELDS)
+_pack_lengths = struct.Struct(f"<{len(FINGERPRINT_FIELDS)}i").pack
+
+
+def encode_fields(values):
+    """
+    Length-prefixed encoding of field values: each field's length in characters
+    as a little-endian int32 (-1 for a missing value), followed by the UTF-8 text
+    of every field. Unlike joining on a separator, no field value can shift
+    into its neighbour, so different rows can't encode the same.
+    """
+    texts = ["" if value is None else str(value) for value in values]
+    lengths = [-1 if value is None else len(text) for value, text in zip(values, texts)]
+    return _pack_lengths(*lengths) + "".join(texts).encode("utf-8", "surrogatepass")
+
+
+def fingerprint(row):
+    """SHA-256 of the length-prefixed FINGERPRINT_FIELDS of a phonerequest row, as raw bytes."""
+    values = _get_fields(row)
+    if None in values:
+        return hashlib.sha256(encode_fields(values)).digest()
+    # Same bytes as encode_fields, built in one f-string for the usual row with every field set
+    a, b, c, d, e, f, g = map(str, values)
+    return hashlib.sha256(
+        _pack_lengths(len(a), len(b), len(c), len(d), len(e), len(f), len(g))
+        + f"{a}{b}{c}{d}{e}{f}{g}".encode("utf-8", "surrogatepass")
+    ).digest()
+
+
+def legacy_fingerprint(row):
+    """The previous record hash: SHA-256 of the fields joined with '|'. Used to migrate old stores."""
+    hash_string = f"{row.newusername}|{row.emailaddress}|{row.phonenumber}|{row.createdat}|{row.dateneededby}|{row.telephonelinesandinstallations}|{row.handsetsandheadsets}"
+    return hashlib.sha256(hash_string.encode()).digest()
@@ -0,0 +1,126 @@
+"""
+Generate a seeded `phonerequest` table for local runs and benchmarks.
+
+Works with any SQLAlchemy URL (SQLite or PostgreSQL). The same seed always
+produces the same rows. A fraction of rows can be made invalid (unknown
+choices, missing fields) or exact duplicates, to exercise validation and dedup.
+
+Usage:
+    python fixtures.py --url sqlite:///bench.db --rows 10000 --seed 1 --bad-rate 0.01
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, text
+from payload import DEFAULT_FORM_SCHEMA, TEMPORARY_USE
+
+FIRST_NAMES = ("Sara", "John", "Amina", "Luis", "Mei", "Tom", "Ngozi", "Ivan", "Priya", "Ola")
+LAST_NAMES = ("Curtis", "Okafor", "Smith", "Garcia", "Chen", "Brown", "Adeyemi", "Petrov", "Patel", "Hansen")
+DEPARTMENTS = ("Finance", "HR", "IT", "Sales", "Legal", "Operations")
+JOBS = ("Data Engineer", "Analyst", "Manager", "Accountant", "Recruiter", "Engineer")
+
+COLUMNS = ("newusername", "samplename", "phonenumber", "departmentname", "job", "emailaddress", "costcenter",
+           "telephonelinesandinstallations", "handsetsandheadsets", "timeframe", "dateneededby",
+           "approximateendingdate", "Comments", "createdat")
+
+CREATE_TABLE = """
+    CREATE TABLE phonerequest (
+        newusername TEXT,
+        samplename TEXT,
+        phonenumber TEXT,
+        departmentname TEXT,
+        job TEXT,
+        emailaddress TEXT,
+        costcenter TEXT,
+        telephonelinesandinstallations TEXT,
+        handsetsandheadsets TEXT,
+        timeframe TEXT,
+        dateneededby DATE,
+        approximateendingdate DATE,
+        "Comments" TEXT,
+        createdat TIMESTAMP
+    )
+"""
+
+INSERT = text(f"""
+    INSERT INTO phonerequest ({", ".join(f'"{column}"' for column in COLUMNS)})
+    VALUES ({", ".join(f":p{i}" for i in range(len(COLUMNS)))})
+""")
+
+
+def _choices(column):
+    for field in DEFAULT_FORM_SCHEMA["answers"]:
+        if field["column"] == column:
+            return list(field["choices"])
+    raise KeyError(column)
+
+
+def generate_rows(count, seed=0, bad_rate=0.0, duplicate_rate=0.0, start=datetime(2025, 10, 1)):
+    """Yield `count` phonerequest rows as tuples in COLUMNS order, oldest first."""
+    rng = random.Random(seed)
+    installations = _choices("telephonelinesandinstallations")
+    equipment = _choices("handsetsandheadsets")
+    previous = None
+
+    for i in range(count):
+        if previous and rng.random() < duplicate_rate:
+            yield previous
+            continue
+
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        created = start + timedelta(seconds=i * 30 + rng.randrange(30))
+        timeframe = rng.choice((TEMPORARY_USE, "Permanent use"))
+        needed = (created + timedelta(days=rng.randint(1, 14))).date()
+        row = [
+            f"{first} {last} {i}", first, f"08{rng.randrange(10**9):09d}", rng.choice(DEPARTMENTS),
+            rng.choice(JOBS), f"{first.lower()}.{last.lower()}{i}@example.com", f"{rng.randrange(10**10):010d}",
+            rng.choice(installations), "; ".join(rng.sample(equipment, rng.randint(1, 3))), timeframe,
+            needed.isoformat(),
+            (needed + timedelta(days=rng.randint(30, 90))).isoformat() if timeframe == TEMPORARY_USE else None,
+            rng.choice(("Replace faulty handset", "New starter", "", None)),
+            created.isoformat(sep=" ")
+        ]
+        if rng.random() < bad_rate:
+            # Break one thing validation checks for
+            broken = rng.choice(("timeframe", "emailaddress", "dateneededby"))
+            row[COLUMNS.index(broken)] = {"timeframe": "Soon", "emailaddress": None, "dateneededby": None}[broken]
+        previous = tuple(row)
+        yield previous
+
+
+def write_fixture(url, count, seed=0, bad_rate=0.0, duplicate_rate=0.0, batch_size=5000):
+    """(Re)create `phonerequest` at `url` and fill it with generated rows."""
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS phonerequest"))
+        conn.execute(text(CREATE_TABLE))
+        # Matches the fetch ordering and keyset pagination key
+        conn.execute(text("CREATE INDEX phonerequest_createdat_email ON phonerequest (createdat, emailaddress)"))
+
+        batch = []
+        for row in generate_rows(count, seed, bad_rate, duplicate_rate):
+            batch.append({f"p{i}": value for i, value in enumerate(row)})
+            if len(batch) >= batch_size:
+                conn.execute(INSERT, batch)
+                batch = []
+        if batch:
+            conn.execute(INSERT, batch)
+    engine.dispose()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="sqlite:///phonerequest.db", help="SQLAlchemy database URL")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bad-rate", type=float, default=0.0, help="fraction of rows that fail validation")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="fraction of rows repeating the previous one")
+    args = parser.parse_args()
+
+    write_fixture(args.url, args.rows, args.seed, args.bad_rate, args.duplicate_rate)
+    print(f"Wrote {args.rows} phonerequest rows to {args.url}")
+
+
+if __name__ == "__main__":
+    main()
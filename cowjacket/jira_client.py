@@ -0,0 +1,289 @@
+import json
+import logging
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+# Default HTTP settings for the Jira connection pool
+DEFAULT_POOL_SIZE = 8
+DEFAULT_TIMEOUT = 30
+DEFAULT_KEEPALIVE_IDLE = 60  # seconds before the first TCP keep-alive probe
+
+# Retry settings for 429/503 responses and connection failures
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_BUDGET = 500  # total retries allowed per run across all tickets
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_CAP = 30.0
+# Sent back without acting on the request (besides 429), so sending it again is safe
+RETRYABLE_STATUS = {503}
+# The request may have been carried out before the error, so a retry could
+# create the issue twice
+UNCERTAIN_STATUS = {500, 502, 504}
+
+# Jira creates at most 50 issues per bulk call
+MAX_BULK_SIZE = 50
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (delta-seconds or HTTP date) into seconds."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def request_not_sent(error):
+    """True if a requests exception means no connection to Jira was opened, so nothing was sent."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def parse_bulk_response(response, count):
+    """
+    Map a bulk create response back onto the `count` submitted items.
+
+    Returns one (issue_key, error) per item in submission order. Jira lists the
+    created issues in order and reports each failed item by its index
+    (`failedElementNumber`), so the remaining items take the issues in turn.
+    """
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    failures = {}
+    for failure in body.get('errors') or []:
+        element_errors = failure.get('elementErrors') or {}
+        messages = list(element_errors.get('errorMessages') or []) + [
+            f"{field}: {message}" for field, message in (element_errors.get('errors') or {}).items()
+        ]
+        failures[failure.get('failedElementNumber')] = "; ".join(messages) or f"Status {failure.get('status')}"
+
+    if response.status_code not in (200, 201) and not failures:
+        error = f"Status {response.status_code} - {response.text}"
+        return [(None, error)] * count
+
+    issues = iter(body.get('issues') or [])
+    results = []
+    for index in range(count):
+        if index in failures:
+            results.append((None, failures[index]))
+            continue
+        issue = next(issues, None)
+        if issue is None:
+            results.append((None, "Missing from bulk response"))
+        else:
+            results.append((issue['key'], None))
+    return results
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter that enables TCP keep-alive probes on pooled connections,
+    so idle connections between batches are not silently dropped by proxies.
+    """
+
+    def __init__(self, keepalive_idle=DEFAULT_KEEPALIVE_IDLE, **kwargs):
+        self.keepalive_idle = keepalive_idle
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        socket_options = list(HTTPConnection.default_socket_options)
+        socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        # TCP_KEEPIDLE is not available on every platform (e.g. macOS)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive_idle))
+        kwargs["socket_options"] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+class JiraClient:
+    """
+    Jira Service Management client that owns a pooled, keep-alive HTTP session.
+
+    One client is created per run and shared by all worker threads, so each
+    ticket reuses an open TCP/TLS connection instead of handshaking again.
+    Requests go through an optional AdaptiveThrottler; 429s honour Retry-After,
+    and 503s and failures to connect are retried with jittered exponential
+    backoff until the per-request attempts or the per-run retry budget run out.
+    Creating an issue is not idempotent, so anything after which Jira may have
+    created it (a read timeout, a dropped connection, 500/502/504) is not
+    retried: it is logged as a possible duplicate, counted as `uncertain`,
+    and returned or raised to the caller.
+    With `metrics` (a Metrics registry) every attempt's latency is observed as
+    jira_request_seconds, labelled by status code ("error" for timeouts and
+    connection errors).
+    """
+
+    def __init__(self, base_url, email, api_token, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, keepalive_idle=DEFAULT_KEEPALIVE_IDLE,
+                 throttler=None, max_retries=DEFAULT_MAX_RETRIES, retry_budget=DEFAULT_RETRY_BUDGET,
+                 backoff_base=DEFAULT_BACKOFF_BASE, backoff_cap=DEFAULT_BACKOFF_CAP, metrics=None):
+        self.base_url = base_url.rstrip("/") if base_url else base_url
+        self.timeout = timeout
+        self.throttler = throttler
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.metrics = metrics
+
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'rate_limited': 0,
+            'uncertain': 0,
+            'backoff_seconds': 0.0,
+            'retry_budget_exhausted': 0
+        }
+
+        self.session = requests.Session()
+        self.session.auth = (email, api_token)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Connection": "keep-alive"
+        })
+
+        # pool_block keeps the number of open connections at pool_size when
+        # more threads than connections are submitting
+        adapter = KeepAliveAdapter(
+            keepalive_idle=keepalive_idle,
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=True
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        logger.info(f"Jira client ready (pool size {pool_size}, timeout {timeout}s)")
+
+    def create_request(self, ticket_issue):
+        """Create a service desk request from a payload dict or pre-encoded bytes
+        and return the final HTTP response."""
+        url = f"{self.base_url}/rest/servicedeskapi/request"
+        data = ticket_issue if isinstance(ticket_issue, bytes) else json.dumps(ticket_issue)
+        return self._post(url, data)
+
+    def create_issues_bulk(self, issue_updates):
+        """
+        Create up to MAX_BULK_SIZE issues in one call from pre-encoded
+        `{"fields": ...}` documents. Returns (response, results) with one
+        (issue_key, error) per document, in order.
+        """
+        url = f"{self.base_url}/rest/api/2/issue/bulk"
+        data = b'{"issueUpdates":[' + b",".join(issue_updates) + b']}'
+        response = self._post(url, data)
+        return response, parse_bulk_response(response, len(issue_updates))
+
+    def _post(self, url, data):
+        """POST with throttling and retries; raises the last error if retries run out."""
+        attempt = 0
+        while True:
+            if self.throttler:
+                self.throttler.acquire()
+            self._count('requests')
+
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                response = self.session.post(url, data=data, timeout=self.timeout)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                self._observe(start, "error")
+                if not request_not_sent(e):
+                    self._uncertain(url, e)
+                    raise
+                if not self._take_retry(attempt):
+                    raise
+                logger.warning(f"Jira request error ({e}); retrying (attempt {attempt + 1}/{self.max_retries})")
+            else:
+                self._observe(start, response.status_code)
+                if response.status_code == 429:
+                    self._count('rate_limited')
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    if self.throttler:
+                        self.throttler.on_throttle(retry_after)
+                elif response.status_code in UNCERTAIN_STATUS:
+                    self._uncertain(url, f"status {response.status_code}")
+                    return response
+                elif response.status_code not in RETRYABLE_STATUS:
+                    if self.throttler and response.status_code < 400:
+                        self.throttler.on_success()
+                    return response
+
+                if not self._take_retry(attempt):
+                    return response
+                logger.warning(f"Jira returned {response.status_code}; retrying (attempt {attempt + 1}/{self.max_retries})")
+
+            # The throttler already holds everyone back for Retry-After
+            if retry_after is None or not self.throttler:
+                self._backoff(attempt, retry_after)
+            attempt += 1
+
+    def _uncertain(self, url, error):
+        self._count('uncertain')
+        logger.error(f"POSSIBLE DUPLICATE: Jira may have created the issue(s) before {url} failed ({error}); "
+                     f"not retried. Check Jira before the record is retried by a later run")
+
+    def _take_retry(self, attempt):
+        """Spend one retry from the per-request attempts and the per-run budget."""
+        if attempt >= self.max_retries:
+            return False
+        with self.stats_lock:
+            if self.retry_budget is not None and self.stats['retries'] >= self.retry_budget:
+                self.stats['retry_budget_exhausted'] += 1
+                return False
+            self.stats['retries'] += 1
+        return True
+
+    def _backoff(self, attempt, retry_after=None):
+        """Sleep with full-jitter exponential backoff, or for Retry-After if given."""
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+        self._count('backoff_seconds', delay)
+        time.sleep(delay)
+
+    def _observe(self, start, status):
+        if self.metrics is not None:
+            self.metrics.observe('jira_request_seconds', time.perf_counter() - start, status=status)
+
+    def _count(self, key, amount=1):
+        with self.stats_lock:
+            self.stats[key] += amount
+
+    def summary(self):
+        """Counters for the end-of-run report. Throttle wait is summed across worker threads."""
+        with self.stats_lock:
+            summary = dict(self.stats)
+        if self.throttler:
+            summary['throttle_wait_seconds'] = self.throttler.throttle_wait
+            summary['current_rate'] = self.throttler.rate
+        return summary
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
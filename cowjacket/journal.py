@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Group-commit settings: fsync after this many records or this many seconds
+DEFAULT_SYNC_EVERY = 32
+DEFAULT_SYNC_INTERVAL = 1.0
+
+
+class HashJournal:
+    """
+    Append-only write-ahead journal of confirmed record hashes.
+
+    Each hash is written (length byte + digest) as soon as its ticket is confirmed,
+    so it reaches the OS even if the process dies mid-batch. fsync is group-committed
+    every `sync_every` records or `sync_interval` seconds to keep the hot path cheap.
+    On startup the journal is replayed into the dedup store; after each batch is
+    committed to the store the journal is reset by atomically renaming a new
+    file over it, holding only hashes recorded since that batch (e.g. by the
+    next batch already in flight). A torn final record from a crash during a
+    write is ignored.
+    """
+
+    def __init__(self, path, sync_every=DEFAULT_SYNC_EVERY, sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        # Hashes recorded since the last reset, so a reset can keep uncommitted ones
+        self.recorded = set()
+        self.file = open(path, 'ab', buffering=0)
+
+    def read(self):
+        """Return every complete hash recorded in the journal."""
+        with open(self.path, 'rb') as file:
+            data = file.read()
+
+        digests = []
+        position = 0
+        while position < len(data):
+            length = data[position]
+            end = position + 1 + length
+            if length == 0 or end > len(data):
+                logger.warning(f"Ignoring torn record at byte {position} of {self.path}")
+                break
+            digests.append(data[position + 1:end])
+            position = end
+        return digests
+
+    def replay(self, store):
+        """Commit hashes left over from an interrupted run into `store`, then reset."""
+        digests = self.read()
+        if digests:
+            store.add_many(digests)
+            logger.info(f"Recovered {len(digests)} processed records from {self.path}")
+        self.reset()
+        return len(digests)
+
+    def record(self, digest):
+        """Durably append one confirmed hash."""
+        with self.lock:
+            self.file.write(bytes([len(digest)]) + digest)
+            self.recorded.add(digest)
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self._sync()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self.unsynced:
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def reset(self, committed=None):
+        """
+        Atomically replace the journal once its hashes are in the store. With
+        `committed`, only those hashes are dropped and any others recorded
+        since the last reset are carried over.
+        """
+        with self.lock:
+            keep = [] if committed is None else [d for d in self.recorded if d not in committed]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'wb') as tmp:
+                tmp.write(b"".join(bytes([len(digest)]) + digest for digest in keep))
+                os.fsync(tmp.fileno())
+            os.replace(tmp_path, self.path)
+            _fsync_dir(os.path.dirname(self.path))
+
+            self.file.close()
+            self.file = open(self.path, 'ab', buffering=0)
+            self.recorded = set(keep)
+            self.unsynced = 0
+            self.last_sync = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.file.close()
+
+
+def _fsync_dir(directory):
+    """Flush a directory entry so a rename survives power loss (no-op where unsupported)."""
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
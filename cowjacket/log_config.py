@@ -0,0 +1,304 @@
+"""
+Non-blocking logging setup.
+
+Log calls only put the record on an in-memory queue; a listener thread formats
+it and writes it to a buffered, size-rotated file, flushing whenever it has
+caught up with the queue. Lines are plain text or, with LOG_FORMAT=json, one
+JSON object per line.
+
+Repeated warnings and errors are rate limited: after LOG_REPEAT_LIMIT of
+the same message from the same log call in LOG_REPEAT_WINDOW seconds the
+rest are counted instead of written, and the count is added to the next one
+let through. Different messages from one call (a failure per record) are
+never held back by each other. If
+the queue is ever full, records are dropped and counted rather than making
+the caller wait.
+"""
+import atexit
+import json
+import logging
+import multiprocessing.util
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from dotenv import load_dotenv
+
+# Imported before the scripts load .env themselves
+load_dotenv()
+
+# "text" for the usual lines, "json" for JSON lines
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+# Rotate the log file at this size, keeping LOG_BACKUP_COUNT old files (.1 the newest)
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+# Records waiting to be written before new ones are dropped
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 100_000))
+# Repeats of one warning/error let through per window; 0 disables rate limiting
+LOG_REPEAT_LIMIT = int(os.getenv('LOG_REPEAT_LIMIT', 20))
+LOG_REPEAT_WINDOW = float(os.getenv('LOG_REPEAT_WINDOW', 60))
+# Write buffer of the log file
+LOG_BUFFER_BYTES = 64 * 1024
+# Distinct messages tracked for rate limiting; past this the least recently seen is forgotten
+REPEAT_TRACKED = 10_000
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, process, thread, message and any traceback."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that writes through a large buffer and leaves flushing
+    to its caller. The file size is tracked as lines are written instead of
+    seeking to the end before every record, which would flush the buffer.
+    """
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+        self.size = 0
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+
+    def _open(self):
+        stream = open(self.baseFilename, self.mode, encoding=self.encoding, errors=self.errors,
+                      buffering=LOG_BUFFER_BYTES)
+        self.size = os.fstat(stream.fileno()).st_size
+        return stream
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + self.terminator
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes and self.size and self.size + len(line) >= self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(line)
+            self.size += len(line)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class RepeatFilter(logging.Filter):
+    """
+    Lets through the first `limit` repeats of each warning and error per
+    `window` seconds and counts the rest. A repeat is a record from the same
+    log call (source file and line) with the same message, or template for
+    %-style calls, and exception type. The count is appended to the first
+    record let through in the next window. At most `tracked` messages are
+    remembered, least recently seen dropped first, so a flood of distinct
+    messages costs constant time per record.
+    """
+
+    def __init__(self, limit=LOG_REPEAT_LIMIT, window=LOG_REPEAT_WINDOW, tracked=REPEAT_TRACKED):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.tracked = tracked
+        self.lock = threading.Lock()
+        # (pathname, lineno, message, exception type) -> [window start, records let through,
+        # records suppressed, first message], least recently seen first
+        self.calls = OrderedDict()
+        self.suppressed = 0
+        # Suppressed records of forgotten messages, not yet reported
+        self.forgotten = 0
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or not self.limit:
+            return True
+        key = (record.pathname, record.lineno, str(record.msg), record.exc_info and record.exc_info[0])
+        now = time.monotonic()
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.calls.move_to_end(key)
+            elif len(self.calls) >= self.tracked:
+                self.forgotten += self.calls.popitem(last=False)[1][2]
+            if call is None or now - call[0] >= self.window:
+                suppressed = call[2] if call else 0
+                self.calls[key] = [now, 1, 0, None]
+            elif call[1] < self.limit:
+                call[1] += 1
+                return True
+            else:
+                if not call[2]:
+                    call[3] = record.getMessage()
+                call[2] += 1
+                self.suppressed += 1
+                return False
+        if suppressed:
+            record.msg = f"{record.getMessage()} [{suppressed} more like this suppressed in the last {self.window:g}s]"
+            record.args = None
+        return True
+
+    def pending(self):
+        """(count, first suppressed message) for log calls with suppressed records not yet reported."""
+        with self.lock:
+            pending = [(call[2], call[3]) for call in self.calls.values() if call[2]]
+            if self.forgotten:
+                pending.append((self.forgotten, "messages no longer tracked"))
+            return pending
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    QueueHandler that never blocks: when the queue is full the record is
+    dropped and counted. With `forward` set the queue crosses processes, so
+    tracebacks are rendered to text before the record is queued; otherwise
+    that is left to the listener thread.
+    """
+
+    def __init__(self, log_queue, forward=False):
+        super().__init__(log_queue)
+        self.forward = forward
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Render the message now; its arguments may change after the call returns
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if self.forward:
+            if record.exc_info and not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class FlushingQueueListener(QueueListener):
+    """QueueListener that flushes its handlers whenever the queue runs empty."""
+
+    def dequeue(self, block):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush()
+            return self.queue.get(block)
+
+
+_handler = None
+_listener = None
+_file_handler = None
+_repeat_filter = None
+
+
+def _formatter(log_format=LOG_FORMAT):
+    return JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+
+
+def setup_logging(path, level=logging.INFO, log_format=LOG_FORMAT):
+    """
+    Send the root logger's records through a queue to a rotating file at
+    `path`. Calling it again changes nothing. The listener is stopped, and
+    the file flushed, at interpreter exit.
+    """
+    global _handler, _listener, _file_handler, _repeat_filter
+    if _listener is not None:
+        return _listener
+
+    _file_handler = BufferedRotatingFileHandler(path)
+    _file_handler.setFormatter(_formatter(log_format))
+    _repeat_filter = RepeatFilter()
+    _handler = AsyncQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _handler.addFilter(_repeat_filter)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(level)
+
+    _listener = FlushingQueueListener(_handler.queue, _file_handler)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def listen(log_queue):
+    """
+    Write records other processes forward through `log_queue` (see
+    forward_logging) to this process's log file. Stop the returned listener
+    once they have exited.
+    """
+    listener = FlushingQueueListener(log_queue, _file_handler)
+    listener.start()
+    return listener
+
+
+def forward_logging(log_queue):
+    """
+    Send this process's records to the parent's `log_queue` (a
+    multiprocessing queue) instead of writing the file, so only one process
+    writes and rotates it. Use as a multiprocessing.Pool initializer.
+    """
+    global _handler, _repeat_filter
+    stop_logging()
+    _repeat_filter = RepeatFilter()
+    _handler = AsyncQueueHandler(log_queue, forward=True)
+    _handler.addFilter(_repeat_filter)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    # Pool workers exit without running atexit. Finalizers run highest priority
+    # first, and the queue closes its feeder thread at priority 10, so this
+    # report still reaches the parent
+    multiprocessing.util.Finalize(None, _report_losses, exitpriority=100)
+
+
+def log_stats():
+    """Records suppressed by rate limiting and dropped because the queue was full."""
+    return {
+        'suppressed': _repeat_filter.suppressed if _repeat_filter else 0,
+        'dropped': _handler.dropped if _handler else 0
+    }
+
+
+def _report_losses():
+    logger = logging.getLogger(__name__)
+    if _repeat_filter is not None:
+        for count, message in _repeat_filter.pending():
+            logger.info(f"Suppressed {count} repeats of: {message}")
+    if _handler is not None and _handler.dropped:
+        logger.warning(f"Dropped {_handler.dropped} log records because the log queue was full")
+
+
+def stop_logging():
+    """Write out every queued record, report anything suppressed or dropped, and close the file."""
+    global _listener
+    if _listener is None:
+        return
+    _report_losses()
+    _listener.stop()
+    _listener = None
+    _file_handler.close()
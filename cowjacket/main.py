@@ -1,13 +1,26 @@
 import os
+import zlib
+import argparse
+import multiprocessing
 import requests
-import json
 import logging
-import hashlib
-import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from dedup_store import DedupStore, ServerDedupStore, SERVER_HASH_SQL, SERVER_HASH_VERSION
+from fingerprint import fingerprint, legacy_fingerprint, FINGERPRINT_VERSION
+from jira_client import JiraClient, MAX_BULK_SIZE
+from journal import HashJournal
+from log_config import setup_logging, listen, forward_logging, log_stats, LOG_QUEUE_SIZE
+from metrics import Metrics, profiled
+from payload import PayloadCompiler, load_form_schema
+from pipeline import Pipeline
+from throttle import AdaptiveThrottler
+from validation import BatchValidator, row_fingerprint, PAGE_KEY_COLUMN
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from datetime import datetime, date, timedelta
 
 load_dotenv()
 
@@ -19,16 +32,28 @@ os.makedirs(LOG_DIR, exist_ok=True)
 
 # Set directory path for tracking processed records
 RECORD_DIR = "processed_records"
-RECORD_FILE = "processed_records.pkl"
+RECORD_FILE = "processed_records.db"
 RECORD_PATH = os.path.join(RECORD_DIR, RECORD_FILE)
+# Pickled hash set used before the SQLite store, imported on first run
+LEGACY_RECORD_PATH = os.path.join(RECORD_DIR, "processed_records.pkl")
+# Bloom filter answering "definitely new" before the store is queried. Off by
+# default: most fetched rows are already processed, and for those the filter
+# only adds work before the store lookup
+BLOOM_PATH = os.path.join(RECORD_DIR, "processed_records.bloom")
+BLOOM_ERROR_RATE = float(os.getenv('BLOOM_ERROR_RATE', 0.001))
+USE_BLOOM_FILTER = os.getenv('USE_BLOOM_FILTER', 'false').lower() == 'true'
+# Write-ahead journal of hashes confirmed since the last batch commit
+JOURNAL_PATH = os.path.join(RECORD_DIR, "processed_records.journal")
+JOURNAL_SYNC_EVERY = int(os.getenv('JOURNAL_SYNC_EVERY', 32))
+JOURNAL_SYNC_INTERVAL = float(os.getenv('JOURNAL_SYNC_INTERVAL', 1.0))
 os.makedirs(RECORD_DIR, exist_ok=True)
 
-#logging config
-logging.basicConfig(
-    filename=LOG_PATH,
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Run metrics written at the end of each run: Prometheus text format if the
+# path ends in .prom (e.g. node_exporter's textfile directory), JSON otherwise
+METRICS_FILE = os.getenv('METRICS_FILE', os.path.join(LOG_DIR, "metrics.json"))
+
+#logging config: queued and written by a background thread (log_config.py)
+setup_logging(LOG_PATH)
 logger = logging.getLogger(__name__)
 
 # Jira Configuration
@@ -38,12 +63,29 @@ API_TOKEN = os.getenv('JIRA_API_TOKEN')
 SERVICE_DESK_ID = os.getenv('SERVICE_DESK_ID')
 REQUEST_TYPE_ID = os.getenv('REQUEST_TYPE_ID')
 
-# Authentication
-auth = (EMAIL, API_TOKEN)
-headers = {
-    "Content-Type": "application/json",
-    "Accept": "application/json"
-}
+# Optional bulk creation through Jira's issue bulk API (plain issues, no service
+# desk form); needs the project and issue type the issues are created in
+BULK_MODE = os.getenv('BULK_MODE', 'false').lower() == 'true'
+BULK_SIZE = min(int(os.getenv('BULK_SIZE', MAX_BULK_SIZE)), MAX_BULK_SIZE)
+JIRA_PROJECT_KEY = os.getenv('JIRA_PROJECT_KEY')
+JIRA_ISSUE_TYPE_ID = os.getenv('JIRA_ISSUE_TYPE_ID')
+# Request types that must go through the service desk form API, never bulk
+FORM_REQUEST_TYPES = {t.strip() for t in os.getenv('FORM_REQUEST_TYPES', '').split(',') if t.strip()}
+
+# Optional JSON file overriding the built-in form field schema
+FORM_SCHEMA_PATH = os.getenv('FORM_SCHEMA_PATH')
+
+# Jira HTTP connection pool
+JIRA_POOL_SIZE = int(os.getenv('JIRA_POOL_SIZE', os.getenv('MAX_WORKERS', 8)))
+JIRA_TIMEOUT = int(os.getenv('JIRA_TIMEOUT', 30))
+JIRA_KEEPALIVE_IDLE = int(os.getenv('JIRA_KEEPALIVE_IDLE', 60))
+
+# Jira rate limiting and retries
+JIRA_RATE = float(os.getenv('JIRA_RATE', 10))  # starting requests/sec
+JIRA_MIN_RATE = float(os.getenv('JIRA_MIN_RATE', 0.5))
+JIRA_MAX_RATE = float(os.getenv('JIRA_MAX_RATE', 50))
+JIRA_MAX_RETRIES = int(os.getenv('JIRA_MAX_RETRIES', 5))
+JIRA_RETRY_BUDGET = int(os.getenv('JIRA_RETRY_BUDGET', 500))
 
 # Database config
 DB_CREDENTIALS=os.getenv('DB_CREDENTIALS')
@@ -52,289 +94,1028 @@ DB_CREDENTIALS=os.getenv('DB_CREDENTIALS')
 engine = create_engine(DB_CREDENTIALS)
 Session = sessionmaker(bind=engine)
 
-CHUNK_SIZE = 1000
+# Compile the ticket payload template and validation rules once per process
+form_schema = load_form_schema(FORM_SCHEMA_PATH)
+payload_compiler = PayloadCompiler(SERVICE_DESK_ID, REQUEST_TYPE_ID, form_schema)
+validator = BatchValidator(form_schema)
+
+# Per-stage timings and counters for this process
+metrics = Metrics()
+
+# Rows per fetched batch
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 1000))
+
+# Number of concurrent Jira submissions per run
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', 8))
+
+# Pipeline: batches each stage queue can hold, and Jira requests queued or
+# running at once before the submit stage waits
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 2))
+PIPELINE_IN_FLIGHT = int(os.getenv('PIPELINE_IN_FLIGHT', MAX_WORKERS * 4))
+
+# Read strategy for phonerequest: "stream" (default, one server-side cursor),
+# "keyset" or "offset" pagination
+PAGINATION_MODE = os.getenv('PAGINATION_MODE', 'stream')
+# Unique column that breaks ties between rows with the same (createdat,
+# emailaddress) when paging; by default the table's physical row id (ctid on
+# PostgreSQL, rowid on SQLite)
+PHONEREQUEST_KEY = os.getenv('PHONEREQUEST_KEY')
+
+# Columns read from phonerequest; everything the ticket payload and the hash need
+PHONEREQUEST_COLUMNS = (
+    "newusername",
+    "job",
+    "phonenumber",
+    "emailaddress",
+    "departmentname",
+    "costcenter",
+    "telephonelinesandinstallations",
+    "handsetsandheadsets",
+    "timeframe",
+    "dateneededby",
+    "approximateendingdate",
+    '"Comments"',
+    "createdat"
+)
+PHONEREQUEST_SELECT = ", ".join(PHONEREQUEST_COLUMNS)
 
 # Time window for fetching records (fetch last 24 hours)
-TRACK_HOURS = 24
+# In incremental mode this is the overlap re-read behind the saved watermark,
+# so rows committed late with an older createdat are still picked up.
+TRACK_HOURS = float(os.getenv('TRACK_HOURS', 24))
+
+# Fetch strategy: "incremental" (rows newer than the watermark) or "full"
+FETCH_MODE = os.getenv('FETCH_MODE', 'incremental')
+
+# Rows rejected within this many days are re-read on every incremental run
+# even once the watermark has passed them, so a row fixed late is still ticketed
+DEAD_LETTER_RECHECK_DAYS = float(os.getenv('DEAD_LETTER_RECHECK_DAYS', 30))
+# createdat values per query when re-reading dead-lettered rows
+RECHECK_CHUNK = 500
+# Runs (or daemon passes) a row whose ticket fails holds the watermark back for;
+# after this many failures it is dead-lettered and no longer retried until it changes
+FAILED_TICKET_RETRIES = int(os.getenv('FAILED_TICKET_RETRIES', 5))
+
+# Sharding: SHARD_COUNT workers (processes here or on other machines) each take
+# the rows whose shard key maps to their SHARD_INDEX. SHARD_BY is "email" (hash
+# of emailaddress) or "createdat" (SHARD_BUCKET_HOURS wide time ranges dealt out
+# round-robin). Workers on several machines need DEDUP_MODE=server.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 1))
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', 0))
+SHARD_BY = os.getenv('SHARD_BY', 'email')
+SHARD_BUCKET_HOURS = float(os.getenv('SHARD_BUCKET_HOURS', 1))
+# Claims older than this are assumed abandoned and released at startup
+CLAIM_TTL_HOURS = float(os.getenv('CLAIM_TTL_HOURS', 24))
+
+# Where processed rows are filtered out: "local" (in Python against the dedup
+# store) or "server" (anti-join against processed_hashes in PostgreSQL)
+DEDUP_MODE = os.getenv('DEDUP_MODE', 'local')
+
+@event.listens_for(engine, "connect")
+def _register_sqlite_functions(dbapi_connection, connection_record):
+    """SQLite has no built-in string hash; provide one for email sharding."""
+    if engine.dialect.name == "sqlite":
+        dbapi_connection.create_function(
+            "shard_hash", 1, lambda value: zlib.crc32((value or "").encode()), deterministic=True
+        )
+
+
+def shard_condition():
+    """SQL condition selecting this shard's rows (:shard_index of :shard_count)."""
+    postgres = engine.dialect.name == "postgresql"
+    if SHARD_BY == "createdat":
+        if postgres:
+            bucket = "floor(extract(epoch from createdat) / :shard_bucket)::bigint"
+        else:
+            bucket = "CAST(strftime('%s', createdat) AS INTEGER) / CAST(:shard_bucket AS INTEGER)"
+    elif postgres:
+        bucket = "abs(hashtext(coalesce(emailaddress, ''))::bigint)"
+    else:
+        bucket = "shard_hash(emailaddress)"
+    return f"({bucket}) % :shard_count = :shard_index"
+
+
+def row_key_sql():
+    """(column, parameter) SQL for the unique row key pages are ordered and resumed by."""
+    if PHONEREQUEST_KEY:
+        return PHONEREQUEST_KEY, ":last_row"
+    if engine.dialect.name == "postgresql":
+        return "ctid", "CAST(:last_row AS tid)"
+    return "rowid", ":last_row"
+
+
+def shard_name(shard_index, shard_count):
+    """Name used for a shard's journal, watermark and claims."""
+    return f"shard-{shard_index}-of-{shard_count}"
+
 
 def generate_hash_record(user):
-    """Generate a unique hasd for each record based on combination of several fields"""
+    """Generate a unique hash for each record based on combination of several fields"""
+    return fingerprint(user)
+
 
-    hash_string = f"{user['newusername']}|{user['emailaddress']}|{user['phonenumber']}|{user['createdat']}|{user['dateneededby']}|{user['telephonelinesandinstallations']}|{user['handsetsandheadsets']}"
-    return hashlib.sha256(hash_string.encode()).hexdigest()
+def record_digest(user):
+    """Return the dedup key for a fetched row: the server-computed hash in server mode."""
+    record_hash = getattr(user, 'record_hash', None)
+    if record_hash is not None:
+        return bytes(record_hash)
+    return generate_hash_record(user)
 
 
-def load_processed_records():
+def migrate_fingerprints(store):
     """
-    Load the set of already processed record hashes from state file.
+    Re-key a store written with the old '|'-joined record hash. Scans phonerequest
+    once and, for every row whose old hash is in the store, adds its new
+    fingerprint (and points its dead letter at it), so no processed request is
+    ticketed again. The old digests stay in the store, so an interrupted
+    migration simply runs again. Stores that hold server hashes
+    (DEDUP_MODE=server) don't use the local fingerprint and are skipped.
     """
-    if os.path.exists(RECORD_PATH):
-        try:
-            with open(RECORD_PATH, 'rb') as file:
-                data = pickle.load(file)
-                logger.info(f"Loaded {len(data['hashes'])} previously processed records.")
-                return data
-        except Exception as e:
-            logger.warning(f"Could not load record file: {e}. Starting fresh.")
-            return {"hashes": set(), "last_run": None}
-    return {"hashes": set(), "last_run": None}
+    if store.get_state('fingerprint') == FINGERPRINT_VERSION:
+        return 0
+    migrated = 0
+    if len(store) and store.get_state('server_backfill') is None:
+        logger.info(f"Migrating processed records to {FINGERPRINT_VERSION} fingerprints")
+        for batch in fetch_users_in_batches(pagination="stream", server_dedup=False):
+            pairs = [(legacy_fingerprint(user), fingerprint(user)) for user in batch]
+            processed = store.existing(legacy for legacy, _ in pairs)
+            store.add_many(digest for legacy, digest in pairs if legacy in processed)
+            migrated += sum(1 for legacy, _ in pairs if legacy in processed)
+            if store.dead_letter_count:
+                store.rekey_dead_letters(pairs)
+        logger.info(f"Migrated {migrated} processed records to {FINGERPRINT_VERSION}")
+    store.set_state('fingerprint', FINGERPRINT_VERSION)
+    return migrated
+
+
+def load_processed_records(shard=None):
+    """
+    Open the store of already processed record hashes and its journal, importing
+    the old pickle state file the first time and recovering any hashes journaled
+    by a run that did not finish. Unreadable state raises rather than starting
+    fresh, since starting fresh would re-ticket everything.
+    Each `shard` (a shard_name) has its own journal, and its stale claims are
+    released once the journal is replayed.
+    """
+    load_start = time.perf_counter()
+    store = DedupStore(
+        RECORD_PATH,
+        bloom_path=BLOOM_PATH if USE_BLOOM_FILTER else None,
+        bloom_error_rate=BLOOM_ERROR_RATE
+    )
+    store.migrate_pickle(LEGACY_RECORD_PATH)
+    if DEDUP_MODE == "server":
+        store = ServerDedupStore(store, engine)
+    journal_path = JOURNAL_PATH if shard is None else JOURNAL_PATH.replace(".journal", f".{shard}.journal")
+    journal = HashJournal(journal_path, sync_every=JOURNAL_SYNC_EVERY, sync_interval=JOURNAL_SYNC_INTERVAL)
+    journal.replay(store)
+    if shard is not None:
+        store.release_stale_claims(shard, CLAIM_TTL_HOURS)
+    migrate_fingerprints(store)
+    if DEDUP_MODE == "server" and store.get_state('server_backfill') is None:
+        # First run in server mode: carry over what the local store already knows
+        store.backfill(generate_hash_record)
+        store.set_state('server_backfill', datetime.now().isoformat())
+        store.set_state('server_hash', SERVER_HASH_VERSION)
+    elif DEDUP_MODE == "server" and store.get_state('server_hash') != SERVER_HASH_VERSION:
+        # processed_hashes was written with the old '|'-joined server hash
+        store.rekey()
+        store.set_state('server_hash', SERVER_HASH_VERSION)
+    metrics.observe('state_load_seconds', time.perf_counter() - load_start)
+    logger.info(f"Loaded {len(store)} previously processed records.")
+    return store, journal
 
 
-def save_processed_records(processed_data):
+def save_processed_records(store, new_hashes, journal):
     """
-    Save the set of processed record hashes to state file.
+    Commit the hashes processed in the latest batch to the store, then reset the journal.
     """
     try:
-        processed_data["last_run"] = datetime.now().isoformat()
-        with open(RECORD_PATH, 'wb') as file:
-            pickle.dump(processed_data, file)
-        logger.info(f"Saved state with {len(processed_data['hashes'])} processed records")
+        with metrics.timer('state_save_seconds'):
+            store.add_many(new_hashes)
+            store.set_state('last_run', datetime.now().isoformat())
+            journal.reset(new_hashes)
+        logger.info(f"Saved state with {len(new_hashes)} newly processed records")
     except Exception as e:
         logger.error(f"Failed to save state file: {e}", exc_info=True)
 
 
-def fetch_users_in_batches(batch_size=CHUNK_SIZE):
+def watermark_since(watermark, overlap_hours=TRACK_HOURS):
+    """
+    Return the createdat lower bound for an incremental fetch, or None for a full scan.
+    """
+    if watermark is None:
+        return None
+    if isinstance(watermark, str):
+        watermark = datetime.fromisoformat(watermark)
+    elif isinstance(watermark, date) and not isinstance(watermark, datetime):
+        watermark = datetime.combine(watermark, datetime.min.time())
+    return watermark - timedelta(hours=overlap_hours)
+
+
+def fetch_users_in_batches(batch_size=CHUNK_SIZE, pagination=PAGINATION_MODE, since=None,
+                           server_dedup=DEDUP_MODE == "server", shard=None, createdat_in=None):
     """
     Fetch users in batches from database.
+
+    Only the columns the ticket needs are selected, all reads share one session,
+    and rows are yielded as SQLAlchemy Row tuples (attribute access) rather than dicts.
+    The default "stream" mode runs a single ordered query through a server-side
+    cursor and yields it `batch_size` rows at a time. With keyset pagination each
+    page resumes after the last (createdat, emailaddress, row key) seen, so the
+    database seeks straight to the next page instead of rescanning every earlier
+    row the way LIMIT/OFFSET does. Rows with a NULL createdat or emailaddress
+    can't be sought past, so they are read afterwards in a second pass ordered
+    by the row key alone.
+    When `since` is given only rows created at or after it are read.
+    With `server_dedup` each row's hash is computed in SQL and rows already in
+    processed_hashes are dropped by an anti-join, so only new work is transferred.
+    With `shard` as (shard_index, shard_count) only that shard's rows are read.
+    With `createdat_in` only rows created at one of those values are read.
     """
     if not Session:
         raise Exception("Database session not initialised")
-    
+
+    if server_dedup and pagination == "offset":
+        # Rows drop out of the anti-join as they are processed, which would shift OFFSET pages
+        logger.warning("Server-side dedup cannot use offset pagination; using keyset")
+        pagination = "keyset"
 
     offset = 0
+    last_key = None
+    null_pass = False
     total_fetched = 0
+    row_key, last_row = row_key_sql()
 
-    while True:
-        try:
-            with Session() as session:
-                query = text("""
-                    SELECT *
+    try:
+        with Session() as session:
+            while True:
+                conditions = []
+                params = {"limit": batch_size}
+                if since is not None:
+                    conditions.append("createdat >= :since")
+                    params["since"] = since
+                if createdat_in is not None:
+                    names = [f"createdat_{i}" for i in range(len(createdat_in))]
+                    conditions.append(f"createdat IN ({', '.join(':' + name for name in names)})")
+                    params.update(zip(names, createdat_in))
+                if shard is not None:
+                    conditions.append(shard_condition())
+                    params["shard_index"], params["shard_count"] = shard
+                    params["shard_bucket"] = int(SHARD_BUCKET_HOURS * 3600)
+
+                hash_column = ""
+                if server_dedup:
+                    hash_column = f", {SERVER_HASH_SQL} AS record_hash"
+                    conditions.append(f"""NOT EXISTS (
+                        SELECT 1 FROM processed_hashes ph WHERE ph.record_hash = {SERVER_HASH_SQL}
+                    )""")
+
+                key_column = ""
+                order_clause = "createdat, emailaddress"
+                if pagination == "stream":
+                    page_clause = ""
+                elif pagination == "keyset":
+                    key_column = f", {row_key} AS {PAGE_KEY_COLUMN}"
+                    if null_pass:
+                        conditions.append("(createdat IS NULL OR emailaddress IS NULL)")
+                        if last_key is not None:
+                            conditions.append(f"{row_key} > {last_row}")
+                            params["last_row"] = last_key[2]
+                        order_clause = row_key
+                    else:
+                        conditions.append("createdat IS NOT NULL AND emailaddress IS NOT NULL")
+                        if last_key is not None:
+                            # Resume from the last row of the previous page; the
+                            # >= keeps the (createdat, emailaddress) index usable
+                            conditions.append(
+                                "(createdat, emailaddress) >= (:last_createdat, :last_email) AND "
+                                "((createdat, emailaddress) > (:last_createdat, :last_email) "
+                                f"OR {row_key} > {last_row})"
+                            )
+                            params["last_createdat"], params["last_email"], params["last_row"] = last_key
+                        order_clause = f"createdat, emailaddress, {row_key}"
+                    page_clause = "LIMIT :limit"
+                else:
+                    params["offset"] = offset
+                    # A unique last column, so rows tying on the rest can't move between pages
+                    order_clause = f"createdat, emailaddress, {row_key}"
+                    page_clause = "LIMIT :limit OFFSET :offset"
+
+                where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+                query = text(f"""
+                    SELECT {PHONEREQUEST_SELECT}{hash_column}{key_column}
                     FROM phonerequest
-                    ORDER BY createdat, emailaddress
-                    LIMIT :limit OFFSET :offset;
+                    {where_clause}
+                    ORDER BY {order_clause}
+                    {page_clause};
                 """)
-                
-                result = session.execute(
-                    query,
-                    {"limit": batch_size, "offset": offset}
-                )
-                
-                batch = [dict(row._mapping) for row in result]
-                
-                if not batch:
-                    # No more records
+
+                if pagination == "stream":
+                    result = session.execute(
+                        query, params,
+                        execution_options={"stream_results": True, "yield_per": batch_size}
+                    )
+                    for batch in result.partitions(batch_size):
+                        total_fetched += len(batch)
+                        logger.info(f"Fetched batch of {len(batch)} users (total so far: {total_fetched})")
+                        yield batch
                     break
+
+                batch = session.execute(query, params).all()
                 
-                total_fetched += len(batch)
-                logger.info(f"Fetched batch of {len(batch)} users (total so far: {total_fetched})")
-                
-                yield batch
+                if batch:
+                    total_fetched += len(batch)
+                    logger.info(f"Fetched batch of {len(batch)} users (total so far: {total_fetched})")
+                    yield batch
                 
                 # If batch is smaller than batch_size then end loop
                 if len(batch) < batch_size:
+                    if pagination == "keyset" and not null_pass:
+                        # Now the rows with a NULL createdat or emailaddress
+                        null_pass = True
+                        last_key = None
+                        continue
                     break
                 
                 offset += batch_size
+                if pagination == "keyset":
+                    last = batch[-1]
+                    last_key = (last.createdat, last.emailaddress, getattr(last, PAGE_KEY_COLUMN))
                 
-        except Exception as e:
-            logger.error(f"Failed to fetch users batch: {e}", exc_info=True)
-            raise
+    except Exception as e:
+        logger.error(f"Failed to fetch users batch: {e}", exc_info=True)
+        raise
 
 
-def process_batch(batch, processed_records, new_hash):
-    """Process a batch of users and create Jira tickets for each user.
-        Skips records already processed
+def fetch_dead_letter_rows(createdats, shard=None, seen=None):
+    """
+    Fetch the current rows created at `createdats`, the rows behind open dead
+    letters, RECHECK_CHUNK values per query. The (createdat, row_fingerprint)
+    of every row read is added to `seen` if given, a query's rows only once all
+    of them have been read.
     """
+    for start in range(0, len(createdats), RECHECK_CHUNK):
+        rows = []
+        for batch in fetch_users_in_batches(pagination="stream", shard=shard,
+                                            createdat_in=createdats[start:start + RECHECK_CHUNK]):
+            rows.extend((timestamp_text(user.createdat), row_fingerprint(user)) for user in batch)
+            yield batch
+        if seen is not None:
+            seen.update(rows)
 
-    success = 0
-    failed = 0
-    skipped = 0
-    batch_new_hash = set()
 
-    for user in batch:
-        try:
-            # Generate hash for new record
-            hash_record = generate_hash_record(user)
-
-            # Skip if already processed
-            if hash_record in processed_records or hash_record in new_hash:
-                logger.debug(f"Skipping already processed record for {user['newusername']}")
-                skipped += 1
-                continue
-
-            # Extract user data
-            name = user['newusername']
-            job_title = user['job']
-            phone = user['phonenumber']
-            email = user['emailaddress']
-            department = user['departmentname']
-            cost_center = user['costcenter']
-            installation_type = user['telephonelinesandinstallations']
-            equipment = [item.strip() for item in user['handsetsandheadsets'].split(";")]
-            time_usage_raw = user['timeframe']
-            ending_date = user['dateneededby']
-            comments = user['Comments']
-
-            # Initialise variables
-            approx_ending_date = None
-
-            # Set condition for users based of time_usage selection
-            if time_usage_raw == "Temporary use (three months or less)":
-                time_usage = ["183"]
-                approx_ending_date = user['approximateendingdate']
-            elif time_usage_raw == "Permanent use":
-                time_usage = ["184"]
-
-
-         # Process installation type
-            installation_mapping = {
-                "New extension including new cabling and socket": ["160"],
-                "New extension to an existing, inactive socket": ["161"],
-                "Relocate existing to a new location": ["182"],
-                "Convert existing extension from analogue to digital": ["190"],
-                "Relocate an existing extension to an existing inactive, socket": ["191"],
-                "Swap of telephone extensions": ["192"],
-                "Other... (multi-line hunt group setup)": ["0"]
-            }
-            installation_type_cd = installation_mapping[installation_type]
-            
-            # Process equipment
-            equipment_list = []
-            equipment_mapping = {
-                "Handset speaker phone": "164",
-                "Cordless headset": "165",
-                "Cordless handset": "166",
-                "Mobile phone": "167",
-                "Smartphone": "168",
-                "SIM card only": "194",
-                "Other...": "0"
-            }
-            
-            for item in equipment:
-                if item in equipment_mapping:
-                    equipment_list.append(equipment_mapping[item])
-        
-            # Build ticket issue
-            ticket_issue = {
-                "serviceDeskId": SERVICE_DESK_ID,
-                "requestTypeId": REQUEST_TYPE_ID,
-                "requestFieldValues": {
-                    "summary": f"Phone equipment order - {name}",
-                    "description": f"Equipment request for {name} in {department}"
-                },
-                "form": {
-                    "answers": {
-                        # First section of form- Person making the request
-                        "199": {"text": name},
-                        "200": {"text": job_title},
-                        "201": {"text": phone},
-                        "202": {"text": email},
-                        "203": {"text": department},
-                        "204": {"text": cost_center},
-                        
-                        # Telephone lines and installations
-                        "157": {"choices": installation_type_cd},
-                        
-                        # Handsets and Headsets
-                        "159": {"choices": equipment_list},
-                        
-                        # Time frame
-                        "205": {"choices": time_usage},  
-                        "206": {"date": ending_date},
-                        
-                        # Comments
-                        "189": {"text": comments}
-                    }
-                }
-            }
-
-
-            # Add approx_ending_date only if it exists
-            if approx_ending_date:
-                ticket_issue["form"]["answers"]["197"] = {"date": approx_ending_date}
-
-
-            #Submit the request
-            url = f"{JIRA_URL}/rest/servicedeskapi/request"
-            response = requests.post(
-                url, 
-                auth=auth, 
-                headers=headers, 
-                data=json.dumps(ticket_issue),
-                timeout=30  
+def dead_letter_rechecks(store, since):
+    """
+    createdat of the open dead letters (rejected within DEAD_LETTER_RECHECK_DAYS)
+    whose rows are older than `since`. An incremental fetch no longer reads
+    those rows, so they are fetched directly to see whether they have been
+    fixed. Empty for a full scan, which reads them anyway.
+    """
+    if since is None or not store.dead_letter_count:
+        return []
+    recheck = [createdat for createdat in store.dead_letter_createdats(DEAD_LETTER_RECHECK_DAYS)
+               if datetime.fromisoformat(createdat) < since]
+    if recheck:
+        logger.info(f"Re-reading rows of dead letters at {len(recheck)} createdat values before {since}")
+    return recheck
+
+
+def timestamp_text(value):
+    """A createdat value as stored in the state tables."""
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def create_jira_client(shard_count=1):
+    """
+    Create the Jira client shared by every batch in a run. Shards split the
+    configured request rates between them, since they share one Jira account.
+    """
+    throttler = AdaptiveThrottler(
+        rate=JIRA_RATE / shard_count,
+        min_rate=JIRA_MIN_RATE / shard_count,
+        max_rate=JIRA_MAX_RATE / shard_count
+    )
+    return JiraClient(
+        JIRA_URL,
+        EMAIL,
+        API_TOKEN,
+        pool_size=JIRA_POOL_SIZE,
+        timeout=JIRA_TIMEOUT,
+        keepalive_idle=JIRA_KEEPALIVE_IDLE,
+        throttler=throttler,
+        max_retries=JIRA_MAX_RETRIES,
+        retry_budget=JIRA_RETRY_BUDGET,
+        metrics=metrics
+    )
+
+
+def bulk_enabled():
+    """Return True if tickets should be created through the bulk issue API."""
+    if not BULK_MODE:
+        return False
+    if REQUEST_TYPE_ID in FORM_REQUEST_TYPES:
+        logger.info(f"Request type {REQUEST_TYPE_ID} needs the service desk form API; bulk mode disabled")
+        return False
+    if not JIRA_PROJECT_KEY or not JIRA_ISSUE_TYPE_ID:
+        logger.warning("BULK_MODE needs JIRA_PROJECT_KEY and JIRA_ISSUE_TYPE_ID; creating tickets one by one")
+        return False
+    if not FORM_REQUEST_TYPES:
+        logger.warning(
+            f"BULK_MODE is on and FORM_REQUEST_TYPES is unset; request type {REQUEST_TYPE_ID} will be "
+            "created as plain issues without its form fields. List it in FORM_REQUEST_TYPES if it needs the form"
+        )
+    logger.info(f"Bulk mode: up to {BULK_SIZE} issues per call in project {JIRA_PROJECT_KEY}")
+    return True
+
+
+def single_result(response):
+    """Turn a service desk create response into (issue_key, error)."""
+    if response.status_code in [200, 201]:
+        return response.json()['issueKey'], None
+    return None, f"Status {response.status_code} - {response.text}"
+
+
+def validate_batch(candidates, processed_records):
+    """
+    Split (user, hash) candidates into rows fit to ticket and rejects.
+
+    Rows rejected on an earlier run are skipped while unchanged. The rest are
+    validated as one batch; new rejects are logged with their reasons and stored
+    as dead letters instead of being sent to Jira.
+    Returns (valid, rejected, known_rejects).
+    """
+    known_rejects = 0
+    if processed_records.dead_letter_count:
+        fingerprints = [row_fingerprint(user) for user, _ in candidates]
+        dead = processed_records.dead_letters(fingerprints)
+        if dead:
+            kept = [item for item, fingerprint in zip(candidates, fingerprints) if fingerprint not in dead]
+            known_rejects = len(candidates) - len(kept)
+            candidates = kept
+
+    valid = []
+    dead_letters = []
+    reasons = validator.validate(user for user, _ in candidates)
+    for (user, hash_record), row_reasons in zip(candidates, reasons):
+        if row_reasons:
+            reason = "; ".join(row_reasons)
+            logger.warning(f"Rejected record for {user.newusername}: {reason}")
+            createdat = None if user.createdat is None else timestamp_text(user.createdat)
+            dead_letters.append((row_fingerprint(user), hash_record, reason, createdat))
+        else:
+            valid.append((user, hash_record))
+
+    if dead_letters:
+        processed_records.add_dead_letters(dead_letters)
+    return valid, len(dead_letters), known_rejects
+
+
+class BatchWork:
+    """One fetched batch on its way through the pipeline, with its results."""
+
+    def __init__(self, batch):
+        self.batch = batch
+        # Not simply the last row: keyset mode reads rows with a NULL emailaddress
+        # last, whatever their createdat
+        self.newest = max((user.createdat for user in batch if user.createdat is not None), default=None)
+        self.success = 0
+        self.failed = 0
+        self.skipped = 0
+        self.rejected = 0
+        self.new_hash = set()
+        # createdat of the oldest row that failed and is still retried, so the
+        # watermark doesn't move past it (see settle_failures)
+        self.oldest_failed = None
+        # (user, hash_record, error) of rows whose ticket failed
+        self.failed_rows = []
+        # Hashes this batch put in flight, released once the batch is committed
+        self.claimed = []
+        # Hashes of rows that were submitted or about to be, but not ticketed
+        self.unconfirmed = []
+        self.to_submit = []
+        self.ready = []
+        self.pending = {}
+
+    def fail(self, user, hash_record=None, error=None):
+        self.failed += 1
+        if hash_record is None:
+            # No digest to count failures against; retry it until it hashes
+            self.oldest_failed = _older(self.oldest_failed, user.createdat)
+        else:
+            self.unconfirmed.append(hash_record)
+            self.failed_rows.append((user, hash_record, error))
+
+
+def filter_batch(work, processed_records, new_hash, in_flight, owner=None):
+    """
+    Hash the batch, skip records already processed or in flight, and validate the rest.
+    The store is queried once for the whole batch.
+    With `owner` (a shard) the valid rows are then claimed in the store, and
+    rows another shard has claimed or processed meanwhile are skipped.
+    """
+    metrics.count('rows_fetched', len(work.batch))
+    hashed = []
+    with metrics.timer('hash_seconds'):
+        for user in work.batch:
+            try:
+                hashed.append((user, record_digest(user)))
+            except Exception as e:
+                logger.error(f"Unexpected error processing user {user.newusername}: {e}", exc_info=True)
+                work.fail(user)
+    with metrics.timer('dedup_lookup_seconds'):
+        already_processed = processed_records.existing(hash_record for _, hash_record in hashed)
+
+    candidates = []
+    for user, hash_record in hashed:
+        # Skip if already processed
+        if hash_record in already_processed or hash_record in new_hash or hash_record in in_flight:
+            logger.debug(f"Skipping already processed record for {user.newusername}")
+            work.skipped += 1
+            continue
+        in_flight.add(hash_record)
+        work.claimed.append(hash_record)
+        candidates.append((user, hash_record))
+    metrics.count('dedup_checked', len(hashed))
+    metrics.count('dedup_hits', len(hashed) - len(candidates))
+
+    # Reject bad rows before building any payload
+    with metrics.timer('validate_seconds'):
+        work.to_submit, work.rejected, known_rejects = validate_batch(candidates, processed_records)
+    work.skipped += known_rejects
+
+    if owner is not None and work.to_submit:
+        with metrics.timer('claim_seconds'):
+            claimed = processed_records.claim((hash_record for _, hash_record in work.to_submit), owner)
+        work.skipped += len(work.to_submit) - len(claimed)
+        work.to_submit = [(user, hash_record) for user, hash_record in work.to_submit if hash_record in claimed]
+    return work
+
+
+def build_payloads(work, bulk=False):
+    """Build every payload in the batch in one pass."""
+    with metrics.timer('payload_build_seconds'):
+        if bulk:
+            payloads = payload_compiler.build_issue_batch(
+                (user for user, _ in work.to_submit), JIRA_PROJECT_KEY, JIRA_ISSUE_TYPE_ID
             )
+        else:
+            payloads = payload_compiler.build_batch(user for user, _ in work.to_submit)
 
-            if response.status_code in [200, 201]:
-                result = response.json()
-                issue_key = result['issueKey']
-                logger.info(f"Sucessfully created ticket {issue_key} for {name}")
-                success += 1
-                # Add record to records processed
-                batch_new_hash.add(hash_record)
-                new_hash.add(hash_record)
+    for (user, hash_record), (payload, error) in zip(work.to_submit, payloads):
+        if error:
+            # Row can't be mapped to the form (e.g. unknown choice)
+            logger.error(f"Cannot build ticket for {user.newusername}: {error}")
+            work.fail(user, hash_record, error)
+            continue
+        work.ready.append((user, hash_record, payload))
+    return work
+
+
+def send_tickets(client, items, bulk=False, journal=None):
+    """
+    Create the tickets for `items` in one request (a bulk call, or a single
+    ticket) and return one (issue_key, error) per item. Confirmed hashes are
+    journaled right here on the worker thread, as soon as Jira answers.
+    """
+    if bulk:
+        _, results = client.create_issues_bulk([payload for _, _, payload in items])
+    else:
+        results = [single_result(client.create_request(items[0][2]))]
+    if journal:
+        for (_, hash_record, _), (issue_key, _) in zip(items, results):
+            if issue_key:
+                journal.record(hash_record)
+    return results
+
+
+def submit_batch(work, client, executor, bulk=False, journal=None, slots=None, acquire=None):
+    """
+    Submit the batch's tickets to `executor`, one per request or BULK_SIZE per
+    bulk call. With `slots` (a semaphore) each request holds a slot until it
+    completes, which caps the requests in flight and holds this stage back when
+    Jira is the bottleneck; `acquire(slots)` is used to wait for a slot if given.
+    """
+    if bulk:
+        calls = [work.ready[start:start + BULK_SIZE] for start in range(0, len(work.ready), BULK_SIZE)]
+    else:
+        calls = [[item] for item in work.ready]
+
+    for items in calls:
+        if slots is not None:
+            if acquire:
+                acquire(slots)
             else:
-                logger.error(f"Failed to create ticket for {name}: Status {response.status_code} - {response.text}")
-                failed += 1
-
-        except KeyError as e:
-            # Handle missing fields
-            logger.error(f"Missing required field for user {e}", exc_info=True)
-            failed += 1
-        
+                slots.acquire()
+        #Submit the request
+        future = executor.submit(send_tickets, client, items, bulk, journal)
+        if slots is not None:
+            future.add_done_callback(lambda _: slots.release())
+        work.pending[future] = items
+    return work
+
+
+def collect_batch(work, new_hash):
+    """
+    Account for the batch's requests as each completes. A record's hash is only
+    added to `new_hash` once its ticket is confirmed.
+    """
+    for future in as_completed(work.pending):
+        items = work.pending[future]
+        names = ", ".join(user.newusername for user, _, _ in items)
+        try:
+            results = future.result()
+
         except requests.exceptions.RequestException as e:
             # Handle API request errors
-            logger.error(f"API request failed for {user['newusername']}: {e}", exc_info=True)
-            failed += 1
-            
+            logger.error(f"API request failed for {names}: {e}", exc_info=True)
+            results = [(None, str(e))] * len(items)
+
         except Exception as e:
             # Handle any other errors
-            logger.error(f"Unexpected error processing user {user['newusername']}: {e}", exc_info=True)
-            failed += 1
+            logger.error(f"Unexpected error processing {names}: {e}", exc_info=True)
+            results = [(None, str(e))] * len(items)
+
+        for (user, hash_record, _), (issue_key, error) in zip(items, results):
+            name = user.newusername
+            if issue_key:
+                logger.info(f"Sucessfully created ticket {issue_key} for {name}")
+                work.success += 1
+                # Add record to records processed
+                work.new_hash.add(hash_record)
+                new_hash.add(hash_record)
+            else:
+                logger.error(f"Failed to create ticket for {name}: {error}")
+                work.fail(user, hash_record, error)
+
+    logger.info(f"Batch complete: {work.success} successful, {work.failed} failed, {work.rejected} rejected")
+    return work
+
+
+def settle_failures(work, store):
+    """
+    Count the batch's failed tickets in the store. Rows that have failed fewer
+    than FAILED_TICKET_RETRIES times hold the watermark back so they are
+    fetched and retried; the rest are dead-lettered, so a row Jira keeps
+    rejecting can't pin the watermark. Like validation rejects, they are
+    skipped until the row changes.
+    """
+    if not work.failed_rows:
+        return work
+    failures = store.count_failures(hash_record for _, hash_record, _ in work.failed_rows)
+    dead_letters = []
+    for user, hash_record, error in work.failed_rows:
+        count = failures.get(hash_record, 1)
+        if count < FAILED_TICKET_RETRIES:
+            work.oldest_failed = _older(work.oldest_failed, user.createdat)
+            continue
+        logger.error(f"Giving up on {user.newusername} after {count} failed tickets; dead-lettered until the row changes")
+        createdat = None if user.createdat is None else timestamp_text(user.createdat)
+        dead_letters.append((row_fingerprint(user), hash_record, f"Ticket failed {count} times: {error}", createdat))
+    if dead_letters:
+        store.add_dead_letters(dead_letters)
+    return work
+
+
+def process_batch(batch, processed_records, new_hash, client, executor=None, journal=None, bulk=False):
+    """Process a batch of users and create Jira tickets for each user.
+        Skips records already processed
+
+    Runs the pipeline stages (filter_batch, build_payloads, submit_batch,
+    collect_batch) one after another for a single batch; main() overlaps them
+    across batches instead.
+    Returns (success, failed, skipped, rejected, batch_new_hash, oldest_failed).
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+    try:
+        work = filter_batch(BatchWork(batch), processed_records, new_hash, set())
+        build_payloads(work, bulk)
+        submit_batch(work, client, executor, bulk, journal)
+        collect_batch(work, new_hash)
+        settle_failures(work, processed_records)
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
+
+    return work.success, work.failed, work.skipped, work.rejected, work.new_hash, work.oldest_failed
+
+
+def _older(current, candidate):
+    """Return the earlier of two createdat values, ignoring missing ones."""
+    if candidate is None:
+        return current
+    if current is None or candidate < current:
+        return candidate
+    return current
+
+
+def _newer(current, candidate):
+    """Return the later of two createdat values, ignoring missing ones."""
+    if candidate is None:
+        return current
+    if current is None or candidate > current:
+        return candidate
+    return current
+
+
+def log_totals(summary):
+    """Log the ticket and Jira counters of a run (or of all shards merged)."""
+    logger.info(f"Total successful: {summary['success']}")
+    logger.info(f"Total failed: {summary['failed']}")
+    logger.info(f"Total skipped: {summary['skipped']}")
+    logger.info(f"Total rejected: {summary['rejected']}")
+    logger.info(f"New records processed: {summary['new_records']}")
+    logger.info(f"Jira requests: {summary['requests']}, retries: {summary['retries']}, "
+                f"rate limited: {summary['rate_limited']}, "
+                f"retry budget exhausted: {summary['retry_budget_exhausted']}")
+    if summary['uncertain']:
+        logger.error(f"{summary['uncertain']} Jira requests failed after Jira may have created the issue; "
+                     f"search the log for POSSIBLE DUPLICATE and check Jira before they are retried")
+    logger.info(f"Throttle wait: {summary['throttle_wait_seconds']:.2f}s, "
+                f"backoff: {summary['backoff_seconds']:.2f}s")
+
+
+def _until(keep_going, batches):
+    """Pass batches through until keep_going() turns false, then close the fetch."""
+    try:
+        for batch in batches:
+            if not keep_going():
+                logger.info("Stopping: no more batches will be fetched")
+                break
+            yield batch
+    finally:
+        batches.close()
+
 
-    logger.info(f"Batch complete: {success} successful, {failed} failed")
-    return success, failed, skipped, batch_new_hash   
+def _fetch_pass(since, shard_range, recheck, seen):
+    for batch in fetch_users_in_batches(since=since, shard=shard_range):
+        yield BatchWork(batch)
+    for batch in fetch_dead_letter_rows(recheck, shard_range, seen):
+        work = BatchWork(batch)
+        # These rows are behind the watermark and must not move it back; a
+        # failure among them still holds it back (see advance_watermark)
+        work.newest = None
+        yield work
 
 
-def main():
-    """Main execution function."""
+def run_pass(store, journal, client, executor, bulk=False, since=None, shard=None, shard_range=None,
+             keep_going=None, recheck=()):
+    """
+    Run the fetch/filter/build/submit/commit pipeline once over the rows created
+    since `since` (every row if None), then over the rows created at the
+    `recheck` values (see dead_letter_rechecks). `shard` is this shard's name and
+    `shard_range` its (shard_index, shard_count). `keep_going`, if given, is
+    checked before each new batch, so a shutdown stops reading while batches
+    already in flight are still committed.
+    Returns (totals, newest_seen, oldest_failed, pipeline).
+    """
+    totals = {'success': 0, 'failed': 0, 'skipped': 0, 'rejected': 0}
+    new_hashs = set()
+    # Hashes submitted but not yet committed, so later batches don't resubmit them
+    in_flight = set()
+    newest_seen = None
+    oldest_failed = None
+
+    slots = threading.BoundedSemaphore(PIPELINE_IN_FLIGHT)
+    pipeline = Pipeline(queue_size=PIPELINE_QUEUE_SIZE)
+
+    def commit(work):
+        """Last stage: wait for the batch's tickets, then commit its hashes."""
+        nonlocal newest_seen, oldest_failed
+        collect_batch(work, new_hashs)
+        # Update file with newly processed records
+        save_processed_records(store, work.new_hash, journal)
+        settle_failures(work, store)
+        if shard and work.unconfirmed:
+            # Let this or another shard pick these rows up again later
+            store.release(work.unconfirmed)
+        in_flight.difference_update(work.claimed)
+
+        for key in totals:
+            totals[key] += getattr(work, key)
+        newest_seen = _newer(newest_seen, work.newest)
+        oldest_failed = _older(oldest_failed, work.oldest_failed)
+
+    # (createdat, fingerprint) of the dead-lettered rows re-read
+    seen = set()
+    batches = metrics.timed_iter('fetch_seconds', _fetch_pass(since, shard_range, list(recheck), seen))
+    if keep_going is not None:
+        batches = _until(keep_going, batches)
+
+    # Fetch, filter, build, submit and commit run concurrently on successive batches
+    batches = pipeline.source("fetch", batches)
+    filtered = pipeline.stage(
+        "filter", lambda work: filter_batch(work, store, new_hashs, in_flight, shard), batches
+    )
+    built = pipeline.stage("build", lambda work: build_payloads(work, bulk), filtered)
+    submitted = pipeline.stage(
+        "submit", lambda work: submit_batch(work, client, executor, bulk, journal, slots, pipeline.acquire), built
+    )
+    pipeline.stage("commit", commit, submitted, output=False)
+    pipeline.run()
+
+    if seen and shard_range is None:
+        # Their rows were changed and the new versions processed above. Sharded
+        # runs skip this: rows of other shards with the same createdat are not read
+        dropped = store.drop_changed_dead_letters(seen)
+        if dropped:
+            logger.info(f"Cleared {dropped} dead letters whose rows have changed")
+
+    totals['new_records'] = len(new_hashs)
+    return totals, newest_seen, oldest_failed, pipeline
+
+
+def advance_watermark(store, key, newest_seen, oldest_failed):
+    """
+    Move the saved watermark to the newest row seen, held back at the oldest
+    failed row so that row is fetched again next time. Returns the new watermark.
+    """
+    if newest_seen is None and oldest_failed is None:
+        return None
+    watermark = _older(newest_seen, oldest_failed)
+    store.set_state(key, timestamp_text(watermark))
+    logger.info(f"Watermark advanced to {watermark}")
+    return watermark
+
+
+def client_totals(totals, client):
+    """Add the Jira client's counters to a run's totals."""
+    client_stats = client.summary()
+    summary = dict(totals)
+    for key in ('requests', 'retries', 'rate_limited', 'retry_budget_exhausted', 'uncertain',
+                'throttle_wait_seconds', 'backoff_seconds'):
+        summary[key] = client_stats.get(key, 0)
+    return summary
+
+
+def metrics_path(shard=None):
+    """METRICS_FILE, or a per-shard file next to it."""
+    if shard is None:
+        return METRICS_FILE
+    base, extension = os.path.splitext(METRICS_FILE)
+    return f"{base}.{shard}{extension}"
+
+
+def export_metrics(summary, store, pipeline=None, path=METRICS_FILE):
+    """
+    Add the run's totals, dedup and pipeline figures to the metrics registry and
+    write it to `path`. A failed write is logged but never fails the run.
+    """
+    for key in ('success', 'failed', 'skipped', 'rejected'):
+        metrics.set('tickets', summary[key], result=key)
+    for key in ('requests', 'retries', 'rate_limited', 'retry_budget_exhausted', 'uncertain'):
+        metrics.set(f'jira_{key}', summary[key])
+    metrics.set('jira_throttle_wait_seconds', summary['throttle_wait_seconds'])
+    metrics.set('jira_backoff_seconds', summary['backoff_seconds'])
+
+    checked = metrics.counter_value('dedup_checked')
+    metrics.set('dedup_hit_ratio', metrics.counter_value('dedup_hits') / checked if checked else 0.0)
+    metrics.set('dedup_bloom_negatives', store.bloom_negatives)
+    metrics.set('dedup_store_lookups', store.store_lookups)
+    metrics.set('dead_letters', store.dead_letter_count)
+    for key, value in log_stats().items():
+        metrics.set('log_records_lost', value, reason=key)
+    if pipeline is not None:
+        for stage, stats in pipeline.stats.items():
+            metrics.set('pipeline_stage_seconds', stats['seconds'], stage=stage)
+            metrics.set('pipeline_stage_items', stats['items'], stage=stage)
+    metrics.set('last_run_timestamp_seconds', time.time())
+
+    try:
+        metrics.write(path)
+    except Exception as e:
+        logger.error(f"Failed to write metrics to {path}: {e}", exc_info=True)
+        return
+
+    timings = metrics.summary()['histograms']
+    stages = ", ".join(f"{name} {timings[name]['sum']:.2f}s" for name in (
+        'fetch_seconds', 'hash_seconds', 'dedup_lookup_seconds', 'validate_seconds',
+        'payload_build_seconds', 'state_save_seconds') if name in timings)
+    logger.info(f"Stage time: {stages}. Metrics written to {path}")
+
+
+def main(shard_index=SHARD_INDEX, shard_count=SHARD_COUNT):
+    """
+    Main execution function. With shard_count > 1, runs one shard: only its
+    partition of phonerequest is read and every record is claimed before it is
+    submitted. Returns the run's summary counters.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index {shard_index} is outside 0..{shard_count - 1}")
+    shard = shard_name(shard_index, shard_count) if shard_count > 1 else None
     logger.info("=" * 30)
-    logger.info("STARTING JIRA TICKET CREATION PROCESS")
+    logger.info("STARTING JIRA TICKET CREATION PROCESS" + (f" ({shard})" if shard else ""))
     logger.info("=" * 30)
     
     # Load previously processed records
-    records = load_processed_records()
-    processed_hash = records['hashes']
+    store, journal = load_processed_records(shard)
 
-    if records['last_run']:
-        logger.info(f"Last successful run: {records['last_run']}")
+    last_run = store.get_state('last_run')
+    if last_run:
+        logger.info(f"Last successful run: {last_run}")
 
-    total_success = 0
-    total_failed = 0
-    total_skipped = 0
-    new_hashs = set()
-    
-    try:
-        for batch in fetch_users_in_batches():
-            success, failed, skipped, batch_new_hash = process_batch(batch, processed_hash, new_hashs)
-            total_success += success
-            total_failed += failed
-            total_skipped += skipped
-            new_hashs.update(batch_new_hash)
+    # Each shard reads a different partition, so each keeps its own watermark
+    watermark_key = f"watermark:{shard}" if shard else 'watermark'
+    since = None
+    if FETCH_MODE == "incremental":
+        watermark = store.get_state(watermark_key)
+        since = watermark_since(watermark)
+        logger.info(f"Incremental fetch from watermark {watermark} (reading rows since {since})")
 
-            # Update file with newly processed records
-            records['hashes'].update(batch_new_hash)
-            save_processed_records(records)
+    client = create_jira_client(shard_count)
+    bulk = bulk_enabled()
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        totals, newest_seen, oldest_failed, pipeline = run_pass(
+            store, journal, client, executor, bulk, since, shard, (shard_index, shard_count) if shard else None,
+            recheck=dead_letter_rechecks(store, since)
+        )
+        advance_watermark(store, watermark_key, newest_seen, oldest_failed)
+        summary = client_totals(totals, client)
 
         logger.info("=" * 10)
-        logger.info(f"Process complete!")
-        logger.info(f"Total successful: {total_success}")
-        logger.info(f"Total failed: {total_failed}")
-        logger.info(f"Total skipped: {total_skipped}")
-        logger.info(f"New records processed: {len(new_hashs)}")
-        
+        logger.info(f"Process complete!" + (f" ({shard})" if shard else ""))
+        log_totals(summary)
+        logger.info(f"Dead letters awaiting a fix: {store.dead_letter_count}")
+        logger.info(f"Dedup lookups: {store.bloom_negatives} answered by bloom filter, "
+                    f"{store.store_lookups} checked against the store")
+        logger.info(f"Final Jira rate: {client.summary().get('current_rate', 0):.2f} requests/sec")
+        logger.info(f"Pipeline stages: {pipeline.summary()}")
+        export_metrics(summary, store, pipeline, metrics_path(shard))
+        return summary
+
     except Exception as e:
         logger.error(f"Fatal error in main process: {e}", exc_info=True)
         raise
+    finally:
+        executor.shutdown(wait=True)
+        client.close()
+        journal.close()
+        store.close()
+
+
+def run_shards(shard_count):
+    """
+    Run `shard_count` shards as separate processes on this machine, sharing the
+    local dedup store, and log their merged summary.
+    """
+    logger.info(f"Starting {shard_count} shard processes (sharded by {SHARD_BY})")
+    # Migrate the shared store once here rather than in every shard
+    store, journal = load_processed_records()
+    journal.close()
+    store.close()
+    context = multiprocessing.get_context("spawn")
+    # Shards send their log records here and this process writes them, so
+    # only one process appends to and rotates the log file
+    log_queue = context.Queue(LOG_QUEUE_SIZE)
+    shard_logs = listen(log_queue)
+    summaries = []
+    failed_shards = []
+    try:
+        with context.Pool(shard_count, initializer=forward_logging, initargs=(log_queue,)) as pool:
+            results = [pool.apply_async(main, (index, shard_count)) for index in range(shard_count)]
+            for index, result in enumerate(results):
+                try:
+                    summaries.append(result.get())
+                except Exception as e:
+                    logger.error(f"{shard_name(index, shard_count)} failed: {e}")
+                    failed_shards.append(index)
+            # Let the workers exit on their own so their queued log records are sent
+            pool.close()
+            pool.join()
+    finally:
+        shard_logs.stop()
+
+    merged = {}
+    for summary in summaries:
+        for key, value in summary.items():
+            merged[key] = merged.get(key, 0) + value
+
+    logger.info("=" * 10)
+    logger.info(f"All shards complete: {len(summaries)} of {shard_count} succeeded")
+    if merged:
+        log_totals(merged)
+    if failed_shards:
+        raise RuntimeError(f"Shards {failed_shards} failed; see the log for details")
+    return merged
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Create Jira tickets for new phone requests.")
+    parser.add_argument("--shards", type=int, help="run this many shard processes on this machine")
+    parser.add_argument("--shard-index", type=int, default=SHARD_INDEX, help="run only this shard")
+    parser.add_argument("--shard-count", type=int, default=SHARD_COUNT, help="total number of shards")
+    parser.add_argument("--profile", choices=("cpu", "memory", "all"),
+                        help="profile the run with cProfile and/or tracemalloc; results go to the log and logs/main.prof")
+    args = parser.parse_args()
+
+    if args.shards and args.shards > 1:
+        run_shards(args.shards)
+    elif args.profile:
+        with profiled(args.profile, LOG_DIR):
+            main(args.shard_index, args.shard_count)
+    else:
+        main(args.shard_index, args.shard_count)
@@ -0,0 +1,262 @@
+"""
+In-process metrics for a run: counters, gauges and timing histograms.
+
+Values are kept in memory and written once at the end of a run (or after each
+daemon pass) either as a Prometheus text file, for node_exporter's textfile
+collector, or as a JSON summary. `profiled` wraps a run in cProfile and/or
+tracemalloc.
+"""
+import bisect
+import cProfile
+import io
+import json
+import logging
+import math
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds, from sub-millisecond lookups to slow Jira calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Prefix of every exported Prometheus metric name
+PROMETHEUS_PREFIX = "cowjacket_"
+
+
+class Histogram:
+    """Fixed-bucket histogram with exact count, sum, min and max."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the `fraction` quantile, capped at the largest value seen."""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0,
+            'p50': self.quantile(0.50),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'max': self.max
+        }
+
+
+def _key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, gauges and histograms. Each metric can
+    carry labels, given as keyword arguments:
+
+        metrics.count('dedup_hits', 12)
+        metrics.observe('jira_request_seconds', 0.21, status=201)
+        with metrics.timer('payload_build_seconds'):
+            ...
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed_iter(self, name, iterable, **labels):
+        """Yield from `iterable`, observing the seconds each item took to produce."""
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self.observe(name, time.perf_counter() - start, **labels)
+                yield item
+        finally:
+            close = getattr(iterator, "close", None)
+            if close:
+                close()
+
+    def counter_value(self, name, **labels):
+        with self.lock:
+            return self.counters.get(_key(name, labels), 0)
+
+    def summary(self):
+        """Every metric as a JSON-friendly dict, with labels folded into the metric name."""
+        def flat(name, labels):
+            return name + ("{" + ",".join(f"{label}={value}" for label, value in labels) + "}" if labels else "")
+
+        with self.lock:
+            return {
+                'counters': {flat(*key): value for key, value in sorted(self.counters.items())},
+                'gauges': {flat(*key): value for key, value in sorted(self.gauges.items())},
+                'histograms': {flat(*key): histogram.summary() for key, histogram in sorted(self.histograms.items())}
+            }
+
+    def prometheus(self):
+        """Every metric in the Prometheus text exposition format."""
+        def labelled(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                       for _, value in pairs)
+            return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + "}"
+
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = f"{PROMETHEUS_PREFIX}{name}_total"
+                declare(metric, "counter")
+                lines.append(f"{metric}{labelled(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                metric = f"{PROMETHEUS_PREFIX}{name}"
+                declare(metric, "gauge")
+                lines.append(f"{metric}{labelled(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = f"{PROMETHEUS_PREFIX}{name}"
+                declare(metric, "histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{labelled(labels, [('le', f'{bound:g}')])} {cumulative}")
+                lines.append(f"{metric}_bucket{labelled(labels, [('le', '+Inf')])} {histogram.count}")
+                lines.append(f"{metric}_sum{labelled(labels)} {histogram.sum}")
+                lines.append(f"{metric}_count{labelled(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write the metrics to `path`: Prometheus text format for a .prom file,
+        a JSON summary otherwise. The file is replaced atomically so a collector
+        never reads it half written.
+        """
+        if path.endswith(".prom"):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.summary(), indent=2) + "\n"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+
+
+@contextmanager
+def profiled(mode, directory, top=25):
+    """
+    Profile the `with` block. `mode` is "cpu" (cProfile over every thread started
+    inside the block), "memory" (tracemalloc) or "all". The CPU profile is saved
+    to `directory`/main.prof for snakeviz/pstats, and the top `top` entries of
+    each profile are logged.
+    """
+    cpu = mode in ("cpu", "all")
+    memory = mode in ("memory", "all")
+    profiles = []
+
+    def profile_thread(frame, event, arg):
+        # Runs on a new thread's first profiler event and swaps in its own profiler
+        profile = cProfile.Profile()
+        profiles.append(profile)
+        profile.enable()
+
+    # tracemalloc starts first and stops first, so it doesn't count the CPU profiler's own allocations
+    if memory:
+        tracemalloc.start()
+    if cpu:
+        profiles.append(cProfile.Profile())
+        threading.setprofile(profile_thread)
+        profiles[0].enable()
+    try:
+        yield
+    finally:
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = "\n".join(str(stat) for stat in snapshot.statistics("lineno")[:top])
+            logger.info(f"Python heap: {current / 1e6:.1f} MB still allocated, peak {peak / 1e6:.1f} MB. "
+                        f"Largest allocations still live:\n{lines}")
+        if cpu:
+            profiles[0].disable()
+            threading.setprofile(None)
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, "main.prof")
+            stats.dump_stats(path)
+            output = io.StringIO()
+            stats.stream = output
+            stats.sort_stats("cumulative").print_stats(top)
+            logger.info(f"CPU profile over {len(profiles)} threads saved to {path}:\n{output.getvalue()}")
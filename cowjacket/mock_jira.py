@@ -0,0 +1,176 @@
+"""
+Local stand-in for the Jira endpoints main.py calls, for load testing.
+
+Serves POST /rest/servicedeskapi/request and POST /rest/api/2/issue/bulk with
+configurable latency, 5xx error rate and 429 rate limiting, and reports what
+it received at GET /stats.
+
+Usage:
+    python mock_jira.py --port 8765 --latency 50 --error-rate 0.01 --max-rps 20
+Then point main.py at it with JIRA_URL=http://127.0.0.1:8765
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockJira:
+    """
+    Mock Jira server running on a background thread.
+
+    latency        - mean response delay in seconds (jittered +/- `jitter` fraction)
+    error_rate     - fraction of requests answered 503
+    throttle_rate  - fraction of requests answered 429 with Retry-After
+    max_rps        - answer 429 whenever more than this many requests arrive within a second
+    retry_after    - Retry-After seconds sent with 429s
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.05, jitter=0.5, error_rate=0.0,
+                 throttle_rate=0.0, max_rps=None, retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_rps = max_rps
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.keys = itertools.count(1)
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.stats = {'requests': 0, 'created': 0, 'errors': 0, 'rate_limited': 0}
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-jira", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _outcome(self):
+        """Decide the status for the next request: 201, 429 or 503."""
+        with self.lock:
+            self.stats['requests'] += 1
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            over_limit = self.max_rps is not None and self.window_count > self.max_rps
+            draw = self.random.random()
+            if over_limit or draw < self.throttle_rate:
+                self.stats['rate_limited'] += 1
+                return 429
+            if draw < self.throttle_rate + self.error_rate:
+                self.stats['errors'] += 1
+                return 503
+            return 201
+
+    def _delay(self):
+        if self.latency:
+            with self.lock:
+                spread = self.random.uniform(-self.jitter, self.jitter)
+            time.sleep(max(0.0, self.latency * (1 + spread)))
+
+    def _next_key(self, count=1):
+        with self.lock:
+            self.stats['created'] += count
+            return [f"CP-{next(self.keys)}" for _ in range(count)]
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                mock._delay()
+                status = mock._outcome()
+                headers = {}
+                if status == 429:
+                    headers['Retry-After'] = str(mock.retry_after)
+                    payload = {"errorMessage": "Rate limit exceeded"}
+                elif status == 503:
+                    payload = {"errorMessage": "Service unavailable"}
+                elif self.path.endswith("/rest/api/2/issue/bulk"):
+                    count = len(json.loads(body).get("issueUpdates", []))
+                    payload = {"issues": [{"id": key.split("-")[1], "key": key, "self": ""}
+                                          for key in mock._next_key(count)], "errors": []}
+                elif self.path.endswith("/rest/servicedeskapi/request"):
+                    payload = {"issueKey": mock._next_key()[0]}
+                else:
+                    status, payload = 404, {"errorMessage": f"No mock for {self.path}"}
+                self._send(status, payload, headers)
+
+            def do_GET(self):
+                if self.path == "/stats":
+                    with mock.lock:
+                        self._send(200, dict(mock.stats))
+                else:
+                    self._send(404, {"errorMessage": f"No mock for {self.path}"})
+
+            def _send(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=50, help="mean response time in ms")
+    parser.add_argument("--jitter", type=float, default=0.5, help="latency spread as a fraction of the mean")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered 429")
+    parser.add_argument("--max-rps", type=float, default=None, help="answer 429 above this many requests/sec")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds on 429")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    mock = MockJira(args.host, args.port, latency=args.latency / 1000, jitter=args.jitter,
+                    error_rate=args.error_rate, throttle_rate=args.throttle_rate, max_rps=args.max_rps,
+                    retry_after=args.retry_after, seed=args.seed)
+    print(f"Mock Jira listening on {mock.url} (GET /stats for counters)")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import json
+import logging
+import string
+from operator import attrgetter
+from json.encoder import encode_basestring_ascii
+
+logger = logging.getLogger(__name__)
+
+TEMPORARY_USE = "Temporary use (three months or less)"
+
+# Jira form answers keyed by the form's field id, and the phonerequest column each comes from.
+#   text/date     - the column value as is
+#   choice        - the column value looked up in `choices`; unknown values reject the row
+#   multi_choice  - the column split on `separator`, each item looked up in `choices`;
+#                   unknown items are dropped
+#   only_if       - only answer when another column equals a value and this one is set
+#   required      - rows where this column is blank (or, for multi_choice, has no known
+#                   item) are rejected by validation.BatchValidator before any request
+DEFAULT_FORM_SCHEMA = {
+    "summary": "Phone equipment order - {newusername}",
+    "description": "Equipment request for {newusername} in {departmentname}",
+    "answers": [
+        # First section of form- Person making the request
+        {"id": "199", "column": "newusername", "type": "text", "required": True},
+        {"id": "200", "column": "job", "type": "text"},
+        {"id": "201", "column": "phonenumber", "type": "text"},
+        {"id": "202", "column": "emailaddress", "type": "text", "required": True},
+        {"id": "203", "column": "departmentname", "type": "text", "required": True},
+        {"id": "204", "column": "costcenter", "type": "text"},
+
+        # Telephone lines and installations
+        {"id": "157", "column": "telephonelinesandinstallations", "type": "choice", "choices": {
+            "New extension including new cabling and socket": "160",
+            "New extension to an existing, inactive socket": "161",
+            "Relocate existing to a new location": "182",
+            "Convert existing extension from analogue to digital": "190",
+            "Relocate an existing extension to an existing inactive, socket": "191",
+            "Swap of telephone extensions": "192",
+            "Other... (multi-line hunt group setup)": "0"
+        }},
+
+        # Handsets and Headsets
+        {"id": "159", "column": "handsetsandheadsets", "type": "multi_choice", "separator": ";",
+         "required": True, "choices": {
+            "Handset speaker phone": "164",
+            "Cordless headset": "165",
+            "Cordless handset": "166",
+            "Mobile phone": "167",
+            "Smartphone": "168",
+            "SIM card only": "194",
+            "Other...": "0"
+        }},
+
+        # Time frame
+        {"id": "205", "column": "timeframe", "type": "choice", "choices": {
+            TEMPORARY_USE: "183",
+            "Permanent use": "184"
+        }},
+        {"id": "206", "column": "dateneededby", "type": "date", "required": True},
+
+        # Comments
+        {"id": "189", "column": "Comments", "type": "text"},
+
+        # Approximate ending date, temporary use only
+        {"id": "197", "column": "approximateendingdate", "type": "date",
+         "only_if": {"column": "timeframe", "equals": TEMPORARY_USE}}
+    ]
+}
+
+
+class PayloadError(ValueError):
+    """A row cannot be mapped to the Jira form (e.g. an unknown choice)."""
+
+
+def load_form_schema(path=None):
+    """Load the form schema from a JSON file, or the built-in default."""
+    if not path:
+        return DEFAULT_FORM_SCHEMA
+    with open(path, 'r', encoding='utf-8') as file:
+        schema = json.load(file)
+    logger.info(f"Loaded form schema from {path}")
+    return schema
+
+
+def _encode(value):
+    """JSON-encode a scalar the way json.dumps would, dates as ISO strings."""
+    if value is None:
+        return "null"
+    if not isinstance(value, str):
+        value = value.isoformat() if hasattr(value, "isoformat") else str(value)
+    return encode_basestring_ascii(value)
+
+
+class PayloadCompiler:
+    """
+    Turns phonerequest rows into ready-to-send Jira request bodies.
+
+    The form schema is compiled once: every constant part of the JSON document
+    (keys, ids, choice lists) is pre-encoded, so building a payload only encodes
+    the row's own values and joins fragments. `build_batch` renders a whole batch
+    column by column and returns UTF-8 bytes per row.
+    """
+
+    def __init__(self, service_desk_id, request_type_id, schema=DEFAULT_FORM_SCHEMA):
+        self.summary = _compile_template(schema["summary"])
+        self.description = _compile_template(schema["description"])
+        self.head = (
+            '{"serviceDeskId":' + _encode(service_desk_id)
+            + ',"requestTypeId":' + _encode(request_type_id)
+            + ',"requestFieldValues":{"summary":'
+        )
+        self.fields = [self._compile_field(field) for field in schema["answers"]]
+
+    @staticmethod
+    def _compile_field(field):
+        kind = field["type"]
+        compiled = {
+            "kind": kind,
+            "column": field["column"],
+            "only_if": field.get("only_if")
+        }
+
+        if kind == "text":
+            compiled["prefix"] = f'"{field["id"]}":{{"text":'
+        elif kind == "date":
+            compiled["prefix"] = f'"{field["id"]}":{{"date":'
+        elif kind == "choice":
+            # Whole answer pre-encoded per choice
+            compiled["answers"] = {
+                label: f'"{field["id"]}":{{"choices":[{_encode(choice)}]}}'
+                for label, choice in field["choices"].items()
+            }
+        elif kind == "multi_choice":
+            compiled["prefix"] = f'"{field["id"]}":{{"choices":['
+            compiled["separator"] = field.get("separator", ";")
+            compiled["choices"] = {label: _encode(choice) for label, choice in field["choices"].items()}
+        else:
+            raise ValueError(f"Unknown form field type '{kind}' for answer {field['id']}")
+        return compiled
+
+    def _render_column(self, field, rows, errors):
+        """Render one answer for every row; failed rows get their error recorded."""
+        column = field["column"]
+        values = [getattr(row, column) for row in rows]
+        kind = field["kind"]
+
+        if kind in ("text", "date"):
+            prefix = field["prefix"]
+            fragments = [prefix + (encode_basestring_ascii(value) if value.__class__ is str else _encode(value)) + "}"
+                         for value in values]
+        elif kind == "choice":
+            answers = field["answers"]
+            fragments = []
+            for index, value in enumerate(values):
+                fragment = answers.get(value)
+                if fragment is None:
+                    errors[index] = errors[index] or f"Unknown {column} '{value}'"
+                fragments.append(fragment)
+        else:
+            prefix = field["prefix"]
+            separator = field["separator"]
+            choices = field["choices"]
+            fragments = []
+            for index, value in enumerate(values):
+                if value is None:
+                    errors[index] = errors[index] or f"Missing {column}"
+                    fragments.append(None)
+                    continue
+                items = [choices[item] for item in (part.strip() for part in value.split(separator))
+                         if item in choices]
+                fragments.append(prefix + ",".join(items) + "]}")
+
+        only_if = field["only_if"]
+        if only_if:
+            guard = [getattr(row, only_if["column"]) == only_if["equals"] for row in rows]
+            fragments = [fragment if keep and value else None
+                         for fragment, keep, value in zip(fragments, guard, values)]
+        return fragments
+
+    def build_batch(self, rows):
+        """
+        Build payloads for a batch of rows.
+
+        Returns a list of (payload_bytes, error) in row order; exactly one of the
+        two is None.
+        """
+        rows = list(rows)
+        errors = [None] * len(rows)
+        answer_columns = [self._render_column(field, rows, errors) for field in self.fields]
+        answers = zip(*answer_columns) if answer_columns else [()] * len(rows)
+        summaries = [encode_basestring_ascii(text) for text in _render_template(self.summary, rows)]
+        descriptions = [encode_basestring_ascii(text) for text in _render_template(self.description, rows)]
+
+        head = self.head
+        payloads = []
+        for error, summary, description, parts in zip(errors, summaries, descriptions, answers):
+            if error:
+                payloads.append((None, error))
+                continue
+            document = (
+                head + summary + ',"description":' + description
+                + '},"form":{"answers":{' + ",".join(filter(None, parts)) + '}}}'
+            )
+            payloads.append((document.encode("ascii"), None))
+        return payloads
+
+    def _render_answer_lines(self, field, rows, errors):
+        """Render one answer as a "column: value" description line for every row."""
+        column = field["column"]
+        values = [getattr(row, column) for row in rows]
+        if field["kind"] == "choice":
+            answers = field["answers"]
+            for index, value in enumerate(values):
+                if value not in answers:
+                    errors[index] = errors[index] or f"Unknown {column} '{value}'"
+
+        lines = [None if value is None or value == "" else
+                 f"{column}: {value.isoformat() if hasattr(value, 'isoformat') else value}"
+                 for value in values]
+        only_if = field["only_if"]
+        if only_if:
+            lines = [line if getattr(row, only_if["column"]) == only_if["equals"] else None
+                     for line, row in zip(lines, rows)]
+        return lines
+
+    def build_issue_batch(self, rows, project_key, issue_type_id):
+        """
+        Build plain Jira issue documents (`{"fields": ...}`) for the bulk create API.
+
+        Form answers only exist in the service desk form API, so here they are
+        written into the description as one "column: value" line each.
+        Returns a list of (payload_bytes, error) in row order, like build_batch.
+        """
+        rows = list(rows)
+        errors = [None] * len(rows)
+        answer_lines = [self._render_answer_lines(field, rows, errors) for field in self.fields]
+        answers = zip(*answer_lines) if answer_lines else [()] * len(rows)
+        summaries = _render_template(self.summary, rows)
+        descriptions = _render_template(self.description, rows)
+
+        head = (
+            '{"fields":{"project":{"key":' + _encode(project_key)
+            + '},"issuetype":{"id":' + _encode(issue_type_id)
+            + '},"summary":'
+        )
+        payloads = []
+        for error, summary, description, lines in zip(errors, summaries, descriptions, answers):
+            if error:
+                payloads.append((None, error))
+                continue
+            description = description + "\n\n" + "\n".join(filter(None, lines))
+            document = (
+                head + encode_basestring_ascii(summary)
+                + ',"description":' + encode_basestring_ascii(description) + '}}'
+            )
+            payloads.append((document.encode("ascii"), None))
+        return payloads
+
+    def build(self, row):
+        """Build one payload, raising PayloadError if the row cannot be mapped."""
+        payload, error = self.build_batch([row])[0]
+        if error:
+            raise PayloadError(error)
+        return payload
+
+
+def _compile_template(template):
+    """
+    Turn a str.format template with column names into a positional template
+    plus a getter for those columns, so rendering needs no per-row dict.
+    """
+    columns = []
+    parts = []
+    for literal, name, spec, conversion in string.Formatter().parse(template):
+        parts.append(literal.replace("{", "{{").replace("}", "}}"))
+        if name is not None:
+            if name not in columns:
+                columns.append(name)
+            parts.append("{" + str(columns.index(name))
+                         + (f"!{conversion}" if conversion else "")
+                         + (f":{spec}" if spec else "") + "}")
+    getter = attrgetter(*columns) if columns else None
+    return "".join(parts), getter, len(columns)
+
+
+def _render_template(compiled, rows):
+    """Render a compiled template for every row."""
+    template, getter, count = compiled
+    if count == 0:
+        return [template] * len(rows)
+    if count == 1:
+        return [template.format(getter(row)) for row in rows]
+    return [template.format(*getter(row)) for row in rows]
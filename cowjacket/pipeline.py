@@ -0,0 +1,145 @@
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Items each queue between two stages can hold before the upstream stage blocks
+DEFAULT_QUEUE_SIZE = 2
+# How often blocked stages check whether the pipeline is stopping
+POLL_INTERVAL = 0.1
+
+# Marks the end of a stage's output
+DONE = object()
+
+
+class PipelineStopped(Exception):
+    """Raised inside a stage when another stage has failed."""
+
+
+class Pipeline:
+    """
+    Chain of stages, each running in its own thread, connected by bounded queues.
+
+    A source feeds items from an iterable; every stage takes items from the
+    previous queue, passes them to its function and puts the result (if not
+    None) on the next queue. Full queues block the stage upstream, so a run
+    moves at the pace of its slowest stage while the others overlap with it.
+    The first exception in any stage stops every other stage and is re-raised
+    from `run`.
+    """
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.stop = threading.Event()
+        self.errors = []
+        self.threads = []
+        # Per stage: items handled and seconds spent in the stage function
+        self.stats = {}
+
+    def source(self, name, iterable):
+        """Add a stage that feeds `iterable` into the pipeline; returns its output queue."""
+        outbox = queue.Queue(maxsize=self.queue_size)
+
+        def run():
+            iterator = iter(iterable)
+            try:
+                while True:
+                    start = time.perf_counter()
+                    item = next(iterator, DONE)
+                    self._count(name, start, item is not DONE)
+                    if item is DONE:
+                        break
+                    self.put(outbox, item)
+            finally:
+                close = getattr(iterator, "close", None)
+                if close:
+                    close()
+            self.put(outbox, DONE)
+
+        self._start(name, run)
+        return outbox
+
+    def stage(self, name, fn, inbox, output=True):
+        """
+        Add a stage applying `fn` to every item from `inbox`. Returns its output
+        queue, or None for the last stage (`output=False`).
+        """
+        outbox = queue.Queue(maxsize=self.queue_size) if output else None
+
+        def run():
+            while True:
+                item = self.get(inbox)
+                if item is DONE:
+                    break
+                start = time.perf_counter()
+                result = fn(item)
+                self._count(name, start)
+                if outbox is not None and result is not None:
+                    self.put(outbox, result)
+            if outbox is not None:
+                self.put(outbox, DONE)
+
+        self._start(name, run)
+        return outbox
+
+    def put(self, target, item):
+        """Put on a bounded queue, giving up if the pipeline stops."""
+        while True:
+            try:
+                target.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                if self.stop.is_set():
+                    raise PipelineStopped()
+
+    def get(self, source):
+        """Take from a queue, giving up if the pipeline stops."""
+        while True:
+            try:
+                return source.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self.stop.is_set():
+                    raise PipelineStopped()
+
+    def acquire(self, semaphore):
+        """Acquire a semaphore shared with worker threads, giving up if the pipeline stops."""
+        while not semaphore.acquire(timeout=POLL_INTERVAL):
+            if self.stop.is_set():
+                raise PipelineStopped()
+
+    def run(self):
+        """Wait for every stage to finish; re-raise the first stage error."""
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def _start(self, name, target):
+        self.stats[name] = {'items': 0, 'seconds': 0.0}
+
+        def guarded():
+            try:
+                target()
+            except PipelineStopped:
+                pass
+            except Exception as e:
+                logger.error(f"Pipeline stage {name} failed: {e}", exc_info=True)
+                self.errors.append(e)
+                self.stop.set()
+
+        thread = threading.Thread(target=guarded, name=f"pipeline-{name}", daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def _count(self, name, start, item=True):
+        stats = self.stats[name]
+        stats['seconds'] += time.perf_counter() - start
+        if item:
+            stats['items'] += 1
+
+    def summary(self):
+        """One line with each stage's item count and busy time."""
+        return ", ".join(f"{name} {stats['items']} items in {stats['seconds']:.2f}s"
+                         for name, stats in self.stats.items())
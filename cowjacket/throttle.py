@@ -0,0 +1,92 @@
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveThrottler:
+    """
+    Token-bucket rate limiter whose rate is tuned with AIMD
+    (additive increase, multiplicative decrease).
+
+    Every clean second of responses raises the rate by `increase_step` requests/sec
+    up to `max_rate`; a 429 cuts it by `decrease_factor` down to `min_rate` and
+    pauses all callers until the server's Retry-After has passed. The rate is cut
+    at most once per second, so the 429s of one burst, seen by several workers
+    at once, count as one; the others only extend the pause. The rate settles
+    around the largest throughput Jira accepts. The burst follows the rate both
+    ways (never below `burst`), so a cut rate can't be undone by a stored-up
+    burst. Safe to share between threads.
+    """
+
+    def __init__(self, rate=10.0, min_rate=0.5, max_rate=50.0, increase_step=1.0,
+                 decrease_factor=0.5, burst=None):
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.increase_step = float(increase_step)
+        self.decrease_factor = float(decrease_factor)
+        # Smallest burst; the burst is otherwise one second's worth of the current rate
+        self.min_burst = float(burst) if burst else 1.0
+        self.burst = max(self.min_burst, self.rate)
+
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.last_increase = self.last_refill
+        self.last_decrease = float('-inf')
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+        # Counters reported at the end of a run
+        self.throttle_wait = 0.0
+        self.throttled = 0
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """Block until a request may be sent. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.throttle_wait += waited
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def on_success(self):
+        """Additive increase, at most once per second."""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_increase >= 1.0 and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase_step)
+                self.burst = max(self.min_burst, self.rate)
+                self.last_increase = now
+
+    def on_throttle(self, retry_after=None):
+        """Multiplicative decrease, at most once per second, and pause everyone for `retry_after` seconds."""
+        with self.lock:
+            now = time.monotonic()
+            self.throttled += 1
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if now - self.last_decrease < 1.0:
+                return
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.burst = max(self.min_burst, self.rate)
+            self.tokens = min(self.tokens, 0.0)
+            self.last_increase = now
+            self.last_decrease = now
+            logger.warning(f"Jira rate limit hit; throttling to {self.rate:.2f} requests/sec"
+                           + (f" and pausing {retry_after:.1f}s" if retry_after else ""))
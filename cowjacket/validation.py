@@ -0,0 +1,82 @@
+import hashlib
+import logging
+from datetime import date, datetime
+
+logger = logging.getLogger(__name__)
+
+# Row key keyset pagination selects after the row's columns; not part of its content
+PAGE_KEY_COLUMN = "page_key"
+
+
+def row_fingerprint(row):
+    """
+    Digest of every column of a fetched row, so a rejected row is only
+    revalidated once something in it changes.
+    """
+    if getattr(row, "_fields", ())[-1:] == (PAGE_KEY_COLUMN,):
+        row = row[:-1]
+    joined = "\x1f".join("" if value is None else str(value) for value in row)
+    return hashlib.sha256(joined.encode()).digest()
+
+
+def _is_blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _is_date(value):
+    if isinstance(value, (date, datetime)):
+        return True
+    try:
+        datetime.fromisoformat(str(value))
+    except ValueError:
+        return False
+    return True
+
+
+class BatchValidator:
+    """
+    Checks a whole batch of phonerequest rows against the form schema before any
+    payload is built or request sent.
+
+    Rules come from the schema: fields marked `required` must be non-blank,
+    `choice` values must be a known label, `multi_choice` values must contain at
+    least one known label when required, and `date` values must be ISO dates.
+    Rows are checked column by column and every failure is reported, not just
+    the first one.
+    """
+
+    def __init__(self, schema):
+        self.fields = schema["answers"]
+
+    def validate(self, rows):
+        """
+        Return a list of rejection reasons per row, in row order; an empty list
+        means the row is valid.
+        """
+        rows = list(rows)
+        reasons = [[] for _ in rows]
+
+        for field in self.fields:
+            column = field["column"]
+            kind = field["type"]
+            required = field.get("required", False)
+            only_if = field.get("only_if")
+            values = [getattr(row, column) for row in rows]
+
+            for index, value in enumerate(values):
+                if only_if and getattr(rows[index], only_if["column"]) != only_if["equals"]:
+                    continue
+                if _is_blank(value):
+                    if required or kind == "choice":
+                        reasons[index].append(f"Missing {column}")
+                    continue
+                if kind == "choice" and value not in field["choices"]:
+                    reasons[index].append(f"Unknown {column} '{value}'")
+                elif kind == "multi_choice" and required:
+                    separator = field.get("separator", ";")
+                    if not any(part.strip() in field["choices"] for part in value.split(separator)):
+                        reasons[index].append(f"No known {column} in '{value}'")
+                elif kind == "date" and not _is_date(value):
+                    reasons[index].append(f"Invalid {column} '{value}'")
+
+        return reasons
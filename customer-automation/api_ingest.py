@@ -3,6 +3,7 @@ import requests
 import json
 import os
 from dotenv import load_dotenv
+from log_config import setup_logging
 from datetime import datetime
 
 # Setup directories
@@ -16,12 +17,8 @@ OUTPUT_PATH = os.path.join(OUTPUT_DIR, OUTPUT_FILE)
 os.makedirs(LOG_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# logging config
-logging.basicConfig(
-    filename=LOG_PATH,
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# logging config: queued and written by a background thread (log_config.py)
+setup_logging(LOG_PATH)
 logger = logging.getLogger(__name__)
 
 # load enviroment
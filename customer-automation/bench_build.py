@@ -0,0 +1,91 @@
+"""
+Benchmark building subscriber emails, without sending them.
+
+"before" builds each email the way send_email_config used to: render both
+templates, build the MIMEMultipart tree, and flatten it to bytes as
+SMTP.send_message does. "after" is EmailTemplate.build, which returns the
+same bytes-on-the-wire form. Reported as messages per second.
+
+Usage:
+    python bench_build.py --messages 20000 --repeat 5
+"""
+import argparse
+import io
+import time
+from email.generator import BytesGenerator
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formataddr
+from email_template import EmailTemplate, HTML_TEMPLATE, TEXT_TEMPLATE
+
+QUOTE = "The only way to do great work is to love what you do."
+AUTHOR = "Steve Jobs"
+SENDER = "mindfuel@example.com"
+NAMES = ("Ada", "Bolade", "Chen", "Dara", "Zoë", "O'Brien", "", None)
+
+
+def legacy_build(name, email):
+    """The message build send_email_config did per recipient and attempt before EmailTemplate."""
+    message = MIMEMultipart('related')
+    message['From'] = formataddr(('MindFuel', SENDER))
+    message['To'] = email
+    message['Subject'] = "Inspiration from MindFuel"
+    msg_alternative = MIMEMultipart('alternative')
+    message.attach(msg_alternative)
+    html_body = HTML_TEMPLATE.format(name=name, quote=QUOTE, author=AUTHOR)
+    text_body = TEXT_TEMPLATE.format(name=name, quote=QUOTE, author=AUTHOR)
+    msg_alternative.attach(MIMEText(text_body, 'plain'))
+    msg_alternative.attach(MIMEText(html_body, 'html'))
+    return message
+
+
+def legacy_flatten(message):
+    """What SMTP.send_message does with the message before sending it."""
+    with io.BytesIO() as output:
+        BytesGenerator(output).flatten(message, linesep='\r\n')
+        return output.getvalue()
+
+
+def timed(cases, recipients, repeat):
+    """Best time of each case over `repeat` rounds; cases take turns so machine noise hits them alike."""
+    best = [float("inf")] * len(cases)
+    for _ in range(repeat):
+        for index, (_, build) in enumerate(cases):
+            start = time.perf_counter()
+            for name, email in recipients:
+                build(name, email)
+            best[index] = min(best[index], time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5, help="timing repeats (best is reported)")
+    args = parser.parse_args()
+
+    recipients = [(NAMES[i % len(NAMES)], f"user{i}@example.com") for i in range(args.messages)]
+    setup_start = time.perf_counter()
+    template = EmailTemplate(QUOTE, AUTHOR, SENDER)
+    setup = time.perf_counter() - setup_start
+
+    # A NULL first_name must build, as the empty name does, rather than fail the send
+    assert template.build(None, "user@example.com") == template.build("", "user@example.com")
+
+    cases = (
+        ("before: MIME tree", legacy_build),
+        ("before: MIME tree + flatten", lambda name, email: legacy_flatten(legacy_build(name, email))),
+        ("after: EmailTemplate.build", template.build),
+    )
+    print(f"{args.messages} messages, best of {args.repeat} "
+          f"(EmailTemplate set up once in {setup * 1000:.2f} ms)\n")
+    print(f"{'':30} {'messages/s':>12} {'us/message':>11}")
+    timings = timed(cases, recipients, args.repeat)
+    baseline = timings[1]
+    for (label, _), seconds in zip(cases, timings):
+        print(f"{label:30} {args.messages / seconds:>12,.0f} {seconds / args.messages * 1e6:>11.1f}"
+              f"   ({baseline / seconds:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
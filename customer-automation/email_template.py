@@ -0,0 +1,215 @@
+"""
+MindFuel email templates, rendered once per run.
+
+The quote and author are the same for every subscriber, so EmailTemplate
+renders and base64 encodes everything but the subscriber's name once, and
+`build` only encodes the name and the few bytes around it before joining the
+pieces. Quote, author and name are HTML-escaped in the HTML part.
+"""
+import base64
+import secrets
+from email.header import Header
+from email.utils import formataddr
+from html import escape
+
+HTML_TEMPLATE = """
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>MindFuel Email</title>
+    </head>
+    <body style="margin: 0; padding: 0; font-family: Arial, sans-serif; background-color: #f4f4f4;">
+        <table role="presentation" style="width: 100%; border-collapse: collapse;">
+            <tr>
+                <td align="center" style="padding: 40px 0;">
+                    <table role="presentation" style="width: 600px; border-collapse: collapse; background-color: #ffffff; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
+                        <!-- Header -->
+                        <tr>
+                            <td style="padding: 40px 40px 20px 40px; text-align: center;">
+                                <h1 style="margin: 0; font-size: 28px; font-weight: bold; color: #333333;">MINDFUEL</h1>
+                            </td>
+                        </tr>
+                        
+                        <!-- Main Content -->
+                        <tr>
+                            <td style="padding: 20px 40px;">
+                                <h2 style="margin: 0 0 20px 0; font-size: 22px; font-weight: bold; color: #333333; text-align: center;">
+                                    STRENGTH STARTS<br>FROM THE MIND
+                                </h2>
+                                
+                                <p style="margin: 0 0 30px 0; font-size: 16px; color: #666666; text-align: center; font-weight: bold;">
+                                    DAILY QUOTE TO KEEP YOU GOING
+                                </p>
+                                
+                                <p style="margin: 0 0 20px 0; font-size: 15px; color: #333333; line-height: 1.6;">
+                                    Hi {name},
+                                </p>
+                                
+                                <p style="margin: 0 0 30px 0; font-size: 15px; color: #333333; line-height: 1.6;">
+                                    Here's something to get your day started.
+                                </p>
+                                
+                                <div style="background-color: #f8f8f8; padding: 30px; margin: 0 0 20px 0; border-left: 4px solid #4CAF50; border-radius: 4px;">
+                                    <p style="margin: 0 0 15px 0; font-size: 18px; color: #333333; line-height: 1.8; font-style: italic;">
+                                        {quote}
+                                    </p>
+                                    <p style="margin: 0; font-size: 14px; color: #666666; text-align: right;">
+                                        - {author}
+                                    </p>
+                                </div>
+                                
+                                <p style="margin: 30px 0 0 0; font-size: 15px; color: #333333; line-height: 1.6;">
+                                    Best Regards,<br>
+                                    <strong>MindFuel</strong>
+                                </p>
+                            </td>
+                        </tr>
+                        
+                        <!-- Footer -->
+                        <tr>
+                            <td style="padding: 30px 40px; background-color: #f8f8f8; border-top: 1px solid #e0e0e0;">
+                                <p style="margin: 0 0 10px 0; font-size: 16px; color: #333333; font-weight: bold;">
+                                    MindFuel
+                                </p>
+                                <p style="margin: 0 0 15px 0; font-size: 13px; color: #666666; line-height: 1.6;">
+                                    Suite 123, 123 Anywhere Street,<br>
+                                    Any City, ST 12345
+                                </p>
+                                <p style="margin: 0; font-size: 12px; color: #999999; line-height: 1.6;">
+                                    You're receiving this email because you signed up for updates from MindFuel.
+                                </p>
+                            </td>
+                        </tr>
+                    </table>
+                </td>
+            </tr>
+        </table>
+    </body>
+    </html>
+    """
+
+TEXT_TEMPLATE = """
+    MINDFUEL
+    STRENGTH STARTS FROM THE MIND
+    DAILY QUOTE TO KEEP YOU GOING
+
+    Hi {name},
+
+    Here's something to get your day started.
+
+    "{quote}"
+    - {author}
+
+    Best Regards,
+    MindFuel
+
+    MindFuel
+    Suite 123, 123 Anywhere Street,
+    Any City, ST 12345
+
+    You're receiving this email because you signed up for updates from MindFuel.
+    """
+
+# base64 turns every 57 bytes into one 76 character line
+BASE64_LINE_BYTES = 57
+
+
+class _Base64Body:
+    """
+    A body with `name` slots, base64 encoded as it would be whole. The full
+    lines before the first slot are encoded once. So is everything after the
+    last slot, once for each position it can start at within a line, the
+    first time that position comes up. Only the bytes around the names are
+    encoded per message.
+    """
+
+    def __init__(self, segments):
+        segments = [segment.encode('utf-8') for segment in segments]
+        if len(segments) < 2:
+            raise ValueError("Template has no name slot")
+        split = len(segments[0]) // BASE64_LINE_BYTES * BASE64_LINE_BYTES
+        self.head = _encode(segments[0][:split])
+        self.middle = [segments[0][split:]] + segments[1:-1]
+        self.last = segments[-1]
+        # Offset of the last segment within its line -> (bytes to encode per message, the rest encoded)
+        self.tails = {}
+
+    def parts(self, name):
+        """The encoded body for `name` (UTF-8 bytes), in pieces to be joined."""
+        start = name.join(self.middle) + name
+        offset = len(start) % BASE64_LINE_BYTES
+        tail = self.tails.get(offset)
+        if tail is None:
+            cut = (BASE64_LINE_BYTES - offset) % BASE64_LINE_BYTES
+            tail = self.tails[offset] = (self.last[:cut], _encode(self.last[cut:]))
+        lead, rest = tail
+        return self.head, _encode(start + lead), rest
+
+
+def _encode(data):
+    """base64 in 76 character lines, each ending in CRLF."""
+    return base64.encodebytes(data).replace(b'\n', b'\r\n')
+
+
+class EmailTemplate:
+    """
+    The day's email for `quote` and `author`, ready to be addressed.
+
+    `build(name, email)` returns the complete message as bytes (CRLF line
+    endings, text and HTML alternatives in UTF-8), for SMTP sendmail.
+    """
+
+    def __init__(self, quote, author, sender_email, sender_name='MindFuel',
+                 subject="Inspiration from MindFuel"):
+        self.sender_email = sender_email
+        # Splits the rendered templates where the name goes; never part of a real quote
+        slot = f"\x00{secrets.token_hex(8)}\x00"
+        # Text parts are encoded with CRLF line endings, their canonical form
+        html = HTML_TEMPLATE.format(name=slot, quote=escape(quote), author=escape(author)).replace('\n', '\r\n')
+        text = TEXT_TEMPLATE.format(name=slot, quote=quote, author=author).replace('\n', '\r\n')
+        self.html = _Base64Body(html.split(slot))
+        self.text = _Base64Body(text.split(slot))
+
+        related = f"===============mindfuel-{secrets.token_hex(12)}=="
+        alternative = f"===============mindfuel-{secrets.token_hex(12)}=="
+        if not subject.isascii():
+            subject = Header(subject, 'utf-8').encode(linesep='\r\n')
+        self.head = (
+            f'Content-Type: multipart/related; boundary="{related}"\r\n'
+            f'MIME-Version: 1.0\r\n'
+            f'From: {formataddr((sender_name, sender_email))}\r\n'
+            f'To: '
+        ).encode('ascii')
+        self.after_to = (
+            f'\r\nSubject: {subject}\r\n'
+            f'\r\n'
+            f'--{related}\r\n'
+            f'Content-Type: multipart/alternative; boundary="{alternative}"\r\n'
+            f'\r\n'
+            f'--{alternative}\r\n'
+            f'Content-Type: text/plain; charset="utf-8"\r\n'
+            f'Content-Transfer-Encoding: base64\r\n'
+            f'\r\n'
+        ).encode('ascii')
+        self.between = (
+            f'--{alternative}\r\n'
+            f'Content-Type: text/html; charset="utf-8"\r\n'
+            f'Content-Transfer-Encoding: base64\r\n'
+            f'\r\n'
+        ).encode('ascii')
+        self.tail = f'--{alternative}--\r\n\r\n--{related}--\r\n'.encode('ascii')
+
+    def build(self, name, email):
+        """The message for subscriber `name` at `email`. A missing name (NULL first_name) is left blank."""
+        if '\r' in email or '\n' in email:
+            raise ValueError(f"Invalid email address {email!r}")
+        name = '' if name is None else str(name)
+        return b''.join((
+            self.head, email.encode('utf-8'), self.after_to,
+            *self.text.parts(name.encode('utf-8')),
+            self.between,
+            *self.html.parts(escape(name).encode('utf-8')),
+            self.tail
+        ))
@@ -6,9 +6,15 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.utils import formataddr
 from dotenv import load_dotenv
+from log_config import setup_logging
+from smtp_client import SMTPConnection, SenderPool, is_permanent
+from throttle import TokenBucket
+from email_template import EmailTemplate
+from send_ledger import SendLedger
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
+from functools import partial
 import time
 
 # Initialise load_dotenv()
@@ -23,12 +29,8 @@ SUMMARY_LOG_PATH = os.path.join(LOG_DIR, SUMMARY_LOG_FILE)
 os.makedirs(LOG_DIR, exist_ok=True)
 
 
-#logging config
-logging.basicConfig(
-    filename=LOG_PATH,
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+#logging config: queued and written by a background thread (log_config.py)
+setup_logging(LOG_PATH)
 logger = logging.getLogger(__name__)
 
 # Create logger for summary stats
@@ -45,6 +47,10 @@ SENDER_PASSWORD = os.getenv('SENDER_PASSWORD')
 SMTP_SERVER = os.getenv('SMTP_SERVER')
 SMTP_PORT = int(os.getenv('SMTP_PORT'))
 SMTP_TIMEOUT = int(os.getenv('SMTP_TIMEOUT'))
+# One authenticated connection is reused for many emails; it is replaced after
+# this many emails or seconds
+SMTP_MAX_MESSAGES = int(os.getenv('SMTP_MAX_MESSAGES', 100))
+SMTP_MAX_AGE = int(os.getenv('SMTP_MAX_AGE', 300))
 # Set database credentials and file path
 DB_CREDENTIALS = os.getenv('DB_CREDENTIALS')
 FILE_PATH = os.getenv('FILE_PATH') # Path to quotes file
@@ -56,11 +62,23 @@ SEND_ALERTS = os.getenv('SEND_ALERTS').lower() == 'true'
 # Email configuration
 MAX_RETRIES = 3
 RETRY_DELAY = 2  # seconds 
-RATE_LIMIT_DELAY = 0.1  # seconds between emails (10 emails/second)
+# Emails are sent from SEND_WORKERS threads, each on its own SMTP connection,
+# at most SEND_RATE emails/second between them (0 for no limit)
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))
+SEND_RATE = float(os.getenv('SEND_RATE', 10))
+# Send each worker's emails in groups of SMTP_PIPELINE_SIZE, pipelining the
+# SMTP commands when the server supports it
+SMTP_PIPELINING = os.getenv('SMTP_PIPELINING', 'false').lower() == 'true'
+SMTP_PIPELINE_SIZE = int(os.getenv('SMTP_PIPELINE_SIZE', 50))
+# Who was sent today's email, so a rerun after a crash skips them
+SEND_LEDGER_PATH = os.getenv('SEND_LEDGER_PATH', 'send_ledger.db')
 
 # For user batch processing
 CHUNK_SIZE = 1000
 
+# Pagination strategy for reading users: "keyset" (default) or "offset"
+PAGINATION_MODE = os.getenv('PAGINATION_MODE', 'keyset')
+
 # Create database engine
 try:
     logger.info("=" * 30)
@@ -77,32 +95,54 @@ except Exception as e:
 
 
 
-def fetch_users_in_batches(email_frequency, batch_size=CHUNK_SIZE):
+def fetch_users_in_batches(email_frequency, batch_size=CHUNK_SIZE, pagination=PAGINATION_MODE):
     """
     Fetch users in batches from database.
+
+    With keyset pagination each page resumes after the last email_address seen
+    instead of using OFFSET, so later pages don't rescan the earlier ones.
+    email_address is unique and NOT NULL, so the seek can't skip or stop on a
+    row (first_name may be NULL, and a NULL never compares greater).
     """
     if not Session:
         raise Exception("Database session not initialised")
     
     offset = 0
+    last_email = None
     total_fetched = 0
     
     while True:
         try:
             with Session() as session:
-                query = text("""
-                    SELECT first_name, email_address
-                    FROM users
-                    WHERE subscription_status = 'active'
-                        AND email_frequency = :frequency
-                    ORDER BY first_name
-                    LIMIT :limit OFFSET :offset;
-                """)
+                params = {"frequency": email_frequency, "limit": batch_size}
+                if pagination == "keyset":
+                    # Resume from the last row of the previous page
+                    seek_clause = ""
+                    if last_email is not None:
+                        seek_clause = "AND email_address > :last_email"
+                        params["last_email"] = last_email
+
+                    query = text(f"""
+                        SELECT first_name, email_address
+                        FROM users
+                        WHERE subscription_status = 'active'
+                            AND email_frequency = :frequency
+                            {seek_clause}
+                        ORDER BY email_address
+                        LIMIT :limit;
+                    """)
+                else:
+                    query = text("""
+                        SELECT first_name, email_address
+                        FROM users
+                        WHERE subscription_status = 'active'
+                            AND email_frequency = :frequency
+                        ORDER BY first_name, email_address
+                        LIMIT :limit OFFSET :offset;
+                    """)
+                    params["offset"] = offset
                 
-                result = session.execute(
-                    query,
-                    {"frequency": email_frequency, "limit": batch_size, "offset": offset}
-                )
+                result = session.execute(query, params)
                 
                 batch = [dict(row._mapping) for row in result]
                 
@@ -120,6 +160,7 @@ def fetch_users_in_batches(email_frequency, batch_size=CHUNK_SIZE):
                     break
                 
                 offset += batch_size
+                last_email = batch[-1]['email_address']
                 
         except Exception as e:
             logger.error(f"Failed to fetch users batch: {e}", exc_info=True)
@@ -127,139 +168,15 @@ def fetch_users_in_batches(email_frequency, batch_size=CHUNK_SIZE):
 
 
 
-def email_template(recipient_name, quote, author):
-    """Generate HTML and plain text email templates."""
-    # HTML email template
-    html_body = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>MindFuel Email</title>
-    </head>
-    <body style="margin: 0; padding: 0; font-family: Arial, sans-serif; background-color: #f4f4f4;">
-        <table role="presentation" style="width: 100%; border-collapse: collapse;">
-            <tr>
-                <td align="center" style="padding: 40px 0;">
-                    <table role="presentation" style="width: 600px; border-collapse: collapse; background-color: #ffffff; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
-                        <!-- Header -->
-                        <tr>
-                            <td style="padding: 40px 40px 20px 40px; text-align: center;">
-                                <h1 style="margin: 0; font-size: 28px; font-weight: bold; color: #333333;">MINDFUEL</h1>
-                            </td>
-                        </tr>
-                        
-                        <!-- Main Content -->
-                        <tr>
-                            <td style="padding: 20px 40px;">
-                                <h2 style="margin: 0 0 20px 0; font-size: 22px; font-weight: bold; color: #333333; text-align: center;">
-                                    STRENGTH STARTS<br>FROM THE MIND
-                                </h2>
-                                
-                                <p style="margin: 0 0 30px 0; font-size: 16px; color: #666666; text-align: center; font-weight: bold;">
-                                    DAILY QUOTE TO KEEP YOU GOING
-                                </p>
-                                
-                                <p style="margin: 0 0 20px 0; font-size: 15px; color: #333333; line-height: 1.6;">
-                                    Hi {name},
-                                </p>
-                                
-                                <p style="margin: 0 0 30px 0; font-size: 15px; color: #333333; line-height: 1.6;">
-                                    Here's something to get your day started.
-                                </p>
-                                
-                                <div style="background-color: #f8f8f8; padding: 30px; margin: 0 0 20px 0; border-left: 4px solid #4CAF50; border-radius: 4px;">
-                                    <p style="margin: 0 0 15px 0; font-size: 18px; color: #333333; line-height: 1.8; font-style: italic;">
-                                        {quote}
-                                    </p>
-                                    <p style="margin: 0; font-size: 14px; color: #666666; text-align: right;">
-                                        - {author}
-                                    </p>
-                                </div>
-                                
-                                <p style="margin: 30px 0 0 0; font-size: 15px; color: #333333; line-height: 1.6;">
-                                    Best Regards,<br>
-                                    <strong>MindFuel</strong>
-                                </p>
-                            </td>
-                        </tr>
-                        
-                        <!-- Footer -->
-                        <tr>
-                            <td style="padding: 30px 40px; background-color: #f8f8f8; border-top: 1px solid #e0e0e0;">
-                                <p style="margin: 0 0 10px 0; font-size: 16px; color: #333333; font-weight: bold;">
-                                    MindFuel
-                                </p>
-                                <p style="margin: 0 0 15px 0; font-size: 13px; color: #666666; line-height: 1.6;">
-                                    Suite 123, 123 Anywhere Street,<br>
-                                    Any City, ST 12345
-                                </p>
-                                <p style="margin: 0; font-size: 12px; color: #999999; line-height: 1.6;">
-                                    You're receiving this email because you signed up for updates from MindFuel.
-                                </p>
-                            </td>
-                        </tr>
-                    </table>
-                </td>
-            </tr>
-        </table>
-    </body>
-    </html>
-    """.format(name=recipient_name, quote=quote, author=author)
-
-    # Plain text version
-    text_body = f"""
-    MINDFUEL
-    STRENGTH STARTS FROM THE MIND
-    DAILY QUOTE TO KEEP YOU GOING
-
-    Hi {recipient_name},
-
-    Here's something to get your day started.
-
-    "{quote}"
-    - {author}
-
-    Best Regards,
-    MindFuel
-
-    MindFuel
-    Suite 123, 123 Anywhere Street,
-    Any City, ST 12345
-
-    You're receiving this email because you signed up for updates from MindFuel.
-    """
-    return html_body, text_body
-
-
-
-def send_email_config(user_name, user_email, quote, author, sender_name='MindFuel', subject = "Inspiration from MindFuel", max_retries=MAX_RETRIES):
-    """Send email with max retry in place."""
+def send_email_config(user_name, user_email, template, smtp, max_retries=MAX_RETRIES):
+    """Send email over the shared SMTP connection with max retry in place."""
+    # Create message once; every attempt sends the same bytes
+    message = template.build(user_name, user_email)
     for attempt in range(1, max_retries + 1):
         try:
-            # Create message
-            message = MIMEMultipart('related')
-            message['From'] = formataddr((sender_name, SENDER_EMAIL))
-            message['To'] = user_email
-            message['Subject'] = subject
-
-            # Alternative container
-            msg_alternative = MIMEMultipart('alternative')
-            message.attach(msg_alternative)
-
-            html_body, text_body = email_template(user_name, quote=quote, author=author)
-            # Attach text and HTML
-            msg_alternative.attach(MIMEText(text_body, 'plain'))
-            msg_alternative.attach(MIMEText(html_body, 'html'))
-
             # Send email
-            with smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT) as server:
-                server.starttls()
-                server.login(SENDER_EMAIL, SENDER_PASSWORD)
-                server.send_message(message)
-             
-                logger.info(f'Email sent successfully {user_name}, {user_email} on attempt {attempt}!')
+            smtp.send_raw(template.sender_email, [user_email], message)
+            logger.info(f'Email sent successfully {user_name}, {user_email} on attempt {attempt}!')
             return True
         except smtplib.SMTPException as e:
             logger.warning(f'SMTP error sending to {user_email} (attempt {attempt}/{max_retries}): {e}')
@@ -291,30 +208,100 @@ def get_quote(filename):
     
 
 
-def process_user_batch(batch, quote, author, stats):
-    
-    for user in batch:
+def send_to_user(smtp, worker_stats, user, template, record_sent):
+    """
+    Send one user their email from a sender worker, counting the result in the
+    worker's own stats and passing the address of a sent email to record_sent.
+    """
+    name = user['first_name']
+    email = user['email_address']
+
+    worker_stats['records_processed'] += 1
+    try: 
+        success = send_email_config(name, email, template, smtp)
+        if success:
+            worker_stats['emails_sent'] += 1
+            record_sent(email)
+        else:
+            worker_stats['failed'] += 1           
+       
+    except Exception as e:
+        worker_stats['failed'] += 1 
+        logger.error(f"Failed to send email to {name} ({email}): {e}")
+
+    return 1
+
+
+
+def send_to_group(smtp, worker_stats, users, template, record_sent):
+    """
+    Send a group of users their emails as pipelined SMTP transactions, counting
+    each result in the worker's own stats. Refused recipients and other
+    permanent errors count as failed; users whose email failed for a
+    temporary reason, such as a dropped connection, are sent again one at a
+    time with retries.
+    """
+    built = []
+    messages = []
+    for user in users:
+        try:
+            messages.append((user['email_address'], template.build(user['first_name'], user['email_address'])))
+            built.append(user)
+        except Exception as e:
+            # As in send_to_user, one bad row fails only its own email
+            worker_stats['records_processed'] += 1
+            worker_stats['failed'] += 1
+            logger.error(f"Failed to send email to {user['first_name']} ({user['email_address']}): {e}")
+
+    results = smtp.send_many(template.sender_email, messages) if messages else []
+    for user, error in zip(built, results):
         name = user['first_name']
         email = user['email_address']
+        if error is None:
+            worker_stats['records_processed'] += 1
+            worker_stats['emails_sent'] += 1
+            record_sent(email)
+            logger.info(f'Email sent successfully {name}, {email} on attempt 1!')
+        elif is_permanent(error):
+            worker_stats['records_processed'] += 1
+            worker_stats['failed'] += 1
+            logger.error(f"Failed to send email to {name} ({email}): {error}")
+        else:
+            logger.warning(f'SMTP error sending to {email} in a pipelined group, retrying on its own: {error}')
+            send_to_user(smtp, worker_stats, user, template, record_sent)
 
-        stats['records_processed'] += 1
-        try: 
-            success = send_email_config(name, email, quote, author)
-            if success:
-                stats['emails_sent'] += 1
-            else:
-                stats['failed'] += 1           
-           
-        except Exception as e:
-            stats['failed'] += 1 
-            logger.error(f"Failed to send email to {name} ({email}): {e}")
-            
-     # Update every 100 emails progress
-        if stats['records_processed'] % 100 == 0:
-            logger.info(f"Progress: {stats['records_processed']} emails processed.")
-        
-        # Rate limiting
-        time.sleep(RATE_LIMIT_DELAY)   
+    return len(users)
+
+
+
+def process_user_batch(batch, frequency, template, stats, pool, ledger):
+    """
+    Send the batch through the sender pool, skipping users the ledger says
+    were already sent today's email, then merge the workers' counts into stats.
+    """
+    already_sent = ledger.delivered(frequency, [user['email_address'] for user in batch])
+    if already_sent:
+        stats['already_sent'] += len(already_sent)
+        batch = [user for user in batch if user['email_address'] not in already_sent]
+        logger.info(f"Skipped {len(already_sent)} {frequency} users already sent today's email")
+
+    record_sent = partial(ledger.record, frequency)
+    if SMTP_PIPELINING:
+        send = partial(send_to_group, template=template, record_sent=record_sent)
+        items = [batch[i:i + SMTP_PIPELINE_SIZE] for i in range(0, len(batch), SMTP_PIPELINE_SIZE)]
+    else:
+        send = partial(send_to_user, template=template, record_sent=record_sent)
+        items = batch
+    done = stats['records_processed']
+    for count in pool.map(send, items):
+        previous = done
+        done += count
+        # Update every 100 emails progress
+        if done // 100 > previous // 100:
+            logger.info(f"Progress: {done} emails processed.")
+
+    pool.merge_stats(stats)
+    ledger.flush()
 
 
 
@@ -335,6 +322,7 @@ def generate_summary(stats, day_name, duration, success=True):
         Total processed: {total}
         Successfully sent: {stats['emails_sent']}
         Failed: {stats['failed']}
+        Already sent by an earlier run today (skipped): {stats['already_sent']}
         Success rate: {success_rate:.2f}%
 
         BREAKDOWN:
@@ -346,6 +334,16 @@ def generate_summary(stats, day_name, duration, success=True):
         ------------
         Duration: {duration:.2f} seconds ({duration/60:.2f} minutes)
         Throughput: {stats['emails_sent'] / duration:.2f} emails/second
+
+        SMTP CONNECTIONS:
+        -----------------
+        Sender workers: {stats['smtp_workers']}
+        Rate limit wait: {stats['rate_limit_wait']:.2f} seconds (all workers)
+        Connections opened: {stats['smtp_connections']}
+        Emails per connection: {stats['smtp_messages_per_connection']:.1f}
+        Reconnects after server disconnect: {stats['smtp_reconnects']}
+        Recycled (message or age limit): {stats['smtp_recycled']}
+        Sent pipelined: {stats['smtp_pipelined']}
         """
     return summary
 
@@ -361,6 +359,7 @@ def log_final_summary(stats, day_name, duration):
     summary_logger.info(f"Weekly subscribers: {stats['weekly']}")
     summary_logger.info(f"Successfully sent: {stats['emails_sent']}")
     summary_logger.info(f"Failed: {stats['failed']}")
+    summary_logger.info(f"Already sent by an earlier run today (skipped): {stats['already_sent']}")
     
     if stats['records_processed'] > 0:
         success_rate = (stats['emails_sent'] / stats['records_processed']) * 100
@@ -372,6 +371,28 @@ def log_final_summary(stats, day_name, duration):
         throughput = stats['emails_sent'] / duration
         summary_logger.info(f"Throughput: {throughput:.2f} emails/second")
 
+    summary_logger.info(f"Sender workers: {stats['smtp_workers']}, rate limit wait: {stats['rate_limit_wait']:.2f}s")
+    summary_logger.info(f"SMTP connections opened: {stats['smtp_connections']} "
+                        f"({stats['smtp_messages_per_connection']:.1f} emails per connection, "
+                        f"{stats['smtp_reconnects']} reconnects, {stats['smtp_recycled']} recycled, "
+                        f"{stats['smtp_pipelined']} sent pipelined)")
+
+
+
+def finish_sending(stats, pool, limiter, ledger):
+    """
+    Close the sender pool and the send ledger, and add what is left of the
+    workers' counts (from a batch cut short by an error), the connection reuse
+    counters and the rate limit wait into the run stats.
+    """
+    pool.close()
+    ledger.close()
+    pool.merge_stats(stats)
+    for key, value in pool.summary().items():
+        if key != 'messages':
+            stats[f'smtp_{key}'] = value
+    stats['rate_limit_wait'] = limiter.wait_seconds if limiter else 0.0
+
 
 
 def send_alert_email(summary_text, subject="MindFuel Email Automation Summary"):
@@ -458,21 +479,38 @@ def main():
     except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
         logger.error(f"Failed to load quote: {e}")
         return 1
+    # Render the day's email once; only the subscriber's name changes per email
+    template = EmailTemplate(quote, author, SENDER_EMAIL)
     
     stats = {
         'records_processed': 0,
         'emails_sent': 0,
         'failed': 0,
+        'already_sent': 0,
         'daily': 0,
-        'weekly': 0
+        'weekly': 0,
+        'smtp_connections': 0,
+        'smtp_messages_per_connection': 0.0,
+        'smtp_reconnects': 0,
+        'smtp_recycled': 0,
+        'smtp_pipelined': 0,
+        'smtp_workers': 0,
+        'rate_limit_wait': 0.0
     }
+    ledger = SendLedger(SEND_LEDGER_PATH)
+    limiter = TokenBucket(SEND_RATE) if SEND_RATE > 0 else None
+    pool = SenderPool(
+        lambda: SMTPConnection(SMTP_SERVER, SMTP_PORT, SENDER_EMAIL, SENDER_PASSWORD, timeout=SMTP_TIMEOUT,
+                               max_messages=SMTP_MAX_MESSAGES, max_age=SMTP_MAX_AGE, limiter=limiter),
+        SEND_WORKERS
+    )
     # Get day to filter for weekly subscribers
     day_name = datetime.now().strftime("%A")
     try:
         # process daily users in batches
         logger.info("Attempting to fetch daily subscribers")
         for batch in fetch_users_in_batches('daily', CHUNK_SIZE):
-            process_user_batch(batch, quote, author, stats)
+            process_user_batch(batch, 'daily', template, stats, pool, ledger)
             stats['daily'] += len(batch)
         logger.info(f"Completed daily subscribers: {stats['daily']} users processed.")
         
@@ -480,7 +518,7 @@ def main():
         if day_name == 'Monday':
             logger.info("Attempting to fetch weekly subscribers")
             for batch in fetch_users_in_batches('weekly', CHUNK_SIZE):
-                process_user_batch(batch, quote, author, stats)
+                process_user_batch(batch, 'weekly', template, stats, pool, ledger)
                 stats['weekly'] += len(batch)
             logger.info(f"Completed weekly subscribers: {stats['weekly']} users processed")
         else:
@@ -488,6 +526,7 @@ def main():
  
     except Exception as e:
         logger.error(f"Critical error during batch processing: {e}", exc_info=True)
+        finish_sending(stats, pool, limiter, ledger)
 
         end_time = datetime.now()
         duration = (end_time - start_time).total_seconds()
@@ -497,6 +536,8 @@ def main():
         
         return 1
     
+    finish_sending(stats, pool, limiter, ledger)
+
     # Calculate final stats 
     end_time = datetime.now()
     duration = (end_time - start_time).total_seconds()
@@ -0,0 +1,111 @@
+import logging
+import sqlite3
+import threading
+from datetime import date, timedelta
+
+logger = logging.getLogger(__name__)
+
+# SQLite caps the number of bound parameters per statement
+LOOKUP_CHUNK = 500
+
+# Commit recorded sends once this many are waiting
+DEFAULT_COMMIT_EVERY = 100
+
+# Days of ledger entries kept; older ones are deleted on open
+DEFAULT_KEEP_DAYS = 7
+
+
+class SendLedger:
+    """
+    Durable record of who was sent the email on `run_date`, backed by SQLite.
+
+    Entries are keyed on (run_date, frequency, email) in a WITHOUT ROWID
+    table, so checking a batch of subscribers is a handful of primary key
+    lookups however many rows the ledger holds. Sends are recorded from any
+    sender thread and committed in batches of `commit_every`; `flush` commits
+    the rest. A rerun on the same day skips everyone already recorded, so a
+    crash costs at most the uncommitted batch being sent again.
+    """
+
+    def __init__(self, path, run_date=None, commit_every=DEFAULT_COMMIT_EVERY, keep_days=DEFAULT_KEEP_DAYS):
+        self.path = path
+        self.run_date = (run_date or date.today()).isoformat()
+        self.commit_every = commit_every
+        self.lock = threading.Lock()
+        # (frequency, email) of sends not yet committed
+        self.pending = []
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # FULL so a committed batch is on disk before the journal is reset
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sent (
+                run_date TEXT NOT NULL,
+                frequency TEXT NOT NULL,
+                email TEXT NOT NULL,
+                PRIMARY KEY (run_date, frequency, email)
+            ) WITHOUT ROWID
+        """)
+        cutoff = ((run_date or date.today()) - timedelta(days=keep_days)).isoformat()
+        self.conn.execute("DELETE FROM sent WHERE run_date < ?", (cutoff,))
+        self.conn.commit()
+        # Sends already recorded for this date per frequency; while 0, lookups are skipped
+        self.recorded = dict(self.conn.execute(
+            "SELECT frequency, count(*) FROM sent WHERE run_date = ? GROUP BY frequency", (self.run_date,)
+        ).fetchall())
+        if self.recorded:
+            logger.info(f"Send ledger already has {sum(self.recorded.values())} emails sent on {self.run_date}; "
+                        f"they will be skipped")
+
+    def delivered(self, frequency, emails):
+        """Return the subset of `emails` already sent to as `frequency` subscribers on this date."""
+        emails = list(emails)
+        found = set()
+        if not self.recorded.get(frequency):
+            return found
+        with self.lock:
+            for start in range(0, len(emails), LOOKUP_CHUNK):
+                chunk = emails[start:start + LOOKUP_CHUNK]
+                rows = self.conn.execute(
+                    f"SELECT email FROM sent WHERE run_date = ? AND frequency = ? "
+                    f"AND email IN ({','.join('?' * len(chunk))})",
+                    [self.run_date, frequency, *chunk]
+                )
+                found.update(row[0] for row in rows)
+        return found
+
+    def record(self, frequency, email):
+        """Note that `email` was sent to; committed with the next full batch or flush."""
+        with self.lock:
+            self.pending.append((frequency, email))
+            if len(self.pending) >= self.commit_every:
+                self._commit()
+
+    def flush(self):
+        """Commit every recorded send."""
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        # The caller holds the lock
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO sent (run_date, frequency, email) VALUES (?, ?, ?)",
+                ((self.run_date, frequency, email) for frequency, email in self.pending)
+            )
+        for frequency, _ in self.pending:
+            self.recorded[frequency] = self.recorded.get(frequency, 0) + 1
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,379 @@
+import logging
+import re
+import smtplib
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+# Default connection settings
+DEFAULT_TIMEOUT = 30
+# Open a fresh connection after this many messages or seconds; providers cap
+# messages per session and drop long-lived ones
+DEFAULT_MAX_MESSAGES = 100
+DEFAULT_MAX_AGE = 300
+
+
+class SMTPConnection:
+    """
+    Authenticated SMTP connection kept open across sends.
+
+    The connection is opened (STARTTLS and login) on the first send and reused
+    until it has sent `max_messages` messages or is `max_age` seconds old,
+    when it is closed and a new one opened. If the server has dropped the
+    connection, it is reopened and the message sent again once. Other
+    connection errors close it so the caller's next attempt reconnects.
+    With a `limiter` (throttle.TokenBucket), every send waits for a token.
+    send_many sends a list of messages with ESMTP PIPELINING where the server
+    offers it.
+    """
+
+    def __init__(self, host, port, username, password, timeout=DEFAULT_TIMEOUT,
+                 max_messages=DEFAULT_MAX_MESSAGES, max_age=DEFAULT_MAX_AGE, limiter=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.limiter = limiter
+        self.server = None
+        self.opened_at = None
+        self.sent_on_connection = 0
+        self.stats = {
+            'connections': 0,     # connections opened (each one a TLS handshake and login)
+            'messages': 0,        # messages accepted by the server
+            'reconnects': 0,      # reopened after the server dropped the connection
+            'recycled': 0,        # closed after max_messages or max_age
+            'pipelined': 0        # messages accepted through send_many with PIPELINING
+        }
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.starttls()
+            server.login(self.username, self.password)
+        except BaseException:
+            server.close()
+            raise
+        self.server = server
+        self.opened_at = time.monotonic()
+        self.sent_on_connection = 0
+        self.stats['connections'] += 1
+
+    def _expired(self):
+        return (self.sent_on_connection >= self.max_messages
+                or time.monotonic() - self.opened_at >= self.max_age)
+
+    def send(self, message):
+        """Send `message`, returning the recipients the server refused (see SMTP.send_message)."""
+        return self._transact(lambda server: server.send_message(message))
+
+    def send_raw(self, from_addr, to_addrs, data):
+        """
+        Send a message already flattened to bytes (CRLF line endings), returning
+        the recipients the server refused (see SMTP.sendmail).
+        """
+        def sendmail(server):
+            mail_options = ()
+            if not ''.join([from_addr, *to_addrs]).isascii():
+                # Same rule as SMTP.send_message for internationalised addresses
+                if not server.has_extn('smtputf8'):
+                    raise smtplib.SMTPNotSupportedError(
+                        "Non-ASCII addresses need SMTPUTF8, which the server does not support")
+                mail_options = ('SMTPUTF8', 'BODY=8BITMIME')
+            return server.sendmail(from_addr, to_addrs, data, mail_options)
+        return self._transact(sendmail)
+
+    def send_many(self, from_addr, messages):
+        """
+        Send `messages`, (to_addr, data) pairs like send_raw's, one transaction
+        each. Returns a result per message instead of raising: None if the
+        server accepted it, else the SMTPException or OSError it failed with
+        (see is_permanent).
+
+        If the server advertises PIPELINING, a message's MAIL, RCPT and DATA
+        commands are written in one go together with the end of the message
+        before it, so each message costs one round trip instead of four.
+        Otherwise the messages are sent one by one with send_raw. Messages are
+        pipelined in groups no larger than what the connection has left of
+        max_messages, so it is recycled between groups. If the connection is
+        lost, every message of the group not yet confirmed gets the error and
+        the next group is sent on a new connection.
+        """
+        results = []
+        while len(results) < len(messages):
+            rest = messages[len(results):]
+            if self.server is not None and self._expired():
+                self.stats['recycled'] += 1
+                self.close()
+            try:
+                if self.server is None:
+                    self._connect()
+            except OSError as e:
+                return results + [e] * len(rest)
+            if not self.server.has_extn('pipelining'):
+                return results + [self._try_send(from_addr, to_addr, data) for to_addr, data in rest]
+            budget = max(1, self.max_messages - self.sent_on_connection)
+            results += self._pipeline(from_addr, rest[:budget])
+        return results
+
+    def _pipeline(self, from_addr, messages):
+        """Send `messages` over the open connection with PIPELINING; see send_many."""
+        results = [None] * len(messages)
+        pending = []
+        for index, (to_addr, data) in enumerate(messages):
+            if not (from_addr + to_addr).isascii() and not self.server.has_extn('smtputf8'):
+                results[index] = smtplib.SMTPNotSupportedError(
+                    "Non-ASCII addresses need SMTPUTF8, which the server does not support")
+            else:
+                pending.append((index, to_addr, data))
+        if not pending:
+            return results
+
+        server = self.server
+        position = 0
+        try:
+            server.send(self._commands(from_addr, *pending[0][1:]))
+            for position, (index, to_addr, data) in enumerate(pending):
+                mail, rcpt, data_reply = _reply(server), _reply(server), _reply(server)
+                following = b''
+                if position + 1 < len(pending):
+                    following = self._commands(from_addr, *pending[position + 1][1:])
+                end = None
+                if data_reply[0] == 354:
+                    if mail[0] == 250 and rcpt[0] in (250, 251):
+                        body = _quote_periods(data)
+                    else:
+                        # DATA accepted without a recipient; end it empty
+                        body = b''
+                    server.send(body + b'.\r\n' + following)
+                    end = _reply(server)
+                else:
+                    # Nothing to end, but MAIL may have opened a transaction
+                    server.send(b'RSET\r\n' + following)
+                    _reply(server)
+                results[index] = _transaction_error(from_addr, to_addr, mail, rcpt, data_reply, end)
+                if results[index] is None:
+                    self.sent_on_connection += 1
+                    self.stats['messages'] += 1
+                    self.stats['pipelined'] += 1
+        except OSError as e:
+            # SMTPServerDisconnected, a 421 or a socket error; the next send reconnects
+            logger.info(f"SMTP connection to {self.host} lost during pipelined send ({e}); "
+                        f"{len(pending) - position} messages unconfirmed")
+            self._discard()
+            if isinstance(e, smtplib.SMTPServerDisconnected):
+                self.stats['reconnects'] += 1
+            for index, _, _ in pending[position:]:
+                results[index] = e
+        return results
+
+    def _try_send(self, from_addr, to_addr, data):
+        try:
+            self.send_raw(from_addr, [to_addr], data)
+        except OSError as e:
+            return e
+        return None
+
+    def _commands(self, from_addr, to_addr, data):
+        """MAIL, RCPT and DATA for one pipelined transaction, once the limiter allows it."""
+        if self.limiter is not None:
+            self.limiter.acquire()
+        options = ''
+        if self.server.has_extn('size'):
+            options += f' SIZE={len(data)}'
+        if not (from_addr + to_addr).isascii():
+            options += ' SMTPUTF8 BODY=8BITMIME'
+        return (
+            f'MAIL FROM:{smtplib.quoteaddr(from_addr)}{options}\r\n'
+            f'RCPT TO:{smtplib.quoteaddr(to_addr)}\r\n'
+            f'DATA\r\n'
+        ).encode('utf-8')
+
+    def _transact(self, transaction):
+        """Run transaction(server) on an open connection, reconnecting once if the server dropped it."""
+        if self.server is not None and self._expired():
+            self.stats['recycled'] += 1
+            self.close()
+        if self.server is None:
+            self._connect()
+        if self.limiter is not None:
+            self.limiter.acquire()
+        try:
+            try:
+                refused = transaction(self.server)
+            except smtplib.SMTPServerDisconnected:
+                # Usually an idle or session timeout on the server side
+                logger.info(f"SMTP connection to {self.host} was closed by the server; reconnecting")
+                self._discard()
+                self.stats['reconnects'] += 1
+                self._connect()
+                refused = transaction(self.server)
+        except smtplib.SMTPServerDisconnected:
+            self._discard()
+            raise
+        except smtplib.SMTPResponseException as e:
+            # 421: the server is closing the connection
+            if e.smtp_code == 421:
+                self._discard()
+            raise
+        except smtplib.SMTPException:
+            # e.g. every recipient refused; the transaction was reset and the connection is fine
+            raise
+        except OSError:
+            # Socket errors and timeouts (SMTPException is an OSError, hence the order)
+            self._discard()
+            raise
+        self.sent_on_connection += 1
+        self.stats['messages'] += 1
+        return refused
+
+    def _discard(self):
+        if self.server is not None:
+            try:
+                self.server.close()
+            except OSError:
+                pass
+        self.server = None
+
+    def summary(self):
+        """Connection counters, plus messages sent per connection opened."""
+        summary = dict(self.stats)
+        summary['messages_per_connection'] = (
+            summary['messages'] / summary['connections'] if summary['connections'] else 0.0
+        )
+        return summary
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except OSError:
+            pass
+        self._discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _reply(server):
+    """The next (code, message) reply; a 421 means the server is closing the connection."""
+    code, message = server.getreply()
+    if code == 421:
+        raise smtplib.SMTPServerDisconnected(f"{code} {message.decode('utf-8', 'replace')}")
+    return code, message
+
+
+def _quote_periods(data):
+    """Dot-stuff a CRLF message for DATA and make sure it ends with CRLF."""
+    data = re.sub(rb'(?m)^\.', b'..', data)
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data
+
+
+def _transaction_error(from_addr, to_addr, mail, rcpt, data, end):
+    """The exception SMTP.sendmail would raise for these replies, or None if the message was accepted."""
+    if mail[0] != 250:
+        return smtplib.SMTPSenderRefused(mail[0], mail[1], from_addr)
+    if rcpt[0] not in (250, 251):
+        return smtplib.SMTPRecipientsRefused({to_addr: rcpt})
+    if data[0] != 354:
+        return smtplib.SMTPDataError(*data)
+    if end[0] != 250:
+        return smtplib.SMTPDataError(*end)
+    return None
+
+
+def is_permanent(error):
+    """True if sending again cannot help: a 5xx refusal, or a feature the server lacks."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return isinstance(error, smtplib.SMTPNotSupportedError)
+
+
+class SenderPool:
+    """
+    Sends from `workers` threads, each with its own SMTPConnection made by
+    `connect`. Each worker also keeps its own counters, which merge_stats adds
+    into the run's stats between batches, so workers never share a lock for
+    counting.
+    """
+
+    def __init__(self, connect, workers):
+        self.connect = connect
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sender')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (connection, counters) of every worker thread started so far
+        self.workers = []
+
+    def _worker(self):
+        worker = getattr(self.local, 'worker', None)
+        if worker is None:
+            worker = self.local.worker = (self.connect(), Counter())
+            with self.lock:
+                self.workers.append(worker)
+        return worker
+
+    def _run(self, send, item):
+        smtp, counters = self._worker()
+        return send(smtp, counters, item)
+
+    def map(self, send, items):
+        """
+        Call send(smtp, counters, item) for every item on the worker threads,
+        yielding the results as they finish. An exception from `send` is
+        raised here.
+        """
+        futures = [self.executor.submit(self._run, send, item) for item in items]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def merge_stats(self, stats):
+        """Add every worker's counters into `stats` and reset them. Call while no sends are running."""
+        with self.lock:
+            for _, counters in self.workers:
+                for key, value in counters.items():
+                    stats[key] = stats.get(key, 0) + value
+                counters.clear()
+
+    def summary(self):
+        """Connection counters summed over the workers."""
+        with self.lock:
+            totals = Counter()
+            for smtp, _ in self.workers:
+                totals.update(smtp.stats)
+            summary = {key: totals[key] for key in ('connections', 'messages', 'reconnects', 'recycled', 'pipelined')}
+            summary['workers'] = len(self.workers)
+        summary['messages_per_connection'] = (
+            summary['messages'] / summary['connections'] if summary['connections'] else 0.0
+        )
+        return summary
+
+    def close(self):
+        """Wait for running sends, then close every worker's connection."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.lock:
+            for smtp, _ in self.workers:
+                smtp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,34 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter shared by all sender threads: on average at most
+    `rate` acquisitions per second between them, with up to `burst` at once.
+    """
+
+    def __init__(self, rate, burst=1.0):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        # Seconds callers spent waiting, reported at the end of a run
+        self.wait_seconds = 0.0
+
+    def acquire(self):
+        """Block until a token is free. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.wait_seconds += waited
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay